@@ -0,0 +1,95 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+from contextlib import contextmanager
+import io
+import json
+import os
+import tarfile
+
+from gitshed.error import GitShedError
+
+
+# A bundle is an uncompressed tar file, so that it can be written and read in a single sequential
+# pass. Its first member is the index, which maps each key in the bundle to its size and to the shed
+# paths of its content. Each subsequent member holds the content of one key, and is named by it.
+
+BUNDLE_VERSION = 1
+
+_INDEX_NAME = 'index.json'
+
+
+def write_bundle(bundle_path, entries):
+  """Writes a bundle, atomically.
+
+  :param bundle_path: The path to write the bundle to.
+  :param entries: A list of (key, content path, shed paths) triples.
+  :returns: The total size of the content in the bundle.
+  """
+  index = {}
+  for key, content_path, shed_paths in entries:
+    index[key] = {'size': os.path.getsize(content_path), 'shed_paths': sorted(shed_paths)}
+  index_data = json.dumps({'version': BUNDLE_VERSION, 'keys': index}, sort_keys=True).encode('utf-8')
+
+  tmp_path = '{0}.tmp'.format(bundle_path)
+  try:
+    with tarfile.open(tmp_path, 'w') as bundle:
+      index_info = tarfile.TarInfo(_INDEX_NAME)
+      index_info.size = len(index_data)
+      bundle.addfile(index_info, io.BytesIO(index_data))
+      for key, content_path, _ in entries:
+        info = bundle.gettarinfo(content_path, arcname=key)
+        with open(content_path, 'rb') as infile:
+          bundle.addfile(info, infile)
+    os.rename(tmp_path, bundle_path)
+  except BaseException:
+    if os.path.exists(tmp_path):
+      os.unlink(tmp_path)
+    raise
+  return sum(entry['size'] for entry in index.values())
+
+
+@contextmanager
+def open_bundle(bundle_path):
+  """A context for reading a bundle sequentially.
+
+  Yields a pair of (index, entries), where index maps each key in the bundle to a dict with its
+  'size' and 'shed_paths', and entries is an iterator over a (key, file object) pair for each key.
+  Each file object is only valid until the iterator advances.
+
+  :param bundle_path: The bundle to read.
+  :raises GitShedError: If the file isn't a bundle this version of gitshed can read.
+  """
+  try:
+    bundle = tarfile.open(bundle_path, 'r|')
+  except (IOError, tarfile.TarError) as e:
+    raise GitShedError('Failed to open bundle {0}: {1}'.format(bundle_path, e))
+  with bundle:
+    try:
+      members = iter(bundle)
+      index_info = next(members, None)
+      if index_info is None or index_info.name != _INDEX_NAME:
+        raise GitShedError('{0} is not a gitshed bundle: it has no index.'.format(bundle_path))
+      index = json.loads(bundle.extractfile(index_info).read().decode('utf-8'))
+      if index.get('version') != BUNDLE_VERSION:
+        raise GitShedError('Unsupported bundle version {0} in {1}.'.format(index.get('version'), bundle_path))
+
+      def entries():
+        seen = set()
+        for info in members:
+          if info.name not in index['keys'] or not info.isfile():
+            raise GitShedError('Unexpected entry {0} in bundle {1}.'.format(info.name, bundle_path))
+          seen.add(info.name)
+          yield info.name, bundle.extractfile(info)
+        # A tar stream that's truncated between members just looks like it ended early.
+        num_missing = len(set(index['keys']) - seen)
+        if num_missing:
+          raise GitShedError('Bundle {0} is truncated: it has no content for {1} of its {2} keys.'.format(
+            bundle_path, num_missing, len(index['keys'])))
+
+      yield index['keys'], entries()
+    except tarfile.TarError as e:
+      # E.g., a bundle that's truncated in the middle of a member.
+      raise GitShedError('Failed to read bundle {0}: {1}'.format(bundle_path, e))
@@ -0,0 +1,329 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+from contextlib import contextmanager
+from functools import update_wrapper
+import glob
+import itertools
+import os
+import sys
+
+import click
+
+from gitshed.error import GitShedError
+from gitshed.gitshed import GitShed
+from gitshed.metrics import metrics
+from gitshed.util import iter_delimited, parse_size
+
+
+def gitshed_instance():
+  """Returns a GitShed instance to work with."""
+  config_file_path = os.path.join('.gitshed', 'config.json')
+  return GitShed.from_config(config_file_path)
+
+_verbose = False
+
+
+@contextmanager
+def exception_handling():
+  """A context that handles exceptions based on the value of the --verbose flag."""
+  try:
+    yield
+  except Exception as e:
+    metrics.increment('command_errors')
+    if _verbose:  # Raise the exception so we see a full stack trace.
+      raise
+    else:  # Delegate exception handling to click, which will suppress the stack trace.
+      raise click.ClickException(str(e))
+
+
+def path_glob_args(func):
+  """A useful decorator that expands path glob options into a list of matched paths.
+
+  E.g.,
+
+  @path_glob_args
+  def func(paths):
+    ...
+
+  The decorated func will take 'argfile', 'stdin', 'null' and 'path_globs' arguments and pass the
+  expanded paths to func(), as a lazy iterator. Will pass None to func if no paths were specified.
+  This allows func to distinguish no arguments from arguments that evaluate to an empty list of paths.
+  """
+  @click.option('-f', '--argfile', type=click.File('rb'),
+                help='Use the paths listed in this file, one per line.')
+  @click.option('--stdin', 'read_stdin', is_flag=True,
+                help='Use the paths listed on stdin, one per line.')
+  @click.option('-z', '--null', is_flag=True,
+                help='Paths in the argfile or on stdin are NUL-separated, instead of one per line.')
+  @click.argument('path_globs', nargs=-1)
+  @click.pass_context
+  def path_glob_func(ctx, argfile, read_stdin, null, path_globs, **kwargs):
+    with exception_handling():
+      if not argfile and not read_stdin and not path_globs:
+        return ctx.invoke(func, None, **kwargs)
+      def iter_paths(infile):
+        if null:
+          return iter_delimited(infile, b'\0')
+        # Lines may end with CRLF, e.g., in argfiles written on Windows.
+        lines = (record.rstrip(b'\r') for record in iter_delimited(infile, b'\n'))
+        return (line for line in lines if line)
+
+      sources = [(path for path_glob in path_globs for path in glob.glob(path_glob))]
+      if argfile:
+        sources.append(iter_paths(argfile))
+      if read_stdin:
+        sources.append(iter_paths(sys.stdin))
+      try:
+        return ctx.invoke(func, itertools.chain(*sources), **kwargs)
+      finally:
+        if argfile:
+          argfile.close()
+
+  return update_wrapper(path_glob_func, func)
+
+
+# The click subcommands, all under the 'gitshed' main command.
+
+@click.group()
+@click.option('-v', '--verbose/--no-verbose', default=False, help='Show detailed run information.')
+@click.pass_context
+def gitshed(ctx, verbose):
+  global _verbose
+  _verbose = verbose
+  metrics.command = ctx.invoked_subcommand
+
+
+@click.command()
+def status():
+  with exception_handling():
+    gitshed_instance().status()
+
+
+def null_output_option(func):
+  """A decorator that adds an option to NUL-terminate output paths, instead of newline-terminating them.
+
+  The decorated func will take a 'delimiter' argument.
+  """
+  @click.option('-z', '--null', is_flag=True, help='NUL-terminate output paths, instead of newline-terminating them.')
+  @click.pass_context
+  def null_output_func(ctx, null, *args, **kwargs):
+    return ctx.invoke(func, *args, delimiter=b'\0' if null else b'\n', **kwargs)
+
+  return update_wrapper(null_output_func, func)
+
+
+@click.command()
+@null_output_option
+def synced(delimiter):
+  with exception_handling():
+    gitshed_instance().synced(delimiter=delimiter)
+
+
+@click.command()
+@null_output_option
+def unsynced(delimiter):
+  with exception_handling():
+    gitshed_instance().unsynced(delimiter=delimiter)
+
+
+@click.command()
+@path_glob_args
+def manage(paths):
+  if paths:
+    with exception_handling():
+      gb = gitshed_instance()
+      gb.manage(paths)
+
+
+@click.command()
+@path_glob_args
+def unmanage(paths):
+  if paths:
+    with exception_handling():
+      gb = gitshed_instance()
+      gb.unmanage(paths)
+
+
+@click.command()
+@click.option('--retries', default=0, help='Retry failed uploads this many times.')
+def upload(retries):
+  """Upload content that was managed with asynchronous uploads, and is still waiting to be uploaded."""
+  with exception_handling():
+    if gitshed_instance().upload(retries=retries):
+      raise GitShedError('Some content failed to upload. Run "git shed upload" again to retry.')
+
+
+@click.command()
+@click.option('--prefix', 'prefixes', multiple=True,
+              help='Sync files under this path first. May be repeated, in priority order.')
+@click.option('--smallest-first', is_flag=True, help='Sync smaller files first.')
+@click.option('--stream', is_flag=True,
+              help='Print the path of each file, NUL-terminated, as soon as it is synced.')
+@path_glob_args
+def sync(paths, prefixes, smallest_first, stream):
+  def on_synced(path):
+    sys.stdout.write(path)
+    sys.stdout.write(b'\0')
+    sys.stdout.flush()
+
+  with exception_handling():
+    gb = gitshed_instance()
+    kwargs = dict(prefixes=prefixes, smallest_first=smallest_first, on_synced=on_synced if stream else None)
+    if paths is None:
+      gb.sync_all(**kwargs)
+    elif paths:
+      gb.sync(paths, **kwargs)
+
+
+@click.command()
+@path_glob_args
+def resync(paths):
+  with exception_handling():
+    gb = gitshed_instance()
+    if paths is None:
+      gb.resync_all()
+    elif paths:
+      gb.resync(paths)
+
+
+@click.command()
+@click.option('--repair/--no-repair', default=False,
+              help='Refetch files that fail verification from the content store.')
+def fsck(repair):
+  with exception_handling():
+    gitshed_instance().fsck(repair=repair)
+
+
+@click.command()
+@click.option('--max-size', default=None,
+              help='Evict least recently used content until the shed is this size (e.g., 20G). '
+                   'By default all unreferenced content is evicted.')
+@click.option('--ref', 'refs', multiple=True,
+              help='Also keep content referenced by this ref. May be repeated.')
+def gc(max_size, refs):
+  with exception_handling():
+    gitshed_instance().gc(max_size=parse_size(max_size) if max_size else None, refs=refs or None,
+                          out=sys.stdout)
+
+
+@click.group()
+def hook():
+  """Run or install the git hooks that check that committed content is in the content store."""
+  pass
+
+
+@click.command('pre-commit')
+def pre_commit():
+  with exception_handling():
+    if gitshed_instance().check_staged():
+      raise GitShedError('Refusing to commit managed files whose content is not in the content store.')
+
+
+@click.command('pre-push')
+@click.argument('remote')
+@click.argument('url', required=False)
+def pre_push(remote, url):
+  with exception_handling():
+    # Git passes the refs being pushed on stdin, one per line.
+    ref_updates = [line.split() for line in sys.stdin if line.strip()]
+    if gitshed_instance().check_pushed(ref_updates, remote):
+      raise GitShedError('Refusing to push managed files whose content is not in the content store.')
+
+
+@click.command()
+def install():
+  with exception_handling():
+    gitshed_instance().install_hooks()
+
+
+hook.add_command(pre_commit)
+hook.add_command(pre_push)
+hook.add_command(install)
+
+
+@click.group()
+def manifest():
+  """Maintain the content store's key manifest."""
+  pass
+
+
+@click.command()
+def rebuild():
+  with exception_handling():
+    gitshed_instance().rebuild_manifest()
+
+
+manifest.add_command(rebuild)
+
+
+@click.group()
+def bundle():
+  """Pack managed content into a single file, e.g., to seed the shed on CI workers."""
+  pass
+
+
+@click.command('create')
+@click.argument('rev')
+@click.option('-o', '--output', required=True, help='Write the bundle to this file.')
+@click.option('--prefix', 'prefixes', multiple=True,
+              help='Only bundle the content of files under this path. May be repeated.')
+def create_bundle(rev, output, prefixes):
+  """Bundle the content of the managed files at REV (or added or modified in a range A..B)."""
+  with exception_handling():
+    gitshed_instance().create_bundle(rev, output, prefixes=prefixes)
+
+
+@click.command('apply')
+@click.argument('bundle_file')
+def apply_bundle(bundle_file):
+  """Unpack the content in BUNDLE_FILE into the shed."""
+  with exception_handling():
+    gitshed_instance().apply_bundle(bundle_file)
+
+
+bundle.add_command(create_bundle)
+bundle.add_command(apply_bundle)
+
+
+@click.command()
+@click.argument('root')
+def serve(root):
+  """Serve the content store at ROOT over stdin/stdout (run on the content store host)."""
+  with exception_handling():
+    from gitshed.server import ContentStoreServer
+    ContentStoreServer(root, sys.stdin, sys.stdout).serve()
+
+
+@click.command()
+@click.option('--command', default=None, help='Only summarize invocations of this subcommand.')
+def stats(command):
+  """Summarize the metrics recorded by past invocations."""
+  with exception_handling():
+    gitshed_instance().stats(command=command)
+
+
+@click.command()
+def setup():
+  with exception_handling():
+    gitshed_instance().verify_setup()
+
+
+gitshed.add_command(status)
+gitshed.add_command(synced)
+gitshed.add_command(unsynced)
+gitshed.add_command(manage)
+gitshed.add_command(unmanage)
+gitshed.add_command(upload)
+gitshed.add_command(sync)
+gitshed.add_command(resync)
+gitshed.add_command(fsck)
+gitshed.add_command(gc)
+gitshed.add_command(hook)
+gitshed.add_command(manifest)
+gitshed.add_command(bundle)
+gitshed.add_command(serve)
+gitshed.add_command(stats)
+gitshed.add_command(setup)
@@ -0,0 +1,170 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+from gitshed.util import safe_makedirs
+
+
+class AdaptiveConcurrency(object):
+  """Limits the number of concurrent operations, adapting the limit to observed performance.
+
+  Uses additive increase/multiplicative decrease, like TCP congestion control. Operations are
+  measured in rounds of `limit` operations. After each round, the limit is increased by one if
+  throughput improved, and decreased by one if it got worse. Any error halves the limit. Since
+  throughput is measured across concurrent operations, rising latency shows up as falling throughput.
+
+  Also tracks the limit at which the best throughput was observed, so that it can be remembered
+  for next time.
+
+  A controller whose minimum and maximum are equal is just a fixed limit.
+
+  Safe to use from multiple threads.
+  """
+
+  # Throughput must change by at least this fraction to count as a change, rather than as noise.
+  _TOLERANCE = 0.05
+
+  def __init__(self, initial, maximum=None, minimum=1, clock=time.time):
+    """
+    :param initial: The initial limit.
+    :param maximum: Never allow more than this many concurrent operations. Defaults to initial.
+    :param minimum: Never limit to fewer than this many concurrent operations.
+    :param clock: A no-arg function returning the current time in seconds.
+    """
+    self._maximum = max(maximum or initial, 1)
+    self._minimum = min(max(minimum, 1), self._maximum)
+    self._limit = min(max(initial, self._minimum), self._maximum)
+    self._clock = clock
+    self._in_flight = 0
+    self._cond = threading.Condition()
+    self._last_throughput = None
+    self._best_throughput = None
+    self._best_limit = self._limit
+    self._start_round()
+
+  @property
+  def limit(self):
+    return self._limit
+
+  @property
+  def maximum(self):
+    return self._maximum
+
+  @property
+  def best_limit(self):
+    """The limit at which the best throughput has been observed so far."""
+    return self._best_limit
+
+  @contextmanager
+  def slot(self, num_units=1):
+    """A context within which an operation runs, once fewer than `limit` others are running.
+
+    If the context exits with an exception, that counts as an error.
+
+    :param num_units: The amount of work the operation does (e.g., number of files), for measuring
+                      throughput.
+    """
+    with self._cond:
+      while self._in_flight >= self._limit:
+        self._cond.wait()
+      self._in_flight += 1
+      if self._round_start is None:
+        self._round_start = self._clock()
+    try:
+      yield
+    except Exception:
+      self._finish(None)
+      raise
+    self._finish(num_units)
+
+  def record_error(self):
+    """Records an error in an operation that's still running (e.g., one that will be retried)."""
+    with self._cond:
+      self._decrease()
+
+  def _finish(self, num_units):
+    with self._cond:
+      self._in_flight -= 1
+      try:
+        if num_units is None:
+          self._decrease()
+        else:
+          self._round_units += num_units
+          self._round_ops += 1
+          if self._round_ops >= self._limit:
+            self._end_round()
+      finally:
+        # Waiting operations must never be stranded.
+        self._cond.notify_all()
+
+  def _decrease(self):
+    self._limit = max(self._minimum, self._limit // 2)
+    self._last_throughput = None
+    self._start_round()
+
+  def _end_round(self):
+    elapsed = max(self._clock() - self._round_start, 1e-6)
+    throughput = self._round_units / elapsed
+    if self._best_throughput is None or throughput > self._best_throughput:
+      self._best_throughput = throughput
+      self._best_limit = self._limit
+    if self._last_throughput is None or throughput > self._last_throughput * (1 + self._TOLERANCE):
+      self._limit = min(self._maximum, self._limit + 1)
+    elif throughput < self._last_throughput * (1 - self._TOLERANCE):
+      self._limit = max(self._minimum, self._limit - 1)
+    self._last_throughput = throughput
+    self._start_round()
+
+  def _start_round(self):
+    # Operations still in flight will count toward the new round, so it starts now. If there are
+    # none, it starts when the next operation does, so that idle time doesn't count against it.
+    self._round_start = self._clock() if self._in_flight else None
+    self._round_units = 0
+    self._round_ops = 0
+
+
+class ConcurrencyMemory(object):
+  """Remembers the best concurrency limits for each content store, across invocations."""
+
+  def __init__(self, path):
+    """
+    :param path: The file to persist the limits to.
+    """
+    self._path = path
+
+  def _load(self):
+    try:
+      with open(self._path, 'r') as infile:
+        return json.load(infile)
+    except (IOError, ValueError):
+      # Missing or corrupt memory just means we start from the configured limits.
+      return {}
+
+  def recall(self, store_id, kind):
+    """Returns the remembered limit for a kind of operation on a content store, or None.
+
+    :param store_id: A string identifying the content store.
+    :param kind: The kind of operation, e.g., 'get' or 'put'.
+    """
+    return self._load().get(store_id, {}).get(kind)
+
+  def remember(self, store_id, kind_to_limit):
+    """Remembers limits for a content store.
+
+    :param store_id: A string identifying the content store.
+    :param kind_to_limit: A map of kind of operation -> limit.
+    """
+    entries = self._load()
+    entries.setdefault(store_id, {}).update(kind_to_limit)
+    safe_makedirs(os.path.dirname(self._path))
+    tmp_path = '{0}.tmp'.format(self._path)
+    with open(tmp_path, 'w') as outfile:
+      json.dump(entries, outfile)
+    os.rename(tmp_path, self._path)
@@ -3,17 +3,20 @@
 from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
                         print_function, unicode_literals)
 
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+import errno
 import hashlib
-from multiprocessing.pool import ThreadPool
 import os
 import re
 import shutil
-import uuid
+import time
 
+from gitshed.concurrency import AdaptiveConcurrency
 from gitshed.error import GitShedError
+from gitshed.metrics import metric_name, metrics
 from gitshed.progress import Progress
-from gitshed.util import make_mode_read_only, make_read_only, safe_makedirs, temporary_dir
+from gitshed.util import (IO_BUFFER_SIZE, copy_file, make_mode_read_only, make_read_only, safe_makedirs,
+                          temporary_dir)
 
 
 class ContentStore(object):
@@ -32,8 +35,59 @@ class ContentStore(object):
 
   @staticmethod
   def _random_string():
+    import uuid
     return uuid.uuid4().hex
 
+  # The hash algorithms that keys can be based on. Keys based on sha1 (the original key format) are
+  # unprefixed. Keys based on other algorithms are prefixed with the algorithm's name and a dash.
+  HASH_ALGORITHMS = ['sha1', 'blake2b']
+
+  @classmethod
+  def is_supported_hash_algorithm(cls, algorithm):
+    """Checks whether keys based on a hash algorithm can be computed on this system."""
+    if algorithm == 'blake2b':
+      return cls._blake2b_constructor() is not None
+    return algorithm in cls.HASH_ALGORITHMS
+
+  @staticmethod
+  def _blake2b_constructor():
+    # BLAKE2b is in hashlib from Python 3.6, and available as the pyblake2 backport before that.
+    if hasattr(hashlib, 'blake2b'):
+      return hashlib.blake2b
+    try:
+      import pyblake2
+      return pyblake2.blake2b
+    except ImportError:
+      return None
+
+  @classmethod
+  def fingerprint(cls, path, algorithm='sha1'):
+    """Computes a file's content fingerprint, as used in its key.
+
+    :param path: The file to fingerprint.
+    :param algorithm: The hash algorithm to use. One of HASH_ALGORITHMS.
+    """
+    if algorithm == 'sha1':
+      return cls.sha(path)
+    if not cls.is_supported_hash_algorithm(algorithm):
+      raise GitShedError('Unsupported hash algorithm: {0}'.format(algorithm))
+    # BLAKE2b is much faster than sha1, and a 256-bit digest is plenty.
+    hasher = cls._blake2b_constructor()(digest_size=32)
+    with open(path, 'rb') as infile:
+      data = infile.read(IO_BUFFER_SIZE)
+      while data:
+        hasher.update(data)
+        data = infile.read(IO_BUFFER_SIZE)
+    return '{0}-{1}'.format(algorithm, hasher.hexdigest())
+
+  @classmethod
+  def fingerprint_for_key(cls, path, key):
+    """Computes a file's content fingerprint using the same hash algorithm as a key.
+
+    The result can be compared to sha_from_key(key) to verify the file's content.
+    """
+    return cls.fingerprint(path, cls.algorithm_from_key(key))
+
   @classmethod
   def sha(cls, path):
     """Computes a file's git sha.
@@ -50,11 +104,11 @@ class ContentStore(object):
     hasher.update('blob ')
     hasher.update(str(size))
     hasher.update('\0')
-    with open(path, 'r') as infile:
-      data = infile.read(4096)
+    with open(path, 'rb') as infile:
+      data = infile.read(IO_BUFFER_SIZE)
       while data:
         hasher.update(data)
-        data = infile.read(4096)
+        data = infile.read(IO_BUFFER_SIZE)
     return hasher.hexdigest()
 
   @classmethod
@@ -73,32 +127,55 @@ class ContentStore(object):
     return ('0000' + oct(mode))[-5:]
 
   @classmethod
-  def key(cls, path):
+  def key(cls, path, algorithm='sha1'):
     """Computes a file's key.
 
     The key is a combination of the file's content fingerprint and its access permissions.
     This allows us to handle two different files with different permissions but the same sha.
+
+    :param path: The file to compute a key for.
+    :param algorithm: The hash algorithm to fingerprint the content with. One of HASH_ALGORITHMS.
     """
-    sha = cls.sha(path)
+    sha = cls.fingerprint(path, algorithm)
     mode = cls.mode(path)
     return '{0}_{1}'.format(sha, mode)
 
   @classmethod
   def sha_from_key(cls, key):
-    """Returns the sha part of a key."""
-    return key[0:40]
+    """Returns the content fingerprint part of a key (including its algorithm prefix, if any)."""
+    return key.rpartition('_')[0]
 
   @classmethod
   def mode_from_key(cls, key):
     """Returns the access permissions part of a key, as an octal string."""
-    return key[41:]
+    return key.rpartition('_')[2]
+
+  @classmethod
+  def algorithm_from_key(cls, key):
+    """Returns the name of the hash algorithm that a key's fingerprint was computed with."""
+    return cls.algorithm_from_sha(cls.sha_from_key(key))
+
+  @classmethod
+  def algorithm_from_sha(cls, sha):
+    """Returns the name of the hash algorithm that a content fingerprint was computed with."""
+    algorithm, sep, _ = sha.partition('-')
+    return algorithm if sep else 'sha1'
 
-  _KEY_RE = re.compile(r'^[0-9a-f]{40}_0[0-7]{4}$')  # Matches exactly (40 hex digits)_0(4 octal digits).
+  # Matches exactly (40 hex digits)_0(4 octal digits) or blake2b-(64 hex digits)_0(4 octal digits).
+  _KEY_RE = re.compile(r'^(?:[0-9a-f]{40}|blake2b-[0-9a-f]{64})_0[0-7]{4}$')
+
+  # Matches exactly (40 hex digits) or blake2b-(64 hex digits).
+  _SHA_RE = re.compile(r'^(?:[0-9a-f]{40}|blake2b-[0-9a-f]{64})$')
 
   @classmethod
   def is_valid_key(cls, key):
     return cls._KEY_RE.match(key)
 
+  @classmethod
+  def is_valid_sha(cls, sha):
+    """Checks whether a string is a content fingerprint, as found in a key."""
+    return cls._SHA_RE.match(sha)
+
   def __init__(self, chunk_size=20, get_concurrency=None, put_concurrency=None):
     """
     :param chunk_size: Get/put in chunks of this size.
@@ -106,8 +183,100 @@ class ContentStore(object):
     :param put_concurrency: Size of threadpool for puts.
     """
     self._chunk_size = chunk_size
-    self._get_concurrency = get_concurrency or 12
-    self._put_concurrency = put_concurrency or 4
+    self._get_concurrency = AdaptiveConcurrency(get_concurrency or 12)
+    self._put_concurrency = AdaptiveConcurrency(put_concurrency or 4)
+    self._manifest = None
+    self._staging_area = None
+    self._dedupe = False
+    self._transfer_retries = 0
+
+  def use_adaptive_concurrency(self, get_concurrency, put_concurrency):
+    """Limits the number of concurrent chunks with AdaptiveConcurrency controllers.
+
+    :param get_concurrency: The AdaptiveConcurrency controller to use for gets.
+    :param put_concurrency: The AdaptiveConcurrency controller to use for puts.
+    """
+    self._get_concurrency = get_concurrency
+    self._put_concurrency = put_concurrency
+
+  def use_transfer_retries(self, retries):
+    """Retries failed transfers, e.g., for content stores whose connections sometimes drop.
+
+    Any failure is retried, including failures that will recur (e.g., content not found), so
+    retries are only worth enabling for content stores whose failures are often transient.
+
+    :param retries: Retry each failed chunk this many times, with exponential backoff.
+    """
+    self._transfer_retries = retries
+
+  @property
+  def manifest(self):
+    return self._manifest
+
+  def use_manifest(self, manifest):
+    """Consults, and maintains, a KeyManifest of this content store's keys.
+
+    Existence checks for keys in the manifest are then answered locally, and puts skip content
+    that the manifest says is already present.
+
+    :param manifest: The KeyManifest to use.
+    """
+    self._manifest = manifest
+
+  def use_staging_area(self, staging_area):
+    """Stages content in a StagingArea, instead of in temporary dirs under the system temp dir.
+
+    :param staging_area: The StagingArea to use. It should be on the same filesystem as the files
+                         that content is got into and put from.
+    """
+    self._staging_area = staging_area
+
+  def use_dedupe(self):
+    """Stores content under its sha alone, rather than under its key.
+
+    Identical content with different modes is then stored, and transferred, only once. The mode in
+    each key is applied locally when its content is got. Content already stored under its key is
+    still found, so dedupe can be turned on for an existing content store.
+    """
+    self._dedupe = True
+
+  def _staging_dir(self):
+    """A context yielding an empty directory to stage content in."""
+    return self._staging_area.slot() if self._staging_area else temporary_dir()
+
+  def _known_present(self, key):
+    if self._manifest is None:
+      return False
+    present = any(self._manifest.contains(os.path.basename(cs_path))
+                  for cs_path in self._content_store_paths_for_key(key))
+    metrics.increment(metric_name('manifest_lookups', result='hit' if present else 'miss'))
+    return present
+
+  @property
+  def chunk_size(self):
+    return self._chunk_size
+
+  @property
+  def get_concurrency(self):
+    """The AdaptiveConcurrency controller for gets."""
+    return self._get_concurrency
+
+  @property
+  def put_concurrency(self):
+    """The AdaptiveConcurrency controller for puts."""
+    return self._put_concurrency
+
+  def note_paths(self, paths_and_keys):
+    """Tells this content store which paths the content under some keys belongs to.
+
+    Content stores that place content according to its path (e.g., RoutedContentStore) use this to
+    find content without looking for it in every place it might be. Puts note the paths of the
+    content they put, but callers that get, or check for, content should note its paths first.
+    By default, does nothing.
+
+    :param paths_and_keys: Iterable of (path relative to the repo root, key of that path's content) pairs.
+    """
+    pass
 
   def content_store_path_from_key(self, key):
     """Returns the logical path at which to store the file with the given key.
@@ -126,12 +295,37 @@ class ContentStore(object):
     # multiple dirs if you expect a large number of files.)
     return 'content_store/{0}'.format(key)
 
-  def get(self, key_to_target_paths):
+  def content_store_path_from_sha(self, sha):
+    """Returns the logical path at which to store content with the given sha, when deduping.
+
+    Shas never contain the underscore that separates a key's sha from its mode, so these paths
+    never clash with the paths of keys.
+
+    NOTE: Do *not* change the output of this method, for the same reason as above.
+
+    :param sha: Return the logical path for this sha.
+    """
+    return 'content_store/{0}'.format(sha)
+
+  def _content_store_paths_for_key(self, key):
+    """Returns the logical paths that the content with the given key may be at, in order of preference."""
+    if not self._dedupe:
+      return [self.content_store_path_from_key(key)]
+    return [self.content_store_path_from_sha(self.sha_from_key(key)), self.content_store_path_from_key(key)]
+
+  def get(self, key_to_target_paths, on_complete=None):
     """Gets file content from this content_store.
 
-    In the case of multiple files with the same content, will only fetch the content once.
+    In the case of multiple files with the same content, will only fetch the content once. When
+    deduping, that includes content under different keys with the same sha.
+
+    Content is fetched in chunks, which are started in the iteration order of key_to_target_paths
+    (so callers can prioritize by passing an OrderedDict). Each file is in place as soon as its
+    chunk completes, without waiting for the rest.
 
     :param key_to_target_paths: Map of key -> [list of target_paths for the content at that key]
+    :param on_complete: If specified, called with each target path as soon as its content is in
+                        place. Always called on the calling thread.
     """
     def num_files_including_duplicates(k2t):
       return sum(len(t) for t in k2t.values())
@@ -139,17 +333,36 @@ class ContentStore(object):
     if not key_to_target_paths:
       return
 
+    from multiprocessing.pool import ThreadPool
+
     progress = Progress(num_files_including_duplicates(key_to_target_paths))
     progress.update_bar()
 
-    pool = ThreadPool(self._get_concurrency)
+    pool = ThreadPool(self._get_concurrency.maximum)
     def do_get(chunk):
-      self._get_chunk(chunk)
+      with self._get_concurrency.slot(len(chunk)):
+        self._get_chunk(chunk)
       progress.increment(num_files_including_duplicates(chunk))
-    items = list(key_to_target_paths.items())
-    chunks = [dict(items[i:i+self._chunk_size]) for i in range(0, len(items), self._chunk_size)]
-    pool.map(do_get, chunks)
-    print('')
+      return chunk
+    # Keys with the same content share a chunk, so that the content is only fetched once.
+    groups = OrderedDict()
+    for key, target_paths in key_to_target_paths.items():
+      groups.setdefault(self.sha_from_key(key) if self._dedupe else key, []).append((key, target_paths))
+    groups = list(groups.values())
+    chunks = [OrderedDict(item for group in groups[i:i+self._chunk_size] for item in group)
+              for i in range(0, len(groups), self._chunk_size)]
+    # Unlike map(), imap_unordered() hands out one chunk at a time, in order, and yields each chunk
+    # as soon as it's done.
+    try:
+      for chunk in pool.imap_unordered(do_get, chunks):
+        if on_complete:
+          for target_paths in chunk.values():
+            for target_path in target_paths:
+              on_complete(target_path)
+    finally:
+      pool.close()
+      pool.join()
+    progress.finish()
 
   def _get_chunk(self, key_to_target_paths):
     """Gets the content of some files from this content store.
@@ -157,37 +370,83 @@ class ContentStore(object):
     :param key_to_target_paths: Map of key -> [list of target_paths], where those args are as
            described in get() below.
     """
-    with temporary_dir() as target_tmpdir:
-      content_store_paths = []
-      for key in key_to_target_paths:
-        content_store_paths.append(self.content_store_path_from_key(key))
-
-      self.raw_get(content_store_paths, target_tmpdir)
-
+    with self._staging_dir() as target_tmpdir:
+      key_to_cs_path = OrderedDict()  # The content store path that each key's content is fetched from.
+
+      def fetch():
+        for key in key_to_target_paths:
+          key_to_cs_path[key] = self._content_store_paths_for_key(key)[0]
+        content_store_paths = list(OrderedDict.fromkeys(key_to_cs_path.values()))
+        if not self._dedupe:
+          self.raw_get(content_store_paths, target_tmpdir)
+          return
+        missing = set(self.raw_get_partial(content_store_paths, target_tmpdir))
+        if missing:
+          # Fall back to content stored under its key.
+          fallback_paths = []
+          for key, cs_path in key_to_cs_path.items():
+            if cs_path in missing:
+              key_to_cs_path[key] = self.content_store_path_from_key(key)
+              fallback_paths.append(key_to_cs_path[key])
+          self.raw_get(fallback_paths, target_tmpdir)
+
+      def clear_target_tmpdir():
+        for name in os.listdir(target_tmpdir):
+          os.unlink(os.path.join(target_tmpdir, name))
+      self._transfer_with_retries('get', fetch, clear_target_tmpdir)
+
+      # Map of staged file -> number of keys yet to use it.
+      num_uses = defaultdict(lambda: 0)
+      for cs_path in key_to_cs_path.values():
+        num_uses[os.path.join(target_tmpdir, os.path.basename(cs_path))] += 1
+      verified = set()
       for key, target_paths in key_to_target_paths.items():
-        target_path_tmp = os.path.join(target_tmpdir, os.path.basename(self.content_store_path_from_key(key)))
-        actual_sha = ContentStore.sha(target_path_tmp)
-        key_sha = self.sha_from_key(key)
-        if key_sha != actual_sha:
-          raise GitShedError('Content sha mismatch for {0}! Expected {1} but got {2}.'.format(
-            target_path_tmp, key, actual_sha))
-        actual_mode = ContentStore.mode(target_path_tmp)
-        key_mode = self.mode_from_key(key)
-
-        if key_mode != actual_mode:
-          raise GitShedError('File permission mismatch for {0}! Expected {1} but got {2}.'.format(
-            target_path_tmp, key_mode, actual_mode))
+        target_path_tmp = os.path.join(target_tmpdir, os.path.basename(key_to_cs_path[key]))
+        if self._dedupe:
+          # Content stored under its sha may have been put with any mode.
+          os.chmod(target_path_tmp, int(self.mode_from_key(key), 8))
+        if target_path_tmp not in verified:
+          self.verify_content(target_path_tmp, key)
+          verified.add(target_path_tmp)
+          metrics.increment(metric_name('bytes', op='get'), os.path.getsize(target_path_tmp))
+        metrics.increment(metric_name('keys', op='get'))
+        num_uses[target_path_tmp] -= 1
 
         for target_path in target_paths:
           safe_makedirs(os.path.dirname(target_path))
-        for target_path in target_paths[:-1]:
-          shutil.copy(target_path_tmp, target_path)
-        shutil.move(target_path_tmp, target_paths[-1])
+        if num_uses[target_path_tmp]:
+          for target_path in target_paths:
+            copy_file(target_path_tmp, target_path)
+        else:
+          for target_path in target_paths[:-1]:
+            copy_file(target_path_tmp, target_path)
+          # A rename, if the content was staged on the target's filesystem.
+          shutil.move(target_path_tmp, target_paths[-1])
 
-  def put(self, src_paths):
+  @classmethod
+  def verify_content(cls, path, key):
+    """Verifies that a file's content and permissions match a key.
+
+    :param path: The file to verify.
+    :param key: The key that the file's content should have.
+    :raises GitShedError: If the file doesn't match the key.
+    """
+    actual_sha = cls.fingerprint_for_key(path, key)
+    key_sha = cls.sha_from_key(key)
+    if key_sha != actual_sha:
+      raise GitShedError('Content sha mismatch for {0}! Expected {1} but got {2}.'.format(
+        path, key, actual_sha))
+    actual_mode = cls.mode(path)
+    key_mode = cls.mode_from_key(key)
+    if key_mode != actual_mode:
+      raise GitShedError('File permission mismatch for {0}! Expected {1} but got {2}.'.format(
+        path, key_mode, actual_mode))
+
+  def put(self, src_paths, algorithm='sha1'):
     """Puts the content of multiple files into this content_store.
 
     :param src_paths: Iterable source paths to put into this content store.
+    :param algorithm: The hash algorithm to compute the keys with. One of HASH_ALGORITHMS.
     :returns An iterable of keys, one for each source path.
     """
     if not src_paths:
@@ -207,53 +466,183 @@ class ContentStore(object):
     # put operation, so we can show users a progress bar with the numbers they expect.
     cardinality = defaultdict(lambda: 0)  # Map of content store path -> number of user files.
 
+    num_already_present = 0
     for src_path in src_paths:
-      key = ContentStore.key(src_path)
+      key = ContentStore.key(src_path, algorithm)
       ret.append(key)
-      cs_path = self.content_store_path_from_key(key)
+      if self._known_present(key):
+        num_already_present += 1
+        continue
+      cs_path = self._content_store_path_for_put(key)
       if cs_path not in cardinality:
         cs_dir, _, cs_basename = cs_path.rpartition('/')
         cs_dir_to_work[cs_dir].append((src_path, cs_basename))
       cardinality[cs_path] += 1
 
+    self.note_paths(zip(src_paths, ret))
+
     n = len(src_paths)  # Total number of files to put.
     progress = Progress(n)
+    progress.increment(num_already_present)
     progress.update_bar()
 
-    pool = ThreadPool(self._put_concurrency)
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(self._put_concurrency.maximum)
     def do_put(chunk):
       cs_dir, work = chunk
       n = sum(cardinality['{0}/{1}'.format(cs_dir, cs_basename)] for (_, cs_basename) in work)
-      self._put_chunk(cs_dir, work)
+      with self._put_concurrency.slot(len(work)):
+        self._put_chunk(cs_dir, work)
       progress.increment(n)
 
     chunks = []
     for cs_dir, work in cs_dir_to_work.items():
       chunks.extend((cs_dir, work[i:i+self._chunk_size]) for i in range(0, len(work), self._chunk_size))
 
-    pool.map(do_put, chunks)
-    print('')
+    try:
+      pool.map(do_put, chunks)
+    finally:
+      pool.close()
+      pool.join()
+    # Record everything in one manifest segment, rather than one per chunk.
+    self._record_in_manifest([w for work in cs_dir_to_work.values() for w in work])
+    progress.finish()
     return ret
 
+  def put_keyed(self, src_paths_and_keys, paths=None):
+    """Puts the content of files whose keys have already been computed.
+
+    Unlike put(), does all its work on the calling thread and shows no progress, so it's suitable
+    for callers that manage their own concurrency. Callers should use up to put_concurrency.maximum
+    threads: this method waits for a slot from the put_concurrency controller.
+
+    :param src_paths_and_keys: Iterable of (source path, key of that path's content) pairs.
+    :param paths: If the content isn't put from the paths it belongs to (e.g., it's put from the
+                  shed), a list of the paths it belongs to, relative to the repo root, corresponding
+                  to src_paths_and_keys. These paths are noted, instead of the source paths.
+    """
+    src_paths_and_keys = list(src_paths_and_keys)
+    if paths is None:
+      self.note_paths(src_paths_and_keys)
+    else:
+      self.note_paths(zip(paths, [key for _, key in src_paths_and_keys]))
+    cs_dir_to_work = defaultdict(list)
+    cs_paths = set()
+    for src_path, key in src_paths_and_keys:
+      if self._known_present(key):
+        continue
+      cs_path = self._content_store_path_for_put(key)
+      if cs_path not in cs_paths:
+        cs_paths.add(cs_path)
+        cs_dir, _, cs_basename = cs_path.rpartition('/')
+        cs_dir_to_work[cs_dir].append((src_path, cs_basename))
+    for cs_dir, work in cs_dir_to_work.items():
+      with self._put_concurrency.slot(len(work)):
+        self._put_chunk(cs_dir, work)
+    self._record_in_manifest([w for work in cs_dir_to_work.values() for w in work])
+
+  def _content_store_path_for_put(self, key):
+    return self._content_store_paths_for_key(key)[0]
+
   def _put_chunk(self, cs_dir, work):
-    with temporary_dir() as tmpdir:
+    with self._staging_dir() as tmpdir:
       tmp_src_paths = []
       for src_path, cs_basename in work:
         tmp_src_path = os.path.join(tmpdir, cs_basename)
-        os.link(src_path, tmp_src_path)
+        try:
+          os.link(src_path, tmp_src_path)
+        except OSError as e:
+          # Hard links can't cross filesystems, and some filesystems don't support them.
+          if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+          copy_file(src_path, tmp_src_path)
         # Files in gitshed must be read-only.
         make_read_only(tmp_src_path)
         tmp_src_paths.append(tmp_src_path)
-      self.raw_put(tmp_src_paths, cs_dir)
+      self._transfer_with_retries('put', lambda: self.raw_put(tmp_src_paths, cs_dir))
+    metrics.increment(metric_name('keys', op='put'), len(work))
+    metrics.increment(metric_name('bytes', op='put'), sum(os.path.getsize(src_path) for src_path, _ in work))
+
+  # Wait this long before the first retry, doubling the wait before each subsequent retry.
+  _RETRY_DELAY_SECONDS = 0.1
+
+  def _transfer_with_retries(self, op, transfer, before_retry=None):
+    """Calls a function that transfers content, retrying it on failure if retries are enabled.
+
+    Failures are reported to the op's AdaptiveConcurrency controller, and each attempt is recorded
+    in the metrics.
+
+    :param op: The kind of transfer: 'get' or 'put'.
+    :param transfer: A no-arg function that does the transfer.
+    :param before_retry: If specified, a no-arg function to call before each retry.
+    """
+    concurrency = self._get_concurrency if op == 'get' else self._put_concurrency
+    backend = type(self).__name__
+    attempt = 0
+    while True:
+      try:
+        with metrics.timer(metric_name('chunk_seconds', backend=backend, op=op)):
+          return transfer()
+      except (GitShedError, IOError, OSError):
+        metrics.increment(metric_name('chunk_failures', backend=backend, op=op))
+        if attempt == self._transfer_retries:
+          raise
+        concurrency.record_error()
+        if before_retry:
+          before_retry()
+        time.sleep(self._RETRY_DELAY_SECONDS * 2 ** attempt)
+        attempt += 1
+
+  def _record_in_manifest(self, work):
+    if self._manifest is not None:
+      self._manifest.record(cs_basename for _, cs_basename in work)
 
   def has(self, key):
     """Checks for the existence of content in this content store.
 
-    Used only for testing/setup verification.
-
     :param key: Check for content under this key.
     """
-    return self.raw_has(self.content_store_path_from_key(key))
+    if self._known_present(key):
+      return True
+    if self._manifest is not None and self._manifest.is_complete:
+      return False
+    return any(self.raw_has(cs_path) for cs_path in self._content_store_paths_for_key(key))
+
+  def missing(self, keys):
+    """Finds which content is absent from this content store, with a single batched query.
+
+    :param keys: Check for content under these keys.
+    :returns: The set of keys whose content is not in this content store.
+    """
+    key_to_cs_paths = dict((key, self._content_store_paths_for_key(key)) for key in keys
+                           if not self._known_present(key))
+    if not key_to_cs_paths:
+      return set()
+    if self._manifest is not None and self._manifest.is_complete:
+      return set(key_to_cs_paths.keys())
+    present = self.raw_has_many(set(cs_path for cs_paths in key_to_cs_paths.values() for cs_path in cs_paths))
+    return set(key for key, cs_paths in key_to_cs_paths.items()
+               if not any(cs_path in present for cs_path in cs_paths))
+
+  def sizes(self, keys):
+    """Returns the sizes of content in this content store, where they can be found cheaply.
+
+    :param keys: Get the sizes of the content under these keys.
+    :returns: A map of key -> size in bytes. Keys whose sizes are unknown are omitted.
+    """
+    key_to_cs_paths = dict((key, self._content_store_paths_for_key(key)) for key in keys)
+    if not key_to_cs_paths:
+      return {}
+    cs_path_to_size = self.raw_sizes(set(cs_path for cs_paths in key_to_cs_paths.values()
+                                         for cs_path in cs_paths))
+    ret = {}
+    for key, cs_paths in key_to_cs_paths.items():
+      for cs_path in cs_paths:
+        if cs_path in cs_path_to_size:
+          ret[key] = cs_path_to_size[cs_path]
+          break
+    return ret
 
   def verify_setup(self):
     """Check that this content store works from this client.
@@ -300,6 +689,23 @@ class ContentStore(object):
     """
     raise NotImplementedError()
 
+  def raw_get_partial(self, content_store_paths, target_dir_tmp):
+    """Gets the content of whichever of the specified files this content store has.
+
+    Like raw_get(), but content that can't be fetched is reported instead of failing the call.
+    Subclasses may override to implement this more precisely, or more efficiently.
+
+    :param content_store_paths: Get the contents at these content store paths.
+    :param target_dir_tmp: Write the content to this temporary directory, as for raw_get().
+    :returns: The subset of content_store_paths that could not be fetched.
+    """
+    try:
+      self.raw_get(content_store_paths, target_dir_tmp)
+      return []
+    except (GitShedError, IOError, OSError):
+      return [p for p in content_store_paths
+              if not os.path.isfile(os.path.join(target_dir_tmp, os.path.basename(p)))]
+
   def raw_put(self, src_paths, content_store_dir):
     """Puts the contents of files into the content store.
 
@@ -319,3 +725,34 @@ class ContentStore(object):
     :param content_store_path: Check for content at this content store path.
     """
     raise NotImplementedError()
+
+  def raw_has_many(self, content_store_paths):
+    """Checks for the existence of content at multiple logical paths in this content store.
+
+    Subclasses should override if they can check for multiple paths more efficiently than by
+    checking for each one individually.
+
+    :param content_store_paths: Check for content at these content store paths.
+    :returns: The subset of content_store_paths at which content exists.
+    """
+    return set(p for p in content_store_paths if self.raw_has(p))
+
+  def raw_sizes(self, content_store_paths):
+    """Gets the sizes of content at multiple logical paths in this content store.
+
+    Subclasses should override if they can get sizes cheaply. By default, no sizes are known.
+
+    :param content_store_paths: Get the sizes of the content at these content store paths.
+    :returns: A map of content store path -> size in bytes, for whichever paths have known sizes.
+    """
+    return {}
+
+  def raw_list(self, content_store_dir):
+    """Lists the names of the content in a logical directory in this content store.
+
+    Subclasses must implement in order to support a KeyManifest.
+
+    :param content_store_dir: List the content in this content store directory.
+    :returns: A list of basenames. Empty if the directory doesn't exist.
+    """
+    raise NotImplementedError()
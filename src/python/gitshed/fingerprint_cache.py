@@ -0,0 +1,94 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+import json
+import os
+import threading
+
+from gitshed.util import safe_makedirs
+
+
+class FingerprintCache(object):
+  """A persistent cache of file content fingerprints.
+
+  Re-hashing every file in the shed is expensive, so we remember each file's sha along with the
+  stat data it was computed from. A cached sha is only trusted while that stat data is unchanged.
+
+  Safe to use from multiple threads.
+  """
+
+  def __init__(self, path):
+    """
+    :param path: The file to persist the cache to.
+    """
+    self._path = path
+    self._entries = None
+    self._dirty = False
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def _stat_signature(path):
+    # The ctime changes on any write or chmod, so it catches changes that preserve the mtime.
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime, st.st_ctime, st.st_ino]
+
+  def _load(self):
+    if self._entries is None:
+      try:
+        with open(self._path, 'r') as infile:
+          self._entries = json.load(infile)
+      except (IOError, ValueError):
+        # A missing or corrupt cache is just an empty one.
+        self._entries = {}
+
+  def get(self, path):
+    """Returns the cached sha for a file, or None if the file has changed since it was cached.
+
+    :param path: The file to look up.
+    """
+    signature = self._stat_signature(path)
+    with self._lock:
+      self._load()
+      entry = self._entries.get(path)
+    if entry and entry['stat'] == signature:
+      return entry['sha']
+    return None
+
+  def put(self, path, sha):
+    """Records the sha of a file.
+
+    :param path: The file the sha was computed for.
+    :param sha: The file's sha.
+    """
+    signature = self._stat_signature(path)
+    with self._lock:
+      self._load()
+      self._entries[path] = {'stat': signature, 'sha': sha}
+      self._dirty = True
+
+  def prune(self, paths):
+    """Forgets every file except the specified ones (e.g., files that have since been deleted).
+
+    :param paths: The files to remember.
+    """
+    paths = set(paths)
+    with self._lock:
+      self._load()
+      for path in list(self._entries):
+        if path not in paths:
+          del self._entries[path]
+          self._dirty = True
+
+  def save(self):
+    """Persists the cache, if it has changed."""
+    with self._lock:
+      if not self._dirty:
+        return
+      safe_makedirs(os.path.dirname(self._path))
+      tmp_path = '{0}.tmp'.format(self._path)
+      with open(tmp_path, 'w') as outfile:
+        json.dump(self._entries, outfile)
+      os.rename(tmp_path, self._path)
+      self._dirty = False
@@ -3,18 +3,35 @@
 from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
                         print_function, unicode_literals)
 
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, namedtuple
 import json
 import os
 import shutil
 import sys
+import threading
+import time
 from gitshed.content_store import ContentStore
 
 from gitshed.error import GitShedError
-from gitshed.local_content_store import LocalContentStore
-from gitshed.remote_content_store import RSyncedRemoteContentStore
+from gitshed.locks import KeyLocks
+from gitshed.metrics import metric_name, metrics
+from gitshed.progress import Progress
 from gitshed.repo import GitRepo
-from gitshed.util import run_cmd_str, safe_makedirs, safe_rmtree, make_read_only, make_user_writeable
+from gitshed.staging import StagingArea
+from gitshed.util import (IO_BUFFER_SIZE, copy_file, iter_cmd_output, make_read_only, make_user_writeable,
+                          parse_size, safe_makedirs, temporary_dir)
+
+
+# A file managed by gitshed: the path of its symlink, the key of its content, and whether it's synced.
+ManagedFile = namedtuple('ManagedFile', ['path', 'key', 'synced'])
+
+
+class MissingConfigKeyError(GitShedError):
+  """Thrown when an expected config key is not present."""
+  def __init__(self, config_file_path, key_error):
+    """Wrap the specified KeyError instance."""
+    super(MissingConfigKeyError, self).__init__(
+      'Invalid content store config at {0}. Unknown key: {1}'.format(config_file_path, key_error.args[0]))
 
 
 class GitShed(object):
@@ -48,13 +65,7 @@ class GitShed(object):
 
     :param config_file_path: The path to the config file to read.
     """
-    class MissingConfigKeyError(GitShedError):
-      """Thrown when an expected config key is not present."""
-      def __init__(self, key_error):
-        """Wrap the specified KeyError instance."""
-        super(MissingConfigKeyError, self).__init__(
-          'Invalid content store config at {0}. Unknown key: {1}'.format(config_file_path, key_error.args[0]))
-
+    import atexit
     repo = GitRepo(os.getcwd())
     try:
       with open(config_file_path, 'r') as infile:
@@ -67,11 +78,86 @@ class GitShed(object):
     try:
       exclude = config.get('exclude')
       concurrency = config.get('concurrency', {})
+      gc_cfg = config.get('gc', {})
+      manifest_cfg = config.get('manifest', False)
+      dedupe = config.get('dedupe', False)
+      hash_algorithm = config.get('hash', 'sha1')
+      async_upload = config.get('async_upload', False)
+      metrics_cfg = config.get('metrics', False)
+      transfer_retries = config.get('transfer_retries', 0)
       content_store_cfg = config['content_store']
     except KeyError as e:
-      raise MissingConfigKeyError(e)
+      raise MissingConfigKeyError(config_file_path, e)
+
+    # Many commands never touch the content store, so we only create it if and when it's needed.
+    def create_content_store():
+      content_store = cls._content_store_from_config(config_file_path, content_store_cfg, concurrency)
+      if dedupe:
+        content_store.use_dedupe()
+      if transfer_retries:
+        content_store.use_transfer_retries(transfer_retries)
+      if manifest_cfg:
+        import hashlib
+        from gitshed.manifest import KeyManifest
+        complete = isinstance(manifest_cfg, dict) and manifest_cfg.get('complete', False)
+        # Cache each content store's manifest separately, so that the keys cached for one content
+        # store are never taken to be in another, e.g., after the config points to a new store.
+        store_id = json.dumps(content_store_cfg, sort_keys=True)
+        cache_dir = os.path.join(gitshed._state_path('manifest'),
+                                 hashlib.sha1(store_id.encode('utf-8')).hexdigest())
+        content_store.use_manifest(KeyManifest(content_store, cache_dir, complete))
+      if concurrency.get('adaptive'):
+        gitshed._use_adaptive_concurrency(content_store, content_store_cfg, concurrency)
+      return content_store
+
+    gc_max_size = gc_cfg.get('max_size')
+    gitshed = cls(repo, create_content_store, exclude=exclude,
+                  gc_max_size=parse_size(gc_max_size) if gc_max_size is not None else None,
+                  gc_refs=gc_cfg.get('refs'), hash_algorithm=hash_algorithm, async_upload=async_upload,
+                  upload_worker_cmd=cls.UPLOAD_WORKER_CMD if async_upload else None)
+    if metrics_cfg:
+      textfile = metrics_cfg.get('prometheus_textfile') if isinstance(metrics_cfg, dict) else None
+      atexit.register(lambda: gitshed.record_metrics(textfile))
+    return gitshed
+
+  def _use_adaptive_concurrency(self, content_store, content_store_cfg, concurrency):
+    """Makes a content store adapt its concurrency, starting from the best limits remembered for it.
+
+    The best limits observed during this run are remembered for next time when the process exits.
+
+    :param content_store: The ContentStore to configure.
+    :param content_store_cfg: The content store's config, which identifies it.
+    :param concurrency: The concurrency config.
+    """
+    import atexit
+    from gitshed.concurrency import AdaptiveConcurrency, ConcurrencyMemory
+
+    store_id = json.dumps(content_store_cfg, sort_keys=True)
+    memory = ConcurrencyMemory(self._state_path('concurrency.json'))
+    controllers = {}
+    for kind, configured in [('get', content_store.get_concurrency), ('put', content_store.put_concurrency)]:
+      # By default, allow up to 4x the configured concurrency.
+      maximum = concurrency.get('max_{0}'.format(kind), 4 * configured.limit)
+      controllers[kind] = AdaptiveConcurrency(memory.recall(store_id, kind) or configured.limit, maximum)
+    content_store.use_adaptive_concurrency(controllers['get'], controllers['put'])
+    atexit.register(lambda: memory.remember(
+      store_id, dict((kind, controller.best_limit) for kind, controller in controllers.items())))
 
-    chunk_size = content_store_cfg.get('chunk_size', 20)
+  @classmethod
+  def _content_store_from_config(cls, config_file_path, content_store_cfg, concurrency, chunk_size=20,
+                                 nested=False):
+    """Creates a ContentStore instance from its config.
+
+    :param config_file_path: The path of the config file the config was read from.
+    :param content_store_cfg: The content store config.
+    :param concurrency: The concurrency config.
+    :param chunk_size: The chunk size to use if the config doesn't specify one.
+    :param nested: True if the content store is inside another content store (e.g., a tier).
+    """
+    chunk_size = content_store_cfg.get('chunk_size', chunk_size)
+
+    # Content store implementations are imported only when needed, as importing them all slows down
+    # the startup of every command.
 
     if 'remote' in content_store_cfg:
       try:
@@ -79,25 +165,129 @@ class GitShed(object):
         host = rcfg['host']
         root_path = rcfg['root_path']
       except KeyError as e:
-        raise MissingConfigKeyError(e)
-      content_store = RSyncedRemoteContentStore(host, root_path, chunk_size,
-                                                concurrency.get('get'),
-                                                concurrency.get('put'))
+        raise MissingConfigKeyError(config_file_path, e)
+      from gitshed.remote_content_store import RSyncedRemoteContentStore
+      return RSyncedRemoteContentStore(host, root_path, chunk_size,
+                                       concurrency.get('get'),
+                                       concurrency.get('put'))
+    elif 'served' in content_store_cfg:
+      try:
+        scfg = content_store_cfg['served']
+        command = scfg.get('command') or ['ssh', scfg['host'], 'git', 'shed', 'serve', scfg['root_path']]
+      except KeyError as e:
+        raise MissingConfigKeyError(config_file_path, e)
+      from gitshed.served_content_store import ServedContentStore
+      return ServedContentStore(command, scfg.get('sessions', 1), chunk_size=chunk_size,
+                                get_concurrency=concurrency.get('get'),
+                                put_concurrency=concurrency.get('put'))
+    elif 's3' in content_store_cfg:
+      try:
+        s3cfg = content_store_cfg['s3']
+        endpoint = s3cfg['endpoint']
+        bucket = s3cfg['bucket']
+      except KeyError as e:
+        raise MissingConfigKeyError(config_file_path, e)
+      from gitshed.s3_content_store import S3ContentStore
+      return S3ContentStore(endpoint, bucket, s3cfg.get('prefix', ''), s3cfg.get('region', 'us-east-1'),
+                            s3cfg.get('access_key'), s3cfg.get('secret_key'),
+                            s3cfg.get('part_size', 8 * 1024 * 1024), s3cfg.get('parts_in_flight', 4),
+                            chunk_size, concurrency.get('get'), concurrency.get('put'))
+    elif 'routed' in content_store_cfg:
+      try:
+        routed_cfg = content_store_cfg['routed']
+        stores_cfg = routed_cfg['stores']
+        default = routed_cfg['default']
+        routes = [(route['paths'], route['store']) for route in routed_cfg.get('routes', [])]
+      except KeyError as e:
+        raise MissingConfigKeyError(config_file_path, e)
+      stores = dict((name, cls._content_store_from_config(config_file_path, store_cfg, concurrency, chunk_size,
+                                                          nested=True))
+                    for name, store_cfg in stores_cfg.items())
+      from gitshed.routed_content_store import RoutedContentStore
+      return RoutedContentStore(stores, routes, default, chunk_size,
+                                concurrency.get('get'),
+                                concurrency.get('put'))
     elif 'local' in content_store_cfg:
       try:
-        root = content_store_cfg['local']['root']
+        local_cfg = content_store_cfg['local']
+        root = local_cfg['root']
+      except KeyError as e:
+        raise MissingConfigKeyError(config_file_path, e)
+      if nested and local_cfg.get('direct', False):
+        # Content stores that wrap other stores fetch through their raw_* methods, so would copy.
+        raise GitShedError('Direct mode is only supported for a top-level local content store, '
+                           'in config at {0}'.format(config_file_path))
+      from gitshed.local_content_store import LocalContentStore
+      return LocalContentStore(root, chunk_size,
+                               concurrency.get('get'),
+                               concurrency.get('put'),
+                               direct=local_cfg.get('direct', False),
+                               verify=local_cfg.get('verify', True))
+    elif 'tiers' in content_store_cfg:
+      tiers = [cls._content_store_from_config(config_file_path, tier_cfg, concurrency, chunk_size,
+                                              nested=True)
+               for tier_cfg in content_store_cfg['tiers']]
+      if not tiers:
+        raise GitShedError('No tiers specified in content store config at {0}'.format(config_file_path))
+      from gitshed.tiered_content_store import TieredContentStore
+      return TieredContentStore(tiers, content_store_cfg.get('backfill', False), chunk_size,
+                                concurrency.get('get'),
+                                concurrency.get('put'))
+    elif 'replicated' in content_store_cfg:
+      try:
+        replicas_cfg = content_store_cfg['replicated']['replicas']
       except KeyError as e:
-        raise MissingConfigKeyError(e)
-      content_store = LocalContentStore(root, chunk_size,
-                                        concurrency.get('get'),
-                                        concurrency.get('put'))
+        raise MissingConfigKeyError(config_file_path, e)
+      replicas = [cls._content_store_from_config(config_file_path, replica_cfg, concurrency, chunk_size,
+                                                 nested=True)
+                  for replica_cfg in replicas_cfg]
+      if not replicas:
+        raise GitShedError('No replicas specified in content store config at {0}'.format(config_file_path))
+      from gitshed.replicated_content_store import ReplicatedContentStore
+      return ReplicatedContentStore(replicas, content_store_cfg['replicated'].get('write_quorum'), chunk_size,
+                                    concurrency.get('get'),
+                                    concurrency.get('put'))
+    elif 'simulated' in content_store_cfg:
+      try:
+        sim_cfg = content_store_cfg['simulated']
+        backend_cfg = sim_cfg['backend']
+      except KeyError as e:
+        raise MissingConfigKeyError(config_file_path, e)
+      backend = cls._content_store_from_config(config_file_path, backend_cfg, concurrency, chunk_size,
+                                               nested=True)
+      bandwidth = sim_cfg.get('bandwidth')
+      from gitshed.simulated_content_store import SimulatedContentStore
+      return SimulatedContentStore(backend, sim_cfg.get('latency', 0.0), sim_cfg.get('jitter', 0.0),
+                                   parse_size(bandwidth) if bandwidth is not None else None,
+                                   sim_cfg.get('failure_rate', 0.0), sim_cfg.get('seed'), chunk_size,
+                                   concurrency.get('get'),
+                                   concurrency.get('put'))
     else:
       raise GitShedError('No content store specified in config at {0}'.format(config_file_path))
 
-    return cls(repo, content_store, exclude=exclude)
+  # The command that uploads the content in the upload journal in the background.
+  UPLOAD_WORKER_CMD = ['git', 'shed', 'upload', '--retries', '5']
 
-  def __init__(self, git_repo, content_store, exclude=None):
+  def __init__(self, git_repo, content_store, exclude=None, gc_max_size=None, gc_refs=None,
+               hash_algorithm='sha1', async_upload=False, upload_worker_cmd=None):
+    """
+    :param git_repo: The GitRepo to manage files in.
+    :param content_store: The ContentStore to keep file content in, or a no-arg function that
+                          creates it. The function is called when the content store is first used.
+    :param exclude: Don't look for managed files under these paths.
+    :param gc_max_size: If set, garbage-collect the shed down to this many bytes after syncing.
+    :param gc_refs: When garbage-collecting, keep content referenced by these refs as well as by
+                    the worktree.
+    :param hash_algorithm: Compute the keys of newly managed files with this hash algorithm. Files
+                           managed with other algorithms remain valid.
+    :param async_upload: If True, manage() records the content of newly managed files in the upload
+                         journal, instead of uploading it, and upload() uploads it later.
+    :param upload_worker_cmd: If specified, manage() runs this command in the background, to upload
+                              the content it recorded in the upload journal.
+    """
     super(GitShed, self).__init__()
+    if not ContentStore.is_supported_hash_algorithm(hash_algorithm):
+      raise GitShedError('Unsupported hash algorithm: {0}'.format(hash_algorithm))
     self._git_repo = git_repo
     self._exclude = exclude or []
     if '.git' not in self._exclude:
@@ -105,85 +295,394 @@ class GitShed(object):
     if '.gitshed' not in self._exclude:
       self._exclude.append('.gitshed')
     self._content_store = content_store
+    self._gc_max_size = gc_max_size
+    self._gc_refs = gc_refs or []
+    self._hash_algorithm = hash_algorithm
+    self._async_upload = async_upload
+    self._upload_worker_cmd = upload_worker_cmd
+    # Note that the shed dir is created on demand, when content is first written to it.
     self._shed_relpath = self._git_repo.relpath(os.path.join('.gitshed', 'files'))
-    safe_makedirs(self._shed_relpath)
+    # Local bookkeeping (caches etc.) lives here. Unlike the shed, it never holds file content.
+    self._state_relpath = self._git_repo.relpath(os.path.join('.gitshed', 'state'))
+    # Content is staged on the shed's filesystem, so it moves into (and out of) the shed without copying.
+    self._staging_area = StagingArea(lambda: self._state_path('staging'))
+    if isinstance(content_store, ContentStore):
+      content_store.use_staging_area(self._staging_area)
 
   @property
   def git_repo(self):
     return self._git_repo
 
+  @property
+  def content_store(self):
+    if not isinstance(self._content_store, ContentStore):
+      self._content_store = self._content_store()
+      self._content_store.use_staging_area(self._staging_area)
+    return self._content_store
+
+  def iter_managed(self, paths=None):
+    """Lazily yields the files managed by gitshed.
+
+    :param paths: Yield the managed files among these paths. If None, yield all managed files.
+    :returns: An iterator over ManagedFile instances.
+    """
+    for path in (self._iter_all_symlinks() if paths is None else paths):
+      target_path = self._get_gitshed_path(path)
+      if target_path:
+        yield ManagedFile(path, self._get_key_from_versioned_path(target_path), os.path.exists(path))
+
   def get_status(self):
     """Returns a pair of the total number of files in gitshed and the number of unsynced files."""
-    all_symlinks = self._find_all_symlinks()
-    broken_symlinks = self._find_broken_symlinks(all_symlinks)
-    n = len(all_symlinks)
-    b = len(broken_symlinks)
+    n = 0
+    b = 0
+    for managed_file in self.iter_managed():
+      n += 1
+      if not managed_file.synced:
+        b += 1
     return n, b
 
   def status(self, out=sys.stdout):
     """Prints a succinct status message."""
     n, b = self.get_status()
     out.write('{0} files in gitshed. {1} synced. {2} need syncing.\n'.format(n, n - b, b))
+    num_pending = len(self._upload_journal().pending())
+    if num_pending:
+      out.write('{0} files are waiting to be uploaded. Use "git shed upload" to upload them now.\n'.format(
+        num_pending))
     if b:
       out.write('Use "git shed unsynced" to list unsynced files.\n')
       out.write('Use "git shed sync <file_glob>" to sync specific files.\n')
       out.write('Use "git shed sync" to sync all files.\n')
 
-  def synced(self, out=sys.stdout):
-    """Prints all synced files."""
-    all_symlinks = self._find_all_symlinks()
-    broken_symlinks = self._find_broken_symlinks(all_symlinks)
-    valid_symlinks = sorted(set(all_symlinks) - set(broken_symlinks))
-    for symlink in valid_symlinks:
-      out.write(symlink)
-      out.write('\n')
-
-  def unsynced(self, out=sys.stdout):
-    """Prints all unsynced files."""
-    all_symlinks = self._find_all_symlinks()
-    broken_symlinks = self._find_broken_symlinks(all_symlinks)
-    for symlink in broken_symlinks:
-      out.write(symlink)
-      out.write('\n')
-
-  def sync_all(self):
-    """Syncs all unsynced files."""
-    links = self._find_all_symlinks()
-    self.sync(links)
+  def synced(self, out=sys.stdout, delimiter='\n'):
+    """Prints all synced files, in sorted order.
+
+    :param out: Print to this stream.
+    :param delimiter: Terminate each path with this string.
+    """
+    for path in sorted(managed_file.path for managed_file in self.iter_managed() if managed_file.synced):
+      out.write(path)
+      out.write(delimiter)
+
+  def unsynced(self, out=sys.stdout, delimiter='\n'):
+    """Prints all unsynced files, in sorted order.
+
+    :param out: Print to this stream.
+    :param delimiter: Terminate each path with this string.
+    """
+    for path in sorted(managed_file.path for managed_file in self.iter_managed() if not managed_file.synced):
+      out.write(path)
+      out.write(delimiter)
+
+  def sync_all(self, prefixes=None, smallest_first=False, on_synced=None):
+    """Syncs all unsynced files.
+
+    :param prefixes: As for sync().
+    :param smallest_first: As for sync().
+    :param on_synced: As for sync().
+    """
+    self.sync(self._iter_all_symlinks(), prefixes=prefixes, smallest_first=smallest_first,
+              on_synced=on_synced)
 
   def resync_all(self):
     """Resyncs all files.
 
-    Removes the existing versions from the shed, and refetches them from the content store.
+    Verifies the existing versions in the shed, refetches those that fail verification from the
+    content store, and syncs any unsynced files.
     """
-    # Convert to an abspath first, to verify that self._shed_relpath is under the git repo as expected.
-    # This is an extra safety check in case of bugs.
-    gitshed_abspath = os.path.realpath(self._git_repo.abspath(self._shed_relpath))
-    safe_rmtree(gitshed_abspath)
+    self.fsck(repair=True)
     self.sync_all()
 
-  def sync(self, paths):
+  def fsck(self, repair=False, out=sys.stdout):
+    """Verifies the content and permissions of every file in the shed.
+
+    Files are re-hashed in parallel, except where the fingerprint cache shows that a file is
+    unchanged since it was last verified.
+
+    :param repair: If True, refetch files that fail verification from the content store.
+    :param out: Report problems to this stream.
+    :returns: The shed paths that failed verification.
+    """
+    from multiprocessing import cpu_count
+    from multiprocessing.pool import ThreadPool
+    from gitshed.fingerprint_cache import FingerprintCache
+
+    shed_paths = list(self._iter_shed_files())
+    fingerprint_cache = FingerprintCache(self._state_path('fingerprints.json'))
+    # Forget files that are no longer in the shed (e.g., because they were evicted).
+    fingerprint_cache.prune(shed_paths)
+    if not shed_paths:
+      fingerprint_cache.save()
+      return []
+
+    progress = Progress(len(shed_paths))
+    progress.update_bar()
+
+    def verify(shed_path):
+      try:
+        return self._verify_shed_file(shed_path, fingerprint_cache)
+      finally:
+        progress.increment()
+
+    pool = ThreadPool(cpu_count())
+    results = pool.map(verify, shed_paths)
+    pool.close()
+    pool.join()
+    problems = [(p, problem, content_ok) for p, (problem, content_ok) in zip(shed_paths, results) if problem]
+    fingerprint_cache.save()
+
+    for shed_path, problem, _ in problems:
+      out.write('{0}: {1}\n'.format(shed_path, problem))
+    out.write('{0} files checked. {1} failed verification.\n'.format(len(shed_paths), len(problems)))
+
+    if repair and problems:
+      num_repaired = 0
+      key_to_target_paths = defaultdict(list)
+      for shed_path, _, content_ok in problems:
+        try:
+          key = self._get_key_from_versioned_path(shed_path)
+        except GitShedError:
+          continue  # Not shed content, so there's nothing to refetch.
+        # Only the permissions are wrong, so there's no need to refetch. But a shed entry linked to a
+        # content store object (see LocalContentStore) must not be chmodded, so we refetch that.
+        if content_ok and not os.path.islink(shed_path) and os.stat(shed_path).st_nlink == 1:
+          os.chmod(shed_path, int(ContentStore.mode_from_key(key), 8))
+        else:
+          os.unlink(shed_path)
+          key_to_target_paths[key].append(shed_path)
+        num_repaired += 1
+      self.content_store.get(key_to_target_paths)
+      out.write('Repaired {0} files.\n'.format(num_repaired))
+
+    return [p for p, _, _ in problems]
+
+  def _verify_shed_file(self, shed_path, fingerprint_cache):
+    """Checks a single shed file against the key in its name.
+
+    Returns a pair of a description of the problem (or None if the file is good), and whether the
+    file's content is good.
+    """
+    try:
+      key = self._get_key_from_versioned_path(shed_path)
+    except GitShedError:
+      return 'not a versioned shed file', False
+    actual_sha = fingerprint_cache.get(shed_path)
+    if actual_sha is None:
+      actual_sha = ContentStore.fingerprint_for_key(shed_path, key)
+      fingerprint_cache.put(shed_path, actual_sha)
+    if actual_sha != ContentStore.sha_from_key(key):
+      return 'content sha is {0} but should be {1}'.format(actual_sha, ContentStore.sha_from_key(key)), False
+    actual_mode = ContentStore.mode(shed_path)
+    if actual_mode != ContentStore.mode_from_key(key):
+      return 'permissions are {0} but should be {1}'.format(actual_mode, ContentStore.mode_from_key(key)), True
+    return None, True
+
+  # Sync this many files at a time, so that memory use is bounded however many files we sync.
+  _SYNC_BATCH_SIZE = 10000
+
+  # Hold at most this many key locks at once. Enough keys to keep the content store's gets busy,
+  # but few enough open lock files to stay well within the usual per-process limit.
+  _LOCK_GROUP_SIZE = 256
+
+  def sync(self, paths, prefixes=None, smallest_first=False, on_synced=None):
     """Syncs the specified files.
 
     A no-op for paths that aren't unsynced files managed by gitshed.
 
-    :param paths: The files to sync.
+    Files are synced in priority order: by default, the order in which they're specified. Each file
+    is usable as soon as its content arrives, without waiting for the rest.
+
+    :param paths: The files to sync. May be an iterator, which is consumed lazily, unless the order
+                  is changed by prefixes or smallest_first.
+    :param prefixes: If specified, sync files under these paths first, in the order of the prefixes.
+    :param smallest_first: If True, sync smaller files first (within each prefix, if specified).
+    :param on_synced: If specified, called with the path of each file as soon as it's synced.
     """
-    unsynced_paths = [p for p in paths if os.path.islink(p) and not os.path.exists(p)]
-    key_to_target_paths = defaultdict(list)
-    for path in unsynced_paths:
+    unsynced = self._iter_unsynced(paths)
+    if prefixes or smallest_first:
+      unsynced = self._prioritized(list(unsynced), prefixes or [], smallest_first)
+    batch = []
+    synced_keys = {}  # Map of key -> a shed path that an earlier batch synced that key's content to.
+    for path, target_path, key in unsynced:
+      batch.append((path, target_path, key))
+      if len(batch) == self._SYNC_BATCH_SIZE:
+        self._sync_batch(batch, on_synced, synced_keys)
+        batch = []
+    if batch:  # Don't create the content store unless we need it.
+      self._sync_batch(batch, on_synced, synced_keys)
+    if self._gc_max_size is not None:
+      self.gc(max_size=self._gc_max_size)
+
+  def _iter_unsynced(self, paths):
+    """Yields a (path, shed path, key) triple for each unsynced managed file among the paths."""
+    for path in paths:
       target_path = self._get_gitshed_path(path)
-      key = self._get_key_from_versioned_path(target_path)
-      key_to_target_paths[key].append(target_path)
-    self._content_store.get(key_to_target_paths)
+      if target_path:
+        synced = os.path.exists(path)
+        metrics.increment(metric_name('sync_files', result='hit' if synced else 'miss'))
+        if not synced:
+          yield path, target_path, self._get_key_from_versioned_path(target_path)
+
+  def _prioritized(self, unsynced, prefixes, smallest_first):
+    """Sorts (path, shed path, key) triples into the order in which to sync them."""
+    prefixes = [os.path.normpath(prefix) for prefix in prefixes]
+    key_to_size = self.content_store.sizes(set(key for _, _, key in unsynced)) if smallest_first else {}
+    def sort_key(item):
+      path, _, key = item
+      size = key_to_size.get(key)
+      # Content of unknown size comes after all content of known size.
+      return self._prefix_rank(path, prefixes), size is None, size or 0
+
+    return sorted(unsynced, key=sort_key)
+
+  @staticmethod
+  def _prefix_rank(path, prefixes):
+    """Returns the index of the first of the (normalized) prefixes that path is under, or len(prefixes) if none."""
+    path = os.path.normpath(path)
+    for i, prefix in enumerate(prefixes):
+      if path == prefix or path.startswith(prefix + os.sep):
+        return i
+    return len(prefixes)
+
+  def _sync_batch(self, batch, on_synced, synced_keys):
+    key_to_target_paths = OrderedDict()
+    target_path_to_paths = defaultdict(list)
+    for path, target_path, key in batch:
+      target_paths = key_to_target_paths.setdefault(key, [])
+      if target_path not in target_path_to_paths:
+        target_paths.append(target_path)
+      target_path_to_paths[target_path].append(path)
+
+    def on_complete(target_path):
+      if on_synced:
+        for path in target_path_to_paths[target_path]:
+          on_synced(path)
+
+    # Content that an earlier batch synced is copied from the shed, rather than fetched again.
+    for key in list(key_to_target_paths):
+      src = synced_keys.get(key)
+      if src and os.path.isfile(src):
+        for target_path in key_to_target_paths.pop(key):
+          if not os.path.exists(target_path):
+            self._copy_into_shed(src, target_path)
+          on_complete(target_path)
+    if not key_to_target_paths:
+      return
+
+    self.content_store.note_paths((path, key) for path, _, key in batch)
+
+    # Other gitshed processes may be syncing some of the same content. We only fetch content that no
+    # other process is fetching, and then wait for the others to finish fetching the rest.
+    # Each held lock is an open file, so we lock a bounded group of keys at a time.
+    locks = KeyLocks(self._state_path('locks'))
+    keys = list(key_to_target_paths)
+    for i in range(0, len(keys), self._LOCK_GROUP_SIZE):
+      group = OrderedDict((key, key_to_target_paths[key]) for key in keys[i:i + self._LOCK_GROUP_SIZE])
+      try:
+        deferred = []
+        for key in group:
+          if not locks.try_acquire(key):
+            deferred.append(key)
+        self._get_locked(group, locks, on_complete)
+        # Acquiring locks in a consistent order while holding others prevents deadlock.
+        for key in sorted(deferred):
+          locks.acquire(key)
+        self._get_locked(group, locks, on_complete)
+      finally:
+        locks.release_all()
+    for key, target_paths in key_to_target_paths.items():
+      synced_keys[key] = target_paths[0]
+
+  @staticmethod
+  def _copy_into_shed(src, target_path):
+    """Copies content that's already in the shed to another shed path, atomically."""
+    safe_makedirs(os.path.dirname(target_path))
+    tmp_path = '{0}.{1}.tmp'.format(target_path, os.getpid())
+    copy_file(src, tmp_path)
+    os.rename(tmp_path, target_path)
+
+  def _get_locked(self, key_to_target_paths, locks, on_complete):
+    """Gets the content under the held locks that isn't already in place, and releases those locks.
+
+    Content may already be in place if another process fetched it.
+    """
+    to_get = OrderedDict()
+    for key, target_paths in key_to_target_paths.items():
+      if key not in locks.held:
+        continue
+      missing = [target_path for target_path in target_paths if not os.path.exists(target_path)]
+      if missing:
+        to_get[key] = missing
+      else:
+        metrics.increment('sync_coalesced_keys')
+      for target_path in target_paths:
+        if target_path not in missing:
+          on_complete(target_path)
+    try:
+      if to_get:
+        self.content_store.get(to_get, on_complete)
+    finally:
+      locks.release_all()
+
+  def gc(self, max_size=None, refs=None, out=None):
+    """Evicts content that no managed file refers to from the shed.
+
+    Content referenced by the worktree (and by any of the specified refs) is never evicted.
+    Other content is evicted in least-recently-used order, until the shed's total size is within
+    max_size. The sizes are accounted for before anything else, so this is cheap when the shed is
+    already within its budget.
+
+    Note that evicted content can always be synced back from the content store.
+
+    :param max_size: Evict until the shed holds at most this many bytes. If None, evict all
+                     unreferenced content.
+    :param refs: Also keep content referenced by the trees at these refs. Defaults to the refs
+                 specified at construction.
+    :param out: Report what was evicted to this stream.
+    :returns: A pair of the number of files evicted and the number of bytes freed.
+    """
+    entries = []  # List of (last use time, size, shed path).
+    total_size = 0
+    for shed_path in self._iter_shed_files():
+      st = os.lstat(shed_path)
+      # Access times may be updated lazily (e.g., under relatime), but they're good enough for LRU.
+      entries.append((max(st.st_atime, st.st_mtime), st.st_size, shed_path))
+      total_size += st.st_size
+    if max_size is not None and total_size <= max_size:
+      return 0, 0
+
+    referenced = set(self._get_gitshed_path(p) for p in self._iter_all_symlinks())
+    # Content that hasn't been uploaded yet can't be synced back, so it must be kept.
+    referenced.update(self._upload_journal().pending().values())
+    for ref in (self._gc_refs if refs is None else refs):
+      for path, target in self._git_repo.symlink_targets(ref).items():
+        referenced.add(self._git_repo.relpath(os.path.join(os.path.dirname(path), target)))
+
+    num_evicted = 0
+    bytes_freed = 0
+    for _, size, shed_path in sorted(entries):
+      if max_size is not None and total_size - bytes_freed <= max_size:
+        break
+      if shed_path not in referenced:
+        os.unlink(shed_path)
+        self._prune_empty_shed_dirs(os.path.dirname(shed_path))
+        num_evicted += 1
+        bytes_freed += size
+
+    if out:
+      out.write('Evicted {0} files ({1} bytes) from the shed.\n'.format(num_evicted, bytes_freed))
+      if max_size is not None and total_size - bytes_freed > max_size:
+        out.write('The shed is still over its size budget: all remaining content is in use.\n')
+    return num_evicted, bytes_freed
 
   def resync(self, paths):
     """Resyncs the specified files.
 
     Removes the existing versions from the shed, and refetches them from the content store.
 
-    ":param paths: The files to resync.
+    :param paths: The files to resync.
     """
+    paths = list(paths)
     for p in paths:
       if os.path.islink(p):
         gitshed_path = self._get_gitshed_path(p)
@@ -195,53 +694,270 @@ class GitShed(object):
     """Puts files under management by gitshed.
 
     For each file:
-      - Copies it into the shed.
       - Uploads its contents to the content store.
+      - Moves it into the shed.
       - Makes it read-only.
       - Replaces it with a symlink.
 
-    :param paths: Put these files under management.
+    Every file is validated before any is put under management. The files are then streamed through
+    these steps, so that (e.g.,) some files are being hashed while others are being uploaded. If a
+    file fails to upload, files that were already under management remain so.
+
+    If uploads are asynchronous, the contents are recorded in the upload journal instead of being
+    uploaded, and the upload worker (if any) is started to upload them in the background.
+
+    :param paths: Put these files under management. May be an iterator.
     """
+    from multiprocessing import cpu_count
+    from gitshed.pipeline import Pipeline
+
+    if not paths:
+      return
+
+    # Validate everything first, so that a bad path doesn't leave only some of the files managed.
     relpaths = []
+    seen_relpaths = set()
     for path in paths:
       relpath = self._git_repo.relpath(path)
       # No-op if this path is already under our management.
-      if not self._is_managed(relpath):
-        if os.path.islink(relpath):
-          raise GitShedError('Path is an unmanaged symlink: {0}'.format(relpath))
-        if os.path.isdir(relpath):
-          raise GitShedError('Path is a directory: {0}'.format(relpath))
-        if not os.path.isfile(relpath):
-          raise GitShedError('File not found: {0}'.format(relpath))
-        relpaths.append(relpath)
-
-    # Upload everything to the content store.
-    keys = self._content_store.put(relpaths)
-
-    # Move the files into the shed.
-    for key, relpath in zip(keys, relpaths):
-      versioned_relpath = self._create_versioned_path(relpath, key)
-      target_abspath = os.path.abspath(os.path.join(self._shed_relpath, versioned_relpath))
-      if os.path.exists(target_abspath):
-        existing_key = ContentStore.key(target_abspath)
-        if ContentStore.sha_from_key(key) != ContentStore.sha_from_key(existing_key):
-          raise GitShedError("Shed path {0} already exists and doesn't match the content hash "
-                             "of {1}. Delete it manually, but only if you're sure it's "
-                             "safe to do so.".format(target_abspath, relpath))
-        elif ContentStore.mode_from_key(key) != ContentStore.mode_from_key(existing_key):
-          raise GitShedError("Shed path {0} already exists and has different permissions than "
-                             "{1}. Delete it manually, but only if you're sure it's safe to "
-                             "do so".format(target_abspath, relpath))
-        os.unlink(relpath)  # So we can replace it with a symlink below.
+      if relpath in seen_relpaths or self._is_managed(relpath):
+        continue
+      seen_relpaths.add(relpath)
+      if os.path.islink(relpath):
+        raise GitShedError('Path is an unmanaged symlink: {0}'.format(relpath))
+      if os.path.isdir(relpath):
+        raise GitShedError('Path is a directory: {0}'.format(relpath))
+      if not os.path.isfile(relpath):
+        raise GitShedError('File not found: {0}'.format(relpath))
+      relpaths.append(relpath)
+    if not relpaths:
+      return
+
+    progress = Progress(len(relpaths))
+    progress.update_bar()
+    uploaded_keys = set()
+    uploading = {}  # Map of key -> Event that's set when the upload of that key's content ends.
+    lock = threading.Lock()
+
+    def compute_key(relpath):
+      return relpath, ContentStore.key(relpath, self._hash_algorithm)
+
+    def upload(batch):
+      # If multiple files have the same content we only need to upload it once. But a file whose
+      # content another batch is uploading mustn't be moved into the shed until that upload succeeds.
+      done = threading.Event()
+      to_upload = []
+      others = set()
+      with lock:
+        for relpath, key in batch:
+          if key in uploaded_keys:
+            continue
+          if key in uploading:
+            others.add(uploading[key])
+          else:
+            uploading[key] = done
+            to_upload.append((relpath, key))
+      try:
+        self.content_store.put_keyed(to_upload)
+        with lock:
+          uploaded_keys.update(key for _, key in to_upload)
+      finally:
+        with lock:
+          for _, key in to_upload:
+            del uploading[key]
+        done.set()
+      for other in others:
+        other.wait()
+      with lock:
+        failed = [relpath for relpath, key in batch if key not in uploaded_keys]
+      if failed:
+        raise GitShedError('Failed to upload the content of: {0}'.format(', '.join(failed)))
+      return batch
+
+    def record_in_journal(batch):
+      # The content must be recorded before it's moved into the shed, so that it can't end up
+      # managed but never uploaded.
+      journal.add((key, os.path.join(self._shed_relpath, self._create_versioned_path(relpath, key)), relpath)
+                  for relpath, key in batch)
+      return batch
+
+    def move_into_shed(relpath_and_key):
+      self._move_into_shed(*relpath_and_key)
+      progress.increment()
+
+    pipeline = Pipeline()
+    pipeline.add_stage(compute_key, concurrency=cpu_count())
+    if self._async_upload:
+      journal = self._upload_journal()
+      pipeline.add_stage(record_in_journal, batch_size=100)
+    else:
+      pipeline.add_stage(upload, concurrency=self.content_store.put_concurrency.maximum,
+                         batch_size=self.content_store.chunk_size)
+    pipeline.add_stage(move_into_shed, concurrency=4)
+    try:
+      pipeline.run(relpaths)
+    finally:
+      if self._async_upload and self._upload_worker_cmd:
+        self._start_upload_worker()
+    progress.finish()
+
+  # Wait this long before retrying failed uploads, doubling the wait before each subsequent retry.
+  _UPLOAD_RETRY_DELAY_SECONDS = 1.0
+
+  def upload(self, keys=None, wait=False, retries=0, out=None):
+    """Uploads content waiting in the upload journal to the content store.
+
+    Content that another process is uploading is left to that process, unless wait is True.
+
+    :param keys: Only upload the content under these keys. If None, upload all waiting content.
+    :param wait: If True, wait for other processes uploading the same content to finish, and then
+                 upload whatever they failed to.
+    :param retries: Retry failed uploads this many times (in addition to the retries of each chunk
+                    by the content store).
+    :param out: Report progress and problems to this stream.
+    :returns: The keys whose content failed to upload.
+    """
+    out = out or sys.stdout
+    journal = self._upload_journal()
+    failed = set()
+    for attempt in range(retries + 1):
+      if attempt:
+        time.sleep(self._UPLOAD_RETRY_DELAY_SECONDS * 2 ** (attempt - 1))
+      pending = journal.pending_entries()
+      if keys is not None:
+        pending = OrderedDict((key, entry) for key, entry in pending.items() if key in keys)
+      if not pending:
+        return set()
+      failed = self._upload_pending(journal, pending, wait, out)
+      if not failed:
+        return set()
+    return failed
+
+  def _upload_pending(self, journal, pending, wait, out):
+    """Uploads some of the content waiting in the upload journal, and marks it as done.
+
+    :param pending: A map of key -> (shed path, path it was managed from), of the content to upload.
+    :returns: The keys whose content failed to upload.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    content_store = self.content_store
+    progress = Progress(len(pending))
+    progress.update_bar()
+    failed = set()
+    pool = ThreadPool(content_store.put_concurrency.maximum)
+    try:
+      # Each held lock is an open file, so we lock a bounded group of keys at a time.
+      keys = list(pending)
+      for i in range(0, len(keys), self._LOCK_GROUP_SIZE):
+        group = OrderedDict((key, pending[key]) for key in keys[i:i + self._LOCK_GROUP_SIZE])
+        failed.update(self._upload_pending_group(journal, group, wait, pool, progress, out))
+    finally:
+      pool.close()
+      pool.join()
+    progress.finish()
+    return failed
+
+  def _upload_pending_group(self, journal, pending, wait, pool, progress, out):
+    """Uploads a group of the content waiting in the upload journal, under the locks on its keys.
+
+    :param pending: A map of key -> (shed path, path it was managed from), of the content to upload.
+    :param pool: Upload chunks of content concurrently on this ThreadPool.
+    :returns: The keys whose content failed to upload.
+    """
+    locks = KeyLocks(self._state_path('locks'))
+    try:
+      if wait:
+        # Acquiring locks in a consistent order while holding others prevents deadlock.
+        for key in sorted(pending):
+          locks.acquire(key)
       else:
-        safe_makedirs(os.path.dirname(target_abspath))
-        shutil.move(relpath, target_abspath)
+        for key in pending:
+          locks.try_acquire(key)
+      # Another process may have uploaded some of the content before we locked it.
+      still_pending = journal.pending()
+      to_upload = []
+      lost = []
+      for key, (shed_path, relpath) in pending.items():
+        if key in locks.held and key in still_pending:
+          # Content journaled before relpaths were recorded is noted under its shed path.
+          (to_upload if os.path.isfile(shed_path) else lost).append((shed_path, relpath or shed_path, key))
+      if lost:
+        # There's nothing left to upload, so we can only report the problem.
+        for shed_path, _, _ in lost:
+          out.write('{0}: content was removed from the shed before it was uploaded.\n'.format(shed_path))
+        journal.mark_done(key for _, _, key in lost)
+      progress.increment(len(pending) - len(to_upload))
+
+      content_store = self.content_store
+      chunk_size = content_store.chunk_size
+      chunks = [to_upload[i:i + chunk_size] for i in range(0, len(to_upload), chunk_size)]
+
+      def put(chunk):
+        try:
+          # Content stores that place content by path must see the path it was managed from.
+          content_store.put_keyed([(shed_path, key) for shed_path, _, key in chunk],
+                                  paths=[relpath for _, relpath, _ in chunk])
+          return chunk, None
+        except (GitShedError, IOError, OSError) as e:
+          return chunk, e
+
+      failed = set()
+      for chunk, error in pool.imap_unordered(put, chunks):
+        if error:
+          out.write('Failed to upload {0} files: {1}\n'.format(len(chunk), error))
+          failed.update(key for _, _, key in chunk)
+        else:
+          journal.mark_done(key for _, _, key in chunk)
+        progress.increment(len(chunk))
+      return failed
+    finally:
+      locks.release_all()
+
+  def _upload_journal(self):
+    from gitshed.upload_journal import UploadJournal
+    return UploadJournal(os.path.join(self._state_relpath, 'upload_journal'))
+
+  def _start_upload_worker(self):
+    """Starts the upload worker in the background, detached from this process."""
+    import subprocess
+    with open(os.devnull, 'r') as devnull:
+      with open(self._state_path('upload.log'), 'a') as log:
+        try:
+          subprocess.Popen(self._upload_worker_cmd, stdin=devnull, stdout=log, stderr=log,
+                           close_fds=True, preexec_fn=os.setsid)
+        except OSError as e:
+          raise GitShedError('Failed to start the upload worker ({0}): {1}. Use "git shed upload" to '
+                             'upload the files now.'.format(' '.join(self._upload_worker_cmd), e))
+
+  def _move_into_shed(self, relpath, key):
+    """Moves a file whose content has been uploaded into the shed, and replaces it with a symlink.
+
+    :param relpath: The file to move, relative to the repo root.
+    :param key: The key of the file's content.
+    """
+    versioned_relpath = self._create_versioned_path(relpath, key)
+    target_abspath = os.path.abspath(os.path.join(self._shed_relpath, versioned_relpath))
+    if os.path.exists(target_abspath):
+      existing_key = ContentStore.key(target_abspath, ContentStore.algorithm_from_key(key))
+      if ContentStore.sha_from_key(key) != ContentStore.sha_from_key(existing_key):
+        raise GitShedError("Shed path {0} already exists and doesn't match the content hash "
+                           "of {1}. Delete it manually, but only if you're sure it's "
+                           "safe to do so.".format(target_abspath, relpath))
+      elif ContentStore.mode_from_key(key) != ContentStore.mode_from_key(existing_key):
+        raise GitShedError("Shed path {0} already exists and has different permissions than "
+                           "{1}. Delete it manually, but only if you're sure it's safe to "
+                           "do so".format(target_abspath, relpath))
+      os.unlink(relpath)  # So we can replace it with a symlink below.
+    else:
+      safe_makedirs(os.path.dirname(target_abspath))
+      shutil.move(relpath, target_abspath)
 
-      # Must not write through the symlink: those changes won't be seen by git (let alone git shed).
-      make_read_only(target_abspath)
-      # We want the symlink to be relative, so it's portable.
-      rel_link = os.path.relpath(target_abspath, os.path.abspath(os.path.dirname(relpath)))
-      os.symlink(rel_link, relpath)
+    # Must not write through the symlink: those changes won't be seen by git (let alone git shed).
+    make_read_only(target_abspath)
+    # We want the symlink to be relative, so it's portable.
+    rel_link = os.path.relpath(target_abspath, os.path.abspath(os.path.dirname(relpath)))
+    os.symlink(rel_link, relpath)
 
   def unmanage(self, paths):
     """Removes files from management by git shed.
@@ -249,7 +965,8 @@ class GitShed(object):
     For each file:
       - Syncs it into the shed if necessary.
       - Removes the symlink.
-      - Moves the file's contents from the shed to the symlink's location.
+      - Moves the file's contents from the shed to the symlink's location (or copies them, if the
+        shed entry is linked to a content store object).
       - Makes it writeable by the user.
 
     This is useful, e.g., if files need to be edited and re-uploaded. Files in git shed are
@@ -260,8 +977,9 @@ class GitShed(object):
     - Edit the file in its location.
     - Re-manage the file.
 
-    :param paths: Put these files under management.
+    :param paths: Remove these files from management.
     """
+    paths = list(paths)
     self.sync(paths)
     for path in paths:
       relpath = self._git_repo.relpath(path)
@@ -269,9 +987,112 @@ class GitShed(object):
       # No-op if this path is not under our management.
       if target:
         os.unlink(relpath)
-        shutil.move(target, relpath)
+        if os.path.islink(target) or os.stat(target).st_nlink > 1:
+          # The shed entry is linked to a content store object, which must not become writeable.
+          copy_file(target, relpath)
+          os.unlink(target)
+        else:
+          shutil.move(target, relpath)
         make_user_writeable(relpath)
 
+  # The sha git uses to represent a nonexistent object, e.g., the old value of a newly created ref.
+  _NULL_SHA = '0' * 40
+
+  # The git hooks that gitshed provides.
+  HOOKS = ['pre-commit', 'pre-push']
+
+  def check_staged(self, out=sys.stdout):
+    """Checks that the content of every managed file added or modified in the index is in the content store.
+
+    Suitable for use in a pre-commit hook. Only staged files are examined, so the cost is
+    proportional to the size of the change, not of the repo.
+
+    Content waiting in the upload journal counts as being in the content store, as it will be
+    uploaded before it's pushed.
+
+    :param out: Report problems to this stream.
+    :returns: The paths of the staged managed files whose content is not in the content store.
+    """
+    return self._check_content_exists(self._git_repo.staged_symlink_targets().items(), out,
+                                      upload_pending=False)
+
+  def check_pushed(self, ref_updates, remote, out=sys.stdout):
+    """Checks that the content of every managed file added or modified by pushed commits is in the content store.
+
+    Suitable for use in a pre-push hook. Only the pushed commits are examined, so the cost is
+    proportional to the size of the change, not of the repo.
+
+    Content in the pushed commits that's waiting in the upload journal is uploaded first, waiting for
+    any other process uploading it. Other waiting content doesn't hold up the push.
+
+    :param ref_updates: The refs being pushed: an iterable of (local ref, local sha, remote ref,
+                        remote sha) tuples, as provided to a pre-push hook.
+    :param remote: The name of the remote being pushed to.
+    :param out: Report problems to this stream.
+    :returns: The paths of the pushed managed files whose content is not in the content store.
+    """
+    paths_and_targets = []
+    for _, local_sha, _, remote_sha in ref_updates:
+      if local_sha == self._NULL_SHA:
+        continue  # Deleting the remote ref doesn't push anything.
+      # Commits that the remote already has were checked when they were pushed.
+      exclude = ['--remotes={0}'.format(remote)]
+      if remote_sha != self._NULL_SHA and self._git_repo.has_commit(remote_sha):
+        exclude.append(remote_sha)
+      paths_and_targets.extend(self._git_repo.introduced_symlink_targets(local_sha, exclude))
+    return self._check_content_exists(paths_and_targets, out, upload_pending=True)
+
+  def _check_content_exists(self, paths_and_targets, out, upload_pending):
+    """Checks that the content of the specified symlinks into the shed is in the content store.
+
+    Symlinks that don't point into the shed are ignored.
+
+    :param paths_and_targets: An iterable of (symlink path, symlink target) pairs.
+    :param out: Report problems to this stream.
+    :param upload_pending: If True, upload any of the content that's waiting in the upload journal.
+                           Otherwise, count it as being in the content store.
+    :returns: The paths of the symlinks whose content is not in the content store.
+    """
+    paths_and_keys = []
+    for path, target in paths_and_targets:
+      shed_path = self._git_repo.relpath(os.path.join(os.path.dirname(path), target))
+      if shed_path.startswith(self._shed_relpath):
+        paths_and_keys.append((path, self._get_key_from_versioned_path(shed_path)))
+    if not paths_and_keys:
+      return []
+
+    keys = set(key for _, key in paths_and_keys)
+    pending_keys = keys.intersection(self._upload_journal().pending())
+    if pending_keys and upload_pending:
+      self.upload(keys=pending_keys, wait=True, out=out)
+    elif pending_keys:
+      keys -= pending_keys
+    self.content_store.note_paths(paths_and_keys)
+    missing_keys = self.content_store.missing(keys)
+    bad_paths = sorted(set(path for path, key in paths_and_keys if key in missing_keys))
+    for path in bad_paths:
+      out.write('{0}: content is not in the content store.\n'.format(path))
+    return bad_paths
+
+  def install_hooks(self):
+    """Installs gitshed's git hooks into this repo.
+
+    Existing hooks are not overwritten, unless they were installed by gitshed.
+    """
+    hooks_dir = self._git_repo.hooks_dir()
+    safe_makedirs(hooks_dir)
+    marker = '# Installed by git shed.'
+    for hook in self.HOOKS:
+      hook_path = os.path.join(hooks_dir, hook)
+      if os.path.exists(hook_path):
+        with open(hook_path, 'r') as infile:
+          if marker not in infile.read():
+            raise GitShedError('{0} already exists. Add this line to it manually:\n'
+                               '  git shed hook {1} "$@" || exit 1'.format(hook_path, hook))
+      with open(hook_path, 'w') as outfile:
+        outfile.write('#!/bin/sh\n{0}\nexec git shed hook {1} "$@"\n'.format(marker, hook))
+      os.chmod(hook_path, 0755)
+
   def verify_setup(self):
     """Verifies that the repo is set up properly for gitshed use."""
     if not self._git_repo.is_ignored(self._shed_relpath):
@@ -282,7 +1103,220 @@ class GitShed(object):
         raise GitShedError('{0} must be in your .gitignore file.'.format(self._shed_relpath))
       with open('.gitignore', 'a') as outfile:
         outfile.write('\n{0}\n'.format(relpath))
-    self._content_store.verify_setup()
+    self.content_store.verify_setup()
+
+  def rebuild_manifest(self, out=None):
+    """Records every key in the content store in its manifest.
+
+    :param out: Write a summary to this stream. Defaults to stdout.
+    """
+    out = out or sys.stdout
+    manifest = self.content_store.manifest
+    if manifest is None:
+      raise GitShedError('No manifest is configured for the content store.')
+    num_keys = manifest.rebuild()
+    out.write('Recorded {0} keys in the manifest.\n'.format(num_keys))
+
+  def create_bundle(self, rev, bundle_path, prefixes=None, out=None):
+    """Writes the content of managed files to a single bundle file.
+
+    Applying the bundle with apply_bundle() then seeds a shed (e.g., on an ephemeral CI worker)
+    with a single sequential read, instead of syncing every file from the content store.
+
+    Content is read from the shed where it's synced, and fetched from the content store otherwise.
+
+    :param rev: Bundle the content of the managed files in the tree at this revision. Or, if this is
+                a range A..B, of the managed files added or modified by the commits in it.
+    :param bundle_path: Write the bundle to this path.
+    :param prefixes: If specified, only bundle the content of files under these paths.
+    :param out: Write a summary to this stream. Defaults to stdout.
+    :returns: The number of keys bundled.
+    """
+    from gitshed.bundle import write_bundle
+
+    out = out or sys.stdout
+    exclude_rev, sep, include_rev = rev.partition('..')
+    if sep:
+      paths_and_targets = self._git_repo.introduced_symlink_targets(include_rev or 'HEAD', [exclude_rev])
+    else:
+      paths_and_targets = self._git_repo.symlink_targets(rev).items()
+    prefixes = [os.path.normpath(prefix) for prefix in prefixes or []]
+
+    key_to_shed_paths = defaultdict(set)
+    paths_and_keys = []
+    for path, target in paths_and_targets:
+      if prefixes and self._prefix_rank(path, prefixes) == len(prefixes):
+        continue
+      shed_path = self._git_repo.relpath(os.path.join(os.path.dirname(path), target))
+      if shed_path.startswith(self._shed_relpath):
+        key = self._get_key_from_versioned_path(shed_path)
+        key_to_shed_paths[key].add(shed_path)
+        paths_and_keys.append((path, key))
+
+    with temporary_dir() as tmpdir:
+      entries = []
+      key_to_fetch_path = {}
+      for key, shed_paths in sorted(key_to_shed_paths.items()):
+        synced = [shed_path for shed_path in sorted(shed_paths) if os.path.exists(shed_path)]
+        if synced:
+          content_path = synced[0]
+        else:
+          content_path = key_to_fetch_path[key] = os.path.join(tmpdir, key)
+        entries.append((key, content_path, shed_paths))
+      if key_to_fetch_path:
+        self.content_store.note_paths(paths_and_keys)
+        self.content_store.get(dict((key, [path]) for key, path in key_to_fetch_path.items()))
+      total_size = write_bundle(bundle_path, entries)
+    out.write('Bundled {0} files ({1} bytes) into {2}.\n'.format(len(entries), total_size, bundle_path))
+    return len(entries)
+
+  def apply_bundle(self, bundle_path, out=None):
+    """Unpacks the content in a bundle written by create_bundle() into the shed.
+
+    Content is verified against its key before it becomes visible in the shed. Content that's
+    already in the shed is skipped.
+
+    :param bundle_path: The bundle to apply.
+    :param out: Write a summary to this stream. Defaults to stdout.
+    :returns: The number of shed files written.
+    """
+    from gitshed.bundle import open_bundle
+
+    out = out or sys.stdout
+    num_written = 0
+    num_skipped = 0
+    with open_bundle(bundle_path) as (index, entries):
+      for key, infile in entries:
+        shed_paths = [self._validate_bundled_shed_path(shed_path, key) for shed_path in index[key]['shed_paths']]
+        unsynced = [shed_path for shed_path in shed_paths if not os.path.exists(shed_path)]
+        num_skipped += len(shed_paths) - len(unsynced)
+        if not unsynced:
+          continue
+        for shed_path in unsynced:
+          safe_makedirs(os.path.dirname(shed_path))
+        tmp_path = '{0}.tmp'.format(unsynced[-1])
+        try:
+          with open(tmp_path, 'wb') as outfile:
+            shutil.copyfileobj(infile, outfile, IO_BUFFER_SIZE)
+          actual_sha = ContentStore.fingerprint_for_key(tmp_path, key)
+          if actual_sha != ContentStore.sha_from_key(key):
+            raise GitShedError('Content sha mismatch for {0} in bundle {1}! Expected {2} but got {3}.'.format(
+              key, bundle_path, ContentStore.sha_from_key(key), actual_sha))
+          os.chmod(tmp_path, int(ContentStore.mode_from_key(key), 8))
+          for shed_path in unsynced[:-1]:
+            copy_file(tmp_path, shed_path)
+          os.rename(tmp_path, unsynced[-1])
+        finally:
+          if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        num_written += len(unsynced)
+    out.write('Applied {0} files from {1}. {2} were already in the shed.\n'.format(
+      num_written, bundle_path, num_skipped))
+    return num_written
+
+  def _validate_bundled_shed_path(self, shed_path, key):
+    """Checks that a shed path read from a bundle is a path for the key in this shed, and returns it.
+
+    Bundles may come from anywhere, so they mustn't be able to write anywhere else.
+    """
+    if (os.path.isabs(shed_path) or self._git_repo.relpath(shed_path) != shed_path or
+        not shed_path.startswith(self._shed_relpath + os.sep) or
+        self._get_key_from_versioned_path(shed_path) != key):
+      raise GitShedError('Invalid shed path for {0} in bundle: {1}'.format(key, shed_path))
+    return shed_path
+
+  def record_metrics(self, prometheus_textfile=None):
+    """Appends the metrics recorded so far by this invocation to the metrics log in the state dir.
+
+    Also adds them to the running totals that `git shed stats` summarizes.
+
+    :param prometheus_textfile: If specified, also write the totals over all invocations to this file,
+                                in the Prometheus text format (e.g., for the node exporter's textfile
+                                collector).
+    """
+    from gitshed.metrics import record_invocation
+
+    record_invocation(self._state_path('metrics.jsonl'), self._state_path('metrics_totals.json'),
+                      metrics.record(), prometheus_textfile=prometheus_textfile)
+
+  def stats(self, command=None, out=sys.stdout):
+    """Summarizes the metrics recorded by past invocations.
+
+    :param command: If specified, only summarize invocations of this command.
+    :param out: Write the summary to this stream.
+    """
+    from gitshed.metrics import BUCKETS, merge, percentile, read_totals
+
+    totals_by_command = read_totals(os.path.join(self._state_relpath, 'metrics_totals.json')) or {}
+    if command:
+      totals_by_command = {command: totals_by_command[command]} if command in totals_by_command else {}
+    if not totals_by_command:
+      out.write('No metrics recorded. To record them, set "metrics" in the config.\n')
+      return
+    totals = merge(totals_by_command.values())
+    counters = totals['counters']
+
+    def count(name, **labels):
+      return counters.get(metric_name(name, **labels), 0)
+
+    def rate(numerator, denominator):
+      return '{0:.1f}%'.format(100.0 * numerator / denominator)
+
+    def latency(histogram, q):
+      bound = percentile(histogram, q)
+      return '<={0}s'.format(bound) if bound is not None else '>{0}s'.format(BUCKETS[-1])
+
+    invocations = ', '.join('{0} {1}'.format(n, c or '(none)') for c, n in sorted(totals['invocations'].items()))
+    out.write('{0} invocations ({1}), taking {2:.1f}s in total. {3} failed.\n'.format(
+      sum(totals['invocations'].values()), invocations, totals['duration_seconds'], counters.get('command_errors', 0)))
+    for name, what in [('sync_files', 'files to sync were already synced'),
+                       ('manifest_lookups', 'manifest lookups found the key')]:
+      hits, misses = count(name, result='hit'), count(name, result='miss')
+      if hits + misses:
+        out.write('{0} of {1} {2}.\n'.format(rate(hits, hits + misses), hits + misses, what))
+    for op, verb in [('get', 'Fetched'), ('put', 'Stored')]:
+      if count('keys', op=op):
+        out.write('{0} {1} keys ({2} bytes).\n'.format(verb, count('keys', op=op), count('bytes', op=op)))
+    for name, value in sorted(counters.items()):
+      if name.startswith('tier_hits'):
+        out.write('{0}: {1} keys.\n'.format(name, value))
+
+    out.write('Latencies (p50, p90, p99):\n')
+    for name, histogram in sorted(totals['histograms'].items()):
+      line = '  {0}: {1}, {2}, {3} over {4} samples'.format(
+        name, latency(histogram, 0.5), latency(histogram, 0.9), latency(histogram, 0.99), histogram['count'])
+      if name.startswith('chunk_seconds'):
+        failures = counters.get(name.replace('chunk_seconds', 'chunk_failures', 1), 0)
+        line += ', of which {0} failed'.format(rate(failures, histogram['count']))
+      out.write(line + '.\n')
+
+  def _state_path(self, name):
+    """Returns the path of an entry in the local state dir, creating the dir if necessary.
+
+    The state dir ignores itself, so it needn't be added to the repo's .gitignore.
+
+    :param name: The name of the entry.
+    """
+    if not os.path.isdir(self._state_relpath):
+      safe_makedirs(self._state_relpath)
+      with open(os.path.join(self._state_relpath, '.gitignore'), 'w') as outfile:
+        outfile.write('*\n')
+    return os.path.join(self._state_relpath, name)
+
+  def _iter_shed_files(self):
+    """Yields the paths of all files in the shed, relative to the repo root."""
+    for dirpath, _, filenames in os.walk(self._shed_relpath):
+      for filename in filenames:
+        yield os.path.join(dirpath, filename)
+
+  def _prune_empty_shed_dirs(self, path):
+    """Removes path and its parents, up to but not including the shed root, while they're empty."""
+    while path != self._shed_relpath and path.startswith(self._shed_relpath):
+      try:
+        os.rmdir(path)
+      except OSError:
+        return  # Not empty.
+      path = os.path.dirname(path)
 
   def _get_gitshed_path(self, path):
     """If path is a symlink into the gitshed, returns the path it links to, relative to the repo root.
@@ -321,13 +1355,16 @@ class GitShed(object):
     return key
 
   def _generate_find_command(self):
-    """Constructs a UNIX 'find' command line suitable for use by _find_all_symlinks.
+    """Constructs a UNIX 'find' command line suitable for use by _iter_all_symlinks.
 
     See `man find` for further information.
     """
-    # Only look for symlinks into the shed.
-    # E.g., -lname "*.gitshed/files/*"
-    shed_predicate  = '-lname "{shed_relpath}"'.format(shed_relpath=os.path.join('*', self._shed_relpath, '*'))
+    # Only look for symlinks into the shed. Symlinks in the repo root point directly into it,
+    # and all others point into it via some parent dir.
+    # E.g., \( -lname ".gitshed/files/*" -o -lname "*/.gitshed/files/*" \)
+    shed_predicate = '\\( -lname "{root_shed_relpath}" -o -lname "{shed_relpath}" \\)'.format(
+      root_shed_relpath=os.path.join(self._shed_relpath, '*'),
+      shed_relpath=os.path.join('*', self._shed_relpath, '*'))
 
     # Don't descend into the directories we've excluded. This isn't required for correctness,
     # as presumably these directories won't contain symlinks into the shed. But it improves
@@ -341,41 +1378,35 @@ class GitShed(object):
     # Put it all together.
     # E.g.,
     #
-    # find . \( -path "./.pants.d" -o -path "./.pants.bootstrap" \) -prune -o -lname "*/.gitshed/files/*" -print
+    # find . \( -path "./.pants.d" -o -path "./.pants.bootstrap" \) -prune -o \
+    #   \( -lname ".gitshed/files/*" -o -lname "*/.gitshed/files/*" \) -print0
     #
     # Read this as: find from the cwd, prune these paths from the search tree, and print any
-    # symlinks whose targets match this pattern.
-    cmd_str = 'find . \( {prune_paths} \) -prune -o {print_paths} -print'.format(
+    # symlinks whose targets match this pattern, NUL-terminated (as paths may contain newlines).
+    cmd_str = 'find . \( {prune_paths} \) -prune -o {print_paths} -print0'.format(
       prune_paths=exclude_predicate,
       print_paths=shed_predicate)
 
     return cmd_str
 
-  def _find_all_symlinks(self):
-    """Finds all symlinks in the repo that point to files in the shed.
+  def _iter_all_symlinks(self):
+    """Lazily finds all symlinks in the repo that point to files in the shed.
 
     These correspond to all the files managed by gitshed.
     """
-    cmd_str = self._generate_find_command()
-
-    # Actually run the cmd.
-    retcode, stdout, stderr = run_cmd_str(cmd_str)
-    if retcode:
-      raise GitShedError('Command failed: {0}.\nstderr: {1}'.format(cmd_str, stderr))
-    return filter(None, stdout.split('\n'))
-
-  def _find_broken_symlinks(self, all_symlinks):
-    """Detects broken symlinks.
-
-    These correspond to all the unsynced files managed by gitshed.
-
-    :param all_symlinks: Detect from among these symlinks.
-    """
-    broken_symlinks = []
-    for symlink in all_symlinks:
-      if not os.path.exists(symlink):  # Returns False for broken symlinks.
-        broken_symlinks.append(symlink)
-    return broken_symlinks
+    # Only the time spent finding symlinks counts, not the time the caller spends between them.
+    symlinks = iter_cmd_output(self._generate_find_command(), b'\0')
+    elapsed = 0.0
+    try:
+      while True:
+        start = time.time()
+        symlink = next(symlinks, None)
+        elapsed += time.time() - start
+        if symlink is None:
+          return
+        yield symlink
+    finally:
+      metrics.observe('symlink_scan_seconds', elapsed)
 
   def _is_managed(self, relpath):
     """Is a path a symlink into the shed?
@@ -3,26 +3,53 @@
 from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
                         print_function, unicode_literals)
 
+import errno
 import os
 import shutil
+import threading
 
 from gitshed.content_store import ContentStore
-from gitshed.util import safe_makedirs
+from gitshed.error import GitShedError
+from gitshed.metrics import metric_name, metrics
+from gitshed.util import copy_file, safe_makedirs
 
 
 class LocalContentStore(ContentStore):
   """A ContentStore on the local filesystem.
 
-  Useful for testing.
+  Useful for testing, and for content stores on a shared mount (e.g., NFS).
+
+  In direct mode, gets don't copy content into the shed. Instead, each shed entry is linked to
+  the content store's object: hard linked if the two are on the same filesystem, symlinked if not.
+  Syncing then costs only metadata operations (plus reading the content, if it's verified).
+  The linked objects must not be modified, so direct mode is suitable only for content stores that
+  are never written to other than by puts.
   """
-  def __init__(self, root, chunk_size=20, get_concurrency=None, put_concurrency=None):
+  def __init__(self, root, chunk_size=20, get_concurrency=None, put_concurrency=None,
+               direct=False, verify=True):
+    """
+    :param root: The directory to store content in.
+    :param direct: If True, link shed entries to content store objects, instead of copying them.
+    :param verify: If True, verify content before linking to it in direct mode. Content is always
+                   verified when copied.
+    """
     super(LocalContentStore, self).__init__(chunk_size, get_concurrency, put_concurrency)
     self._root = root
+    self._direct = direct
+    self._verify = verify
 
   def raw_get(self, content_store_paths, target_dir_tmp):
+    missing = []
     for path in content_store_paths:
+      full_path = self._get_full_content_store_path(path)
+      if not os.path.isfile(full_path):
+        missing.append(path)
+        continue
       target_path_tmp = os.path.join(target_dir_tmp, os.path.basename(path))
-      shutil.copy(self._get_full_content_store_path(path), target_path_tmp)
+      copy_file(full_path, target_path_tmp)
+    if missing:
+      # We fetch everything we can first, so that raw_get_partial() works precisely.
+      raise GitShedError('Content not found in {0}: {1}'.format(self._root, ', '.join(missing)))
 
   def raw_put(self, src_paths, content_store_dir):
     for src_path in src_paths:
@@ -32,6 +59,63 @@ class LocalContentStore(ContentStore):
   def raw_has(self, content_store_path):
     return os.path.isfile(self._get_full_content_store_path(content_store_path))
 
+  def raw_sizes(self, content_store_paths):
+    ret = {}
+    for path in content_store_paths:
+      full_path = self._get_full_content_store_path(path)
+      if os.path.isfile(full_path):
+        ret[path] = os.path.getsize(full_path)
+    return ret
+
+  def raw_list(self, content_store_dir):
+    full_dir = self._get_full_content_store_path(content_store_dir)
+    if not os.path.isdir(full_dir):
+      return []
+    return [name for name in os.listdir(full_dir) if not name.endswith('.tmp')]
+
+  def _get_chunk(self, key_to_target_paths):
+    if not self._direct:
+      return super(LocalContentStore, self)._get_chunk(key_to_target_paths)
+    missing = []
+    to_copy = {}
+    for key, target_paths in key_to_target_paths.items():
+      full_paths = [self._get_full_content_store_path(cs_path)
+                    for cs_path in self._content_store_paths_for_key(key)]
+      full_path = next((p for p in full_paths if os.path.isfile(p)), None)
+      if full_path is None:
+        missing.append(key)
+        continue
+      if self.mode(full_path) != self.mode_from_key(key):
+        # Content stored under its sha, with some other mode. A link would have the wrong mode.
+        to_copy[key] = target_paths
+        continue
+      if self._verify:
+        self.verify_content(full_path, key)
+      for target_path in target_paths:
+        self._link(full_path, target_path)
+      metrics.increment(metric_name('keys', op='get'))
+    if missing:
+      raise GitShedError('Content not found in {0}: {1}'.format(self._root, ', '.join(missing)))
+    if to_copy:
+      super(LocalContentStore, self)._get_chunk(to_copy)
+
+  @staticmethod
+  def _link(full_path, target_path):
+    """Links target_path to the content store object at full_path, replacing target_path atomically."""
+    safe_makedirs(os.path.dirname(target_path))
+    tmp_path = '{0}.{1}.{2}.tmp'.format(target_path, os.getpid(), threading.current_thread().ident)
+    try:
+      os.link(full_path, tmp_path)
+      kind = 'hardlink'
+    except OSError as e:
+      # Across filesystems, or on a filesystem that doesn't support hard links.
+      if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+        raise
+      os.symlink(os.path.abspath(full_path), tmp_path)
+      kind = 'symlink'
+    os.rename(tmp_path, target_path)
+    metrics.increment(metric_name('direct_links', kind=kind))
+
   def _get_full_content_store_path(self, path):
     """Converts a logical content_store path to the filesytem path for the content."""
     if os.path.sep != '/':
@@ -42,6 +126,7 @@ class LocalContentStore(ContentStore):
   def _safe_copy(cls, src, dest):
     """Copies the file at src to dest atomically."""
     safe_makedirs(os.path.dirname(dest))
-    tmp_dest = dest + '.tmp'
-    shutil.copy(src, tmp_dest)
+    # Concurrent puts may write the same dest, e.g., different keys with the same deduped content.
+    tmp_dest = '{0}.{1}.{2}.tmp'.format(dest, os.getpid(), threading.current_thread().ident)
+    copy_file(src, tmp_dest)
     shutil.move(tmp_dest, dest)
@@ -0,0 +1,91 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+import errno
+import fcntl
+import os
+
+from gitshed.util import safe_makedirs
+
+
+class KeyLocks(object):
+  """Advisory locks on keys, shared by all the gitshed processes working in a repo.
+
+  Each held lock is a file, named for its key, in the lock dir. So the lock dir also serves as a
+  registry of the keys whose content is being worked on. A lock's file is removed when it's
+  released, so the registry doesn't grow without bound.
+
+  The locks are released if the process holding them exits, however it exits.
+
+  Not thread-safe.
+  """
+
+  def __init__(self, lock_dir):
+    """
+    :param lock_dir: The directory to keep lock files in.
+    """
+    self._lock_dir = lock_dir
+    self._held = {}  # Key -> file descriptor of its lock file.
+
+  def try_acquire(self, key):
+    """Acquires the lock on a key, if no other process holds it.
+
+    :returns: Whether the lock was acquired.
+    """
+    return self._lock(key, blocking=False)
+
+  def acquire(self, key):
+    """Acquires the lock on a key, waiting for any other process holding it to release it.
+
+    To avoid deadlock, callers that hold locks while waiting for more must acquire them in a
+    consistent order (e.g., sorted by key).
+    """
+    self._lock(key, blocking=True)
+
+  def release(self, key):
+    """Releases the lock on a key."""
+    fd = self._held.pop(key)
+    # Remove the file while we still hold the lock, so that no other process can acquire the lock on
+    # it after we release it. Processes waiting on it notice that it was removed, and retry.
+    os.unlink(self._lock_path(key))
+    os.close(fd)
+
+  def release_all(self):
+    """Releases all the locks held."""
+    for key in list(self._held.keys()):
+      self.release(key)
+
+  @property
+  def held(self):
+    """The keys whose locks are held."""
+    return set(self._held.keys())
+
+  def _lock_path(self, key):
+    return os.path.join(self._lock_dir, key)
+
+  def _lock(self, key, blocking):
+    if key in self._held:
+      raise ValueError('Lock on {0} is already held.'.format(key))
+    safe_makedirs(self._lock_dir)
+    path = self._lock_path(key)
+    while True:
+      fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except IOError as e:
+        os.close(fd)
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+          return False
+        raise
+      # If the previous holder removed the file before we locked it, we hold a lock that no one
+      # else will ever see, so we try again.
+      try:
+        is_current = os.stat(path).st_ino == os.fstat(fd).st_ino
+      except OSError:
+        is_current = False
+      if is_current:
+        self._held[key] = fd
+        return True
+      os.close(fd)
@@ -0,0 +1,143 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+from bisect import bisect_left
+import os
+import threading
+import time
+import uuid
+
+from gitshed.util import safe_makedirs, temporary_dir
+
+
+class KeyManifest(object):
+  """An append-only manifest of the keys in a content store, cached locally.
+
+  Checking whether a content store has some content usually costs a round trip to it (and, for
+  some content stores, a download). Instead, each put records the keys it wrote in a new segment
+  of the manifest, which lives in the content store itself. Clients fetch just the segments they
+  haven't seen yet, and cache the union of their keys locally, in a sorted key index.
+
+  Content is never deleted from a content store, so a key in the manifest is definitely in the
+  content store. A key that isn't in the manifest may still be in the content store (e.g., if it
+  was put by a client that doesn't maintain the manifest), unless the manifest is complete.
+
+  Safe to use from multiple threads.
+  """
+
+  # The manifest segments live in this dir in the content store.
+  MANIFEST_DIR = 'manifest'
+
+  def __init__(self, content_store, cache_dir, complete=False):
+    """
+    :param content_store: The ContentStore whose keys to track.
+    :param cache_dir: Cache the manifest in this local dir.
+    :param complete: Whether the manifest is known to contain every key in the content store,
+                     e.g., because it was rebuilt after the last put by a client that doesn't
+                     maintain it.
+    """
+    self._content_store = content_store
+    self._cache_dir = cache_dir
+    self._complete = complete
+    self._keys = None  # Sorted list of keys, loaded lazily.
+    self._seen_segments = None  # Set of names of segments whose keys are in self._keys.
+    self._lock = threading.Lock()
+
+  @property
+  def is_complete(self):
+    return self._complete
+
+  def contains(self, key):
+    """Checks whether a key is in the manifest.
+
+    Fetches any new manifest segments on first use.
+
+    :param key: The key to look for.
+    """
+    with self._lock:
+      if self._keys is None:
+        self._refresh()
+      i = bisect_left(self._keys, key)
+      return i < len(self._keys) and self._keys[i] == key
+
+  def refresh(self):
+    """Fetches any manifest segments that aren't in the local cache."""
+    with self._lock:
+      self._refresh()
+
+  def record(self, keys):
+    """Records keys that were just put into the content store.
+
+    :param keys: The keys to record.
+    """
+    keys = sorted(set(keys))
+    if not keys:
+      return
+    # Time-prefixed names make segments sort roughly in the order they were written.
+    segment = '{0:013d}-{1}'.format(int(time.time() * 1000), uuid.uuid4().hex)
+    with temporary_dir() as tmpdir:
+      segment_path = os.path.join(tmpdir, segment)
+      self._write_lines(segment_path, keys)
+      self._content_store.raw_put([segment_path], self.MANIFEST_DIR)
+    with self._lock:
+      self._load()
+      self._merge(keys, [segment])
+
+  def rebuild(self):
+    """Records every key in the content store in a single new segment.
+
+    After a rebuild, the manifest is complete until the next put by a client that doesn't
+    maintain it.
+    """
+    cs_dir = self._content_store.content_store_path_from_key('').rpartition('/')[0]
+    # Content stored under its sha alone (see ContentStore.use_dedupe()) is recorded by its sha.
+    keys = [name for name in self._content_store.raw_list(cs_dir)
+            if self._content_store.is_valid_key(name) or self._content_store.is_valid_sha(name)]
+    self.record(keys)
+    return len(keys)
+
+  def _refresh(self):
+    self._load()
+    new_segments = sorted(set(self._content_store.raw_list(self.MANIFEST_DIR)) - self._seen_segments)
+    if not new_segments:
+      return
+    new_keys = []
+    with temporary_dir() as tmpdir:
+      self._content_store.raw_get(['{0}/{1}'.format(self.MANIFEST_DIR, s) for s in new_segments], tmpdir)
+      for segment in new_segments:
+        new_keys.extend(self._read_lines(os.path.join(tmpdir, segment)))
+    self._merge(new_keys, new_segments)
+
+  def _load(self):
+    if self._keys is None:
+      self._keys = self._read_lines(os.path.join(self._cache_dir, 'keys'))
+      self._seen_segments = set(self._read_lines(os.path.join(self._cache_dir, 'segments')))
+
+  def _merge(self, keys, segments):
+    self._keys = sorted(set(self._keys).union(keys))
+    self._seen_segments.update(segments)
+    safe_makedirs(self._cache_dir)
+    # Write the keys first: if we're interrupted, we'll just refetch the segments next time.
+    self._write_lines(os.path.join(self._cache_dir, 'keys'), self._keys)
+    self._write_lines(os.path.join(self._cache_dir, 'segments'), sorted(self._seen_segments))
+
+  @staticmethod
+  def _read_lines(path):
+    try:
+      with open(path, 'r') as infile:
+        return infile.read().split()
+    except IOError:
+      return []
+
+  @staticmethod
+  def _write_lines(path, lines):
+    """Writes lines to a file atomically."""
+    # Other threads and processes may be writing the same file.
+    tmp_path = '{0}.{1}.{2}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+    with open(tmp_path, 'w') as outfile:
+      for line in lines:
+        outfile.write(line)
+        outfile.write('\n')
+    os.rename(tmp_path, path)
@@ -0,0 +1,288 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+from collections import defaultdict
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import threading
+import time
+
+from gitshed.util import safe_makedirs
+
+
+# Latency histograms count observations into buckets with these upper bounds (in seconds), plus an
+# overflow bucket. Unlike raw percentiles, bucket counts can be summed across invocations.
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0]
+
+
+def metric_name(name, **labels):
+  """Returns the name of a metric with labels, in Prometheus syntax, e.g., bytes{op="get"}.
+
+  :param name: The metric's base name.
+  :param labels: The metric's labels.
+  """
+  if not labels:
+    return name
+  return '{0}{{{1}}}'.format(name, ','.join('{0}="{1}"'.format(k, v) for k, v in sorted(labels.items())))
+
+
+class Metrics(object):
+  """Counters and latency histograms for a single invocation of gitshed.
+
+  Safe to use from multiple threads.
+  """
+
+  def __init__(self, clock=time.time):
+    """
+    :param clock: A no-arg function returning the current time in seconds.
+    """
+    self._clock = clock
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    """Discards everything recorded so far, and restarts the invocation's clock."""
+    with self._lock:
+      self.command = None
+      self._start = self._clock()
+      self._counters = defaultdict(int)
+      self._histograms = {}
+
+  def increment(self, name, amount=1):
+    """Adds to a counter.
+
+    :param name: The counter's name, as returned by metric_name().
+    :param amount: The amount to add.
+    """
+    with self._lock:
+      self._counters[name] += amount
+
+  def observe(self, name, seconds):
+    """Records a latency.
+
+    :param name: The histogram's name, as returned by metric_name().
+    :param seconds: The latency to record.
+    """
+    with self._lock:
+      histogram = self._histograms.get(name)
+      if histogram is None:
+        histogram = self._histograms[name] = {'count': 0, 'sum': 0.0, 'buckets': [0] * (len(BUCKETS) + 1)}
+      histogram['count'] += 1
+      histogram['sum'] += seconds
+      histogram['buckets'][_bucket_index(seconds)] += 1
+
+  @contextmanager
+  def timer(self, name):
+    """A context that records how long it takes, whether or not it succeeds."""
+    start = self._clock()
+    try:
+      yield
+    finally:
+      self.observe(name, self._clock() - start)
+
+  def record(self):
+    """Returns everything recorded so far, as a JSON-serializable dict."""
+    with self._lock:
+      return {
+        'time': self._start,
+        'command': self.command,
+        'duration_seconds': self._clock() - self._start,
+        'counters': dict(self._counters),
+        'histograms': json.loads(json.dumps(self._histograms)),  # A deep copy.
+      }
+
+
+# The metrics for this invocation.
+metrics = Metrics()
+
+
+def _bucket_index(seconds):
+  for i, bound in enumerate(BUCKETS):
+    if seconds <= bound:
+      return i
+  return len(BUCKETS)
+
+
+def merge(records):
+  """Sums metrics across invocations.
+
+  :param records: An iterable of dicts, as returned by Metrics.record() or by merge() itself.
+  :returns: A dict of 'invocations' (a map of command -> count), 'duration_seconds', 'counters'
+            and 'histograms'.
+  """
+  invocations = defaultdict(int)
+  duration = 0.0
+  counters = defaultdict(int)
+  histograms = {}
+  for record in records:
+    if 'invocations' in record:
+      for command, count in record['invocations'].items():
+        invocations[command] += count
+    else:
+      invocations[record['command'] or ''] += 1
+    duration += record['duration_seconds']
+    for name, value in record['counters'].items():
+      counters[name] += value
+    for name, histogram in record['histograms'].items():
+      total = histograms.setdefault(name, {'count': 0, 'sum': 0.0, 'buckets': [0] * (len(BUCKETS) + 1)})
+      total['count'] += histogram['count']
+      total['sum'] += histogram['sum']
+      total['buckets'] = [a + b for a, b in zip(total['buckets'], histogram['buckets'])]
+  return {
+    'invocations': dict(invocations),
+    'duration_seconds': duration,
+    'counters': dict(counters),
+    'histograms': histograms,
+  }
+
+
+def percentile(histogram, q):
+  """Estimates a percentile of a latency histogram.
+
+  :param histogram: A histogram, as recorded by Metrics.observe().
+  :param q: The percentile to estimate, between 0 and 1.
+  :returns: The upper bound of the bucket containing the percentile, or None if it's in the
+            overflow bucket.
+  """
+  target = q * histogram['count']
+  cumulative = 0
+  for bound, count in zip(BUCKETS, histogram['buckets']):
+    cumulative += count
+    if cumulative >= target:
+      return bound
+  return None
+
+
+def append_record(path, record):
+  """Appends a record to a JSON lines file."""
+  safe_makedirs(os.path.dirname(path))
+  with open(path, 'a') as outfile:
+    outfile.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def read_records(path):
+  """Reads the records in a JSON lines file written by append_record().
+
+  Lines that can't be parsed (e.g., because a write was interrupted) are skipped.
+  """
+  records = []
+  try:
+    with open(path, 'r') as infile:
+      for line in infile:
+        try:
+          records.append(json.loads(line))
+        except ValueError:
+          pass
+  except IOError:
+    pass
+  return records
+
+
+# Rotate the metrics log when it grows past this size, keeping just the previous log, as <log>.1.
+MAX_LOG_SIZE = 16 * 1024 * 1024
+
+
+def record_invocation(log_path, totals_path, record, prometheus_textfile=None, max_log_size=MAX_LOG_SIZE):
+  """Appends an invocation's record to the metrics log, and adds it to the running totals.
+
+  The totals are kept per command, so that summarizing past invocations needn't read the log. Both
+  files are updated under a lock, and the totals are replaced atomically, so this is safe to call
+  from multiple processes at once.
+
+  :param log_path: The metrics log, a JSON lines file.
+  :param totals_path: The file to keep the totals in.
+  :param record: The record, as returned by Metrics.record().
+  :param prometheus_textfile: If specified, also write the totals over all commands to this file,
+                              with write_prometheus_textfile().
+  :param max_log_size: Rotate the log when it grows past this size.
+  :returns: The updated totals, as returned by read_totals().
+  """
+  safe_makedirs(os.path.dirname(totals_path))
+  with open('{0}.lock'.format(totals_path), 'a') as lock_file:
+    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    totals = read_totals(totals_path)
+    if totals is None:
+      # No totals were kept before this log was started, so rebuild them from it.
+      totals = {}
+      for old_record in read_records('{0}.1'.format(log_path)) + read_records(log_path):
+        _add_to_totals(totals, old_record)
+    _add_to_totals(totals, record)
+    if os.path.isfile(log_path) and os.path.getsize(log_path) >= max_log_size:
+      os.rename(log_path, '{0}.1'.format(log_path))
+    append_record(log_path, record)
+    tmp_path = '{0}.tmp'.format(totals_path)
+    with open(tmp_path, 'w') as outfile:
+      json.dump({'commands': totals}, outfile)
+    os.rename(tmp_path, totals_path)
+    if prometheus_textfile:
+      write_prometheus_textfile(prometheus_textfile, merge(totals.values()))
+  return totals
+
+
+def read_totals(totals_path):
+  """Reads the totals written by record_invocation().
+
+  :returns: A map of command -> totals for that command, as returned by merge(), or None if there
+            are no totals.
+  """
+  try:
+    with open(totals_path, 'r') as infile:
+      return json.load(infile)['commands']
+  except (IOError, ValueError, KeyError, TypeError):
+    return None
+
+
+def _add_to_totals(totals, record):
+  command = record['command'] or ''
+  totals[command] = merge([totals[command], record] if command in totals else [record])
+
+
+def _split_name(name):
+  """Splits a metric name into its base name and its labels (without braces)."""
+  base, _, labels = name.partition('{')
+  return base, labels.rstrip('}')
+
+
+def write_prometheus_textfile(path, totals):
+  """Writes metrics totals in the Prometheus text format, atomically, for the node exporter's textfile collector.
+
+  :param path: The file to write.
+  :param totals: Metrics totals, as returned by merge().
+  """
+  lines = ['# TYPE gitshed_invocations_total counter']
+  for command, count in sorted(totals['invocations'].items()):
+    lines.append('gitshed_invocations_total{{command="{0}"}} {1}'.format(command, count))
+  lines.append('# TYPE gitshed_duration_seconds_total counter')
+  lines.append('gitshed_duration_seconds_total {0}'.format(totals['duration_seconds']))
+
+  typed = set()
+  for name, value in sorted(totals['counters'].items()):
+    base, labels = _split_name(name)
+    if base not in typed:
+      typed.add(base)
+      lines.append('# TYPE gitshed_{0}_total counter'.format(base))
+    lines.append('gitshed_{0}_total{1} {2}'.format(base, '{{{0}}}'.format(labels) if labels else '', value))
+
+  for name, histogram in sorted(totals['histograms'].items()):
+    base, labels = _split_name(name)
+    if base not in typed:
+      typed.add(base)
+      lines.append('# TYPE gitshed_{0} histogram'.format(base))
+    prefix = labels + ',' if labels else ''
+    cumulative = 0
+    for bound, count in zip(BUCKETS + ['+Inf'], histogram['buckets']):
+      cumulative += count
+      lines.append('gitshed_{0}_bucket{{{1}le="{2}"}} {3}'.format(base, prefix, bound, cumulative))
+    suffix = '{{{0}}}'.format(labels) if labels else ''
+    lines.append('gitshed_{0}_sum{1} {2}'.format(base, suffix, histogram['sum']))
+    lines.append('gitshed_{0}_count{1} {2}'.format(base, suffix, histogram['count']))
+
+  # The collector may read the file at any time, so it must never see a partial write.
+  tmp_path = '{0}.tmp'.format(path)
+  with open(tmp_path, 'w') as outfile:
+    outfile.write('\n'.join(lines) + '\n')
+  os.rename(tmp_path, path)
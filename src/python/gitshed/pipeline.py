@@ -0,0 +1,131 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+from Queue import Empty, Queue
+import sys
+import threading
+
+
+class Pipeline(object):
+  """A chain of stages that process a stream of items concurrently.
+
+  Each item moves on to the next stage as soon as the previous stage is done with it, so all the
+  stages work at the same time, and total time approaches that of the slowest stage rather than
+  the sum of all the stages. Stages are connected by bounded queues, so a fast stage can't run
+  arbitrarily far ahead of a slow one.
+
+  If any stage raises an error, no further items are processed, and run() re-raises the error.
+  Items already processed by the final stage are not rolled back.
+  """
+
+  class _Stage(object):
+    def __init__(self, func, concurrency, batch_size):
+      self.func = func
+      self.concurrency = concurrency
+      self.batch_size = batch_size
+      self.queue = Queue(maxsize=2 * concurrency * (batch_size or 1))
+      self.num_running = concurrency
+      self.lock = threading.Lock()
+
+  # Marks the end of the stream of items.
+  _END = object()
+
+  def __init__(self):
+    self._stages = []
+    self._error = None
+    self._error_lock = threading.Lock()
+
+  def add_stage(self, func, concurrency=1, batch_size=None):
+    """Appends a stage to the pipeline.
+
+    :param func: Processes a single item, returning the item to pass on to the next stage, or None
+                 to drop the item. If batch_size is specified, processes a list of items instead,
+                 returning a list of items to pass on.
+    :param concurrency: The number of threads running this stage.
+    :param batch_size: If specified, pass this stage whatever items are waiting for it, up to this
+                       many at once.
+    """
+    self._stages.append(self._Stage(func, concurrency, batch_size))
+    return self
+
+  def run(self, items):
+    """Processes items through all the stages, returning when all are done.
+
+    :param items: An iterable of items to feed into the first stage. Consumed lazily.
+    """
+    threads = []
+    for i, stage in enumerate(self._stages):
+      next_stage = self._stages[i + 1] if i + 1 < len(self._stages) else None
+      for _ in range(stage.concurrency):
+        thread = threading.Thread(target=self._work, args=(stage, next_stage))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    first_stage = self._stages[0]
+    try:
+      for item in items:
+        if self._error:
+          break
+        first_stage.queue.put(item)
+    except Exception:
+      self._set_error(sys.exc_info())
+    for _ in range(first_stage.concurrency):
+      first_stage.queue.put(self._END)
+
+    for thread in threads:
+      # Join with a timeout so that we remain interruptible.
+      while thread.is_alive():
+        thread.join(0.1)
+
+    if self._error:
+      raise self._error[0], self._error[1], self._error[2]
+
+  def _work(self, stage, next_stage):
+    while True:
+      item = stage.queue.get()
+      if item is self._END:
+        break
+      if stage.batch_size:
+        batch = [item]
+        while len(batch) < stage.batch_size:
+          try:
+            item = stage.queue.get_nowait()
+          except Empty:
+            break
+          if item is self._END:
+            break
+          batch.append(item)
+        self._process(stage.func, batch, next_stage, True)
+        if item is self._END:
+          break
+      else:
+        self._process(stage.func, item, next_stage, False)
+
+    # The last worker of this stage to finish signals the end of the stream to the next stage.
+    with stage.lock:
+      stage.num_running -= 1
+      is_last = stage.num_running == 0
+    if is_last and next_stage:
+      for _ in range(next_stage.concurrency):
+        next_stage.queue.put(self._END)
+
+  def _process(self, func, item_or_batch, next_stage, is_batch):
+    if self._error:
+      return  # Just drain the queue, so that upstream stages aren't blocked.
+    try:
+      result = func(item_or_batch)
+    except Exception:
+      self._set_error(sys.exc_info())
+      return
+    if next_stage:
+      for item in ((result or []) if is_batch else [result]):
+        if item is not None:
+          next_stage.queue.put(item)
+
+  def _set_error(self, exc_info):
+    with self._error_lock:
+      if not self._error:
+        self._error = exc_info
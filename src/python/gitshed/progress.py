@@ -15,7 +15,8 @@ class Progress(object):
 
   def __init__(self, total, num_increments=50):
     """
-    :param total: The number of units of work to display progress for.
+    :param total: The number of units of work to display progress for, or None if not known in
+                  advance, in which case only the number of completed units is displayed.
     :param num_increments: The number of increments to display in the progress bar.
                            each one represents (total/num_increments) units of work.
 
@@ -23,17 +24,27 @@ class Progress(object):
     self._completed = 0
     self._total = total
     self._num_increments = num_increments
+    self._lock = threading.Lock()
+
+    if total is None:
+      self._bar_format = '{completed} files'
+      return
     self._increment_size = total / num_increments
 
     # The ascii-art progress bar format.
     # E.g.:
     # 120/200 files [..............................                    ]  60%
     self._bar_format = '{completed:>' + str(len(str(total))) + '}/' + str(total) + ' files [{dots}{spaces}] {pct:>3}%'
-    self._lock = threading.Lock()
 
   def is_complete(self):
     return self._completed == self._total
 
+  def finish(self):
+    """Ends the progress bar's line, if completing the work hasn't already done so."""
+    if not self.is_complete():
+      sys.stderr.write('\n')
+      sys.stderr.flush()
+
   def pct_complete(self):
     return int(100 * self._completed / self._total)
 
@@ -43,7 +54,10 @@ class Progress(object):
     :param n: Number of times to increment.
     """
     with self._lock:
-      if self._completed < self._total:
+      if self._total is None:
+        self._completed += n
+        self.update_bar()
+      elif self._completed < self._total:
         self._completed += min(n, self._total - self._completed)
         self.update_bar()
 
@@ -53,6 +67,10 @@ class Progress(object):
     Note: Unsynchronized.
     """
     sys.stderr.write('\r')
+    if self._total is None:
+      sys.stderr.write(self._bar_format.format(completed=self._completed))
+      sys.stderr.flush()
+      return
     increments_done = int(self._completed / self._increment_size)
     sys.stderr.write(self._bar_format.format(
       completed=self._completed,
@@ -0,0 +1,97 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+import struct
+
+from gitshed.error import GitShedError
+
+
+# The framed protocol spoken between ServedContentStore and `git shed serve`.
+#
+# Every message is a frame: a header of (1-byte type, 4-byte request id, 8-byte payload length),
+# big-endian, followed by the payload. The client may have many requests outstanding on a single
+# session. The server may answer them in any order, and tags each response with the id of the request
+# it answers.
+#
+# Request payloads consist of NUL-terminated UTF-8 fields, followed by raw data, if any:
+#
+# VERSION: protocol version. Answered with the server's protocol version.
+# STAT: any number of content store paths. Answered with (path, size, octal mode) fields for each
+#       path that exists.
+# GET: path, offset, length. Answered with that byte range of the content at path.
+# PUT: upload token, path, octal mode, offset, total size, then data. Writes data at that offset
+#      of the upload identified by the token. When all of an upload's bytes have been written, its
+#      content is atomically moved to path. Answered with the path for the request that completed
+#      the upload, and with no fields otherwise. Tokens are per session, so all of an upload's
+#      requests must be sent on the same session.
+# LIST: a content store dir. Answered with the name of each entry in that dir.
+#
+# Responses are OK (with the payload described above) or ERROR (with a message).
+
+PROTOCOL_VERSION = '2'
+
+VERSION = b'V'
+STAT = b'S'
+GET = b'G'
+PUT = b'P'
+LIST = b'L'
+OK = b'K'
+ERROR = b'E'
+
+_HEADER = struct.Struct(b'>cIQ')
+
+
+def write_frame(outfile, frame_type, request_id, payload=b''):
+  """Writes a single frame. Callers must serialize calls on the same stream."""
+  outfile.write(_HEADER.pack(frame_type, request_id, len(payload)))
+  outfile.write(payload)
+  outfile.flush()
+
+
+def read_frame(infile):
+  """Reads a single frame.
+
+  :returns: A (type, request id, payload) triple, or None at the end of the stream.
+  """
+  header = _read_exactly(infile, _HEADER.size)
+  if header is None:
+    return None
+  frame_type, request_id, length = _HEADER.unpack(header)
+  payload = _read_exactly(infile, length) if length else b''
+  if payload is None:
+    raise GitShedError('Truncated frame.')
+  return frame_type, request_id, payload
+
+
+def _read_exactly(infile, n):
+  data = infile.read(n)
+  if not data:
+    return None
+  while len(data) < n:
+    more = infile.read(n - len(data))
+    if not more:
+      raise GitShedError('Truncated frame.')
+    data += more
+  return data
+
+
+def encode_fields(fields, data=b''):
+  """Encodes text fields, followed by raw data, as a payload."""
+  return b''.join('{0}\0'.format(field).encode('utf-8') for field in fields) + data
+
+
+def decode_fields(payload, num_fields=None):
+  """Decodes a payload encoded by encode_fields().
+
+  :param num_fields: If specified, decode just this many fields, and return the rest of the payload
+                     as raw data. Otherwise decode all the fields in the payload.
+  :returns: The list of fields, or if num_fields is specified a pair of (fields, data).
+  """
+  if num_fields is None:
+    return [field.decode('utf-8') for field in payload.split(b'\0')[:-1]]
+  parts = payload.split(b'\0', num_fields)
+  if len(parts) <= num_fields:
+    raise GitShedError('Malformed payload: expected {0} fields.'.format(num_fields))
+  return [field.decode('utf-8') for field in parts[:num_fields]], parts[num_fields]
@@ -31,6 +31,55 @@ class RSyncedRemoteContentStore(ContentStore):
       _, retcode, _, _ = self._try_raw_get([path], tmpdir)
       return retcode == 0
 
+  def raw_has_many(self, content_store_paths):
+    return set(self._list(content_store_paths).keys())
+
+  def raw_sizes(self, content_store_paths):
+    return self._list(content_store_paths)
+
+  # List at most this many paths per rsync invocation, to stay well within command line length limits.
+  _LIST_BATCH_SIZE = 1000
+
+  def _list(self, content_store_paths):
+    """Lists whichever of the specified content the remote store has, in one rsync per batch of paths.
+
+    :param content_store_paths: List the content at these content store paths.
+    :returns: A map of content store path -> size in bytes, for the paths that exist.
+    """
+    content_store_paths = list(content_store_paths)
+    basename_to_path = dict((os.path.basename(p), p) for p in content_store_paths)
+    ret = {}
+    for i in range(0, len(content_store_paths), self._LIST_BATCH_SIZE):
+      batch = content_store_paths[i:i + self._LIST_BATCH_SIZE]
+      remote_paths = [os.path.join(self._remote_root_path, self.escape(p)) for p in batch]
+      cmd_str = """rsync --list-only {0}:'{1}'""".format(self._host, ' '.join(remote_paths))
+      retcode, stdout, stderr = run_cmd_str(cmd_str)
+      # Exit code 23 means that some of the paths don't exist, which is expected.
+      if retcode not in (0, 23):
+        raise GitShedError('Failed to list {0} on {1}.\ncommand: {2}\nstdout: {3}\nstderr: {4}'.format(
+          batch, self._host, cmd_str, stdout, stderr))
+      for line in stdout.splitlines():
+        # E.g., -r--r--r--          1,234 2015/01/01 12:00:00 0123...cdef_00444
+        fields = line.split(None, 4)
+        if len(fields) == 5 and fields[4] in basename_to_path:
+          ret[basename_to_path[fields[4]]] = int(fields[1].replace(',', ''))
+    return ret
+
+  def raw_list(self, content_store_dir):
+    remote_dir = os.path.join(self._remote_root_path, self.escape(content_store_dir))
+    cmd_str = """rsync --list-only {0}:'{1}/'""".format(self._host, remote_dir)
+    retcode, stdout, stderr = run_cmd_str(cmd_str)
+    # Exit code 23 means that the dir doesn't exist, which just means it has no content yet.
+    if retcode not in (0, 23):
+      raise GitShedError('Failed to list {0} on {1}.\ncommand: {2}\nstdout: {3}\nstderr: {4}'.format(
+        content_store_dir, self._host, cmd_str, stdout, stderr))
+    ret = []
+    for line in stdout.splitlines():
+      fields = line.split(None, 4)
+      if len(fields) == 5 and fields[0].startswith('-'):  # Skip the dir itself.
+        ret.append(fields[4])
+    return ret
+
   def _try_raw_get(self, content_store_paths, target_dir):
     remote_paths = [os.path.join(self._remote_root_path, self.escape(p)) for p in content_store_paths]
     cmd_str = """rsync -acvz {0}:'{1}' "{2}" """.format(self._host, ' '.join(remote_paths), target_dir)
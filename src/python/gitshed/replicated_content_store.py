@@ -0,0 +1,196 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
+from gitshed.content_store import ContentStore
+from gitshed.error import GitShedError
+from gitshed.metrics import metric_name, metrics
+
+
+class ReplicaStats(object):
+  """Recent performance measurements of a single replica.
+
+  Safe to use from multiple threads.
+  """
+
+  # Weight of the newest measurement in the moving average.
+  _ALPHA = 0.3
+
+  # Measurements older than this many seconds no longer reflect the replica's state, so a replica
+  # that hasn't been used recently is probed again.
+  _STALE_SECONDS = 60
+
+  # After a failure, a replica is tried last for this many seconds.
+  _BACKOFF_SECONDS = 30
+
+  def __init__(self, clock=time.time):
+    self._clock = clock
+    self._seconds_per_file = None
+    self._last_measured = None
+    self._failed_at = None
+    self._lock = threading.Lock()
+
+  def record_success(self, seconds, num_files):
+    with self._lock:
+      sample = seconds / num_files
+      if self._seconds_per_file is None or self._is_stale():
+        self._seconds_per_file = sample
+      else:
+        self._seconds_per_file = self._ALPHA * sample + (1 - self._ALPHA) * self._seconds_per_file
+      self._last_measured = self._clock()
+      self._failed_at = None
+
+  def record_failure(self):
+    with self._lock:
+      self._failed_at = self._clock()
+
+  def sort_key(self):
+    """Returns a key that orders replicas from most to least preferred.
+
+    Replicas that failed recently come last. Unmeasured replicas come first, so that they get
+    measured. Otherwise faster replicas come first.
+    """
+    with self._lock:
+      failed_recently = self._failed_at is not None and self._clock() - self._failed_at < self._BACKOFF_SECONDS
+      if self._seconds_per_file is None or self._is_stale():
+        return failed_recently, 0
+      return failed_recently, self._seconds_per_file
+
+  def _is_stale(self):
+    return self._last_measured is None or self._clock() - self._last_measured > self._STALE_SECONDS
+
+
+class ReplicatedContentStore(ContentStore):
+  """Content replicated across multiple content stores, for durability and latency.
+
+  Puts upload to all replicas concurrently, and succeed if at least a quorum of them succeed.
+
+  Gets read from the replica with the best recently measured performance, failing over to the
+  other replicas for any content it can't provide. So one slow or failing replica doesn't stall
+  everyone's syncs.
+  """
+  def __init__(self, replicas, write_quorum=None, chunk_size=20, get_concurrency=None,
+               put_concurrency=None):
+    """
+    :param replicas: The ContentStore instances to replicate across.
+    :param write_quorum: A put succeeds if it succeeds on at least this many replicas.
+                         Defaults to all of them.
+    :param chunk_size: Get/put in chunks of this size.
+    :param get_concurrency: Size of threadpool for gets.
+    :param put_concurrency: Size of threadpool for puts.
+    """
+    super(ReplicatedContentStore, self).__init__(chunk_size, get_concurrency, put_concurrency)
+    self._replicas = replicas
+    self._write_quorum = write_quorum or len(replicas)
+    if not 0 < self._write_quorum <= len(replicas):
+      raise GitShedError('Write quorum of {0} is impossible with {1} replicas.'.format(
+        self._write_quorum, len(replicas)))
+    self._stats = [ReplicaStats() for _ in replicas]
+
+  def note_paths(self, paths_and_keys):
+    paths_and_keys = list(paths_and_keys)
+    for replica in self._replicas:
+      replica.note_paths(paths_and_keys)
+
+  def raw_get(self, content_store_paths, target_dir_tmp):
+    missing = self.raw_get_partial(content_store_paths, target_dir_tmp)
+    if missing:
+      raise GitShedError('Content not found in any replica: {0}'.format(', '.join(missing)))
+
+  def raw_get_partial(self, content_store_paths, target_dir_tmp):
+    missing = list(content_store_paths)
+    for replica, stats in self._replicas_by_preference():
+      if not missing:
+        break
+      start = time.time()
+      still_missing = replica.raw_get_partial(missing, target_dir_tmp)
+      elapsed = time.time() - start
+      replica_index = self._replicas.index(replica)
+      metrics.observe(metric_name('replica_seconds', replica=replica_index, backend=type(replica).__name__),
+                      elapsed)
+      num_fetched = len(missing) - len(still_missing)
+      if num_fetched:
+        stats.record_success(elapsed, num_fetched)
+      if still_missing and self._failed_to_provide(replica, still_missing):
+        stats.record_failure()
+      missing = still_missing
+    return missing
+
+  def raw_put(self, src_paths, content_store_dir):
+    def put_to_replica(replica):
+      try:
+        replica.raw_put(src_paths, content_store_dir)
+        return None
+      except (GitShedError, IOError, OSError) as e:
+        return e
+
+    pool = ThreadPool(len(self._replicas))
+    try:
+      errors = [e for e in pool.map(put_to_replica, self._replicas) if e is not None]
+    finally:
+      pool.close()
+      pool.join()
+    num_succeeded = len(self._replicas) - len(errors)
+    if num_succeeded < self._write_quorum:
+      raise GitShedError('Put succeeded on {0} replicas, but the write quorum is {1}. Errors:\n{2}'.format(
+        num_succeeded, self._write_quorum, '\n'.join(str(e) for e in errors)))
+
+  def raw_has(self, content_store_path):
+    return any(replica.raw_has(content_store_path) for replica, _ in self._replicas_by_preference())
+
+  def raw_has_many(self, content_store_paths):
+    present = set()
+    missing = set(content_store_paths)
+    for replica, _ in self._replicas_by_preference():
+      if not missing:
+        break
+      replica_present = replica.raw_has_many(missing)
+      present.update(replica_present)
+      missing.difference_update(replica_present)
+    return present
+
+  def raw_sizes(self, content_store_paths):
+    # Sizes are only used as a hint, so the first replica that answers will do.
+    for replica, _ in self._replicas_by_preference():
+      try:
+        return replica.raw_sizes(content_store_paths)
+      except (GitShedError, IOError, OSError):
+        pass
+    return {}
+
+  def raw_list(self, content_store_dir):
+    # A put may have reached only a quorum of the replicas, so we need the union of their listings,
+    # and we can only tolerate as many failures as leave us certain to see every put.
+    names = set()
+    errors = []
+    for replica in self._replicas:
+      try:
+        names.update(replica.raw_list(content_store_dir))
+      except (GitShedError, IOError, OSError) as e:
+        errors.append(e)
+    if len(errors) >= self._write_quorum:
+      raise GitShedError('Failed to list {0} on enough replicas. Errors:\n{1}'.format(
+        content_store_dir, '\n'.join(str(e) for e in errors)))
+    return sorted(names)
+
+  @staticmethod
+  def _failed_to_provide(replica, content_store_paths):
+    """Checks whether a replica failed to provide content, rather than just not having it.
+
+    A replica that doesn't have some content (e.g., because a put only reached a quorum) is healthy,
+    and mustn't be tried last because of it.
+    """
+    try:
+      return bool(replica.raw_has_many(content_store_paths))
+    except (GitShedError, IOError, OSError):
+      return True
+
+  def _replicas_by_preference(self):
+    """Returns a list of (replica, stats) pairs, from most to least preferred."""
+    # Sorting is stable, so the configured order breaks ties.
+    return sorted(zip(self._replicas, self._stats), key=lambda pair: pair[1].sort_key())
@@ -3,17 +3,172 @@
 from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
                         print_function, unicode_literals)
 
+import atexit
 import os
+import subprocess
+import tempfile
+import threading
 
 from gitshed.error import GitShedError
 from gitshed.util import run_cmd_str
 
 
+class _Coprocess(object):
+  """A long-lived git process that answers queries written to its stdin.
+
+  The process is started on first use, restarted if it dies, and stopped when the interpreter
+  exits. Queries are answered one at a time, so this is safe to use from multiple threads.
+  """
+
+  def __init__(self, cmd):
+    """
+    :param cmd: The command to run, as a list of args.
+    """
+    self._cmd = cmd
+    self._process = None
+    self._reader = None
+    self._stderr = None
+    self._lock = threading.Lock()
+    self._close_at_exit = False
+
+  def query(self, request, read_response):
+    """Writes a request to the process, and reads its response.
+
+    :param request: The bytes to write to the process's stdin.
+    :param read_response: A function that reads the response from a _Reader of the process's stdout.
+    :returns: The value returned by read_response.
+    :raises GitShedError: If the process fails.
+    """
+    with self._lock:
+      if self._process is None:
+        self._start()
+      process = self._process
+      # Write from another thread, so that neither of us blocks on a full pipe buffer.
+      write_errors = []
+
+      def write():
+        try:
+          process.stdin.write(request)
+          process.stdin.flush()
+        except (IOError, OSError) as e:
+          write_errors.append(e)
+
+      writer = threading.Thread(target=write)
+      writer.daemon = True
+      writer.start()
+      try:
+        response = read_response(self._reader)
+      except EOFError:
+        # The process has exited, so the writer can't block for long.
+        writer.join()
+        stderr = self._stop()
+        raise GitShedError('Command failed: {0}.\nstderr: {1}'.format(' '.join(self._cmd), stderr))
+      writer.join()
+      if write_errors:
+        self._stop()
+        raise GitShedError('Error writing to "{0}": {1}'.format(' '.join(self._cmd), write_errors[0]))
+      return response
+
+  def close(self):
+    """Stops the process, if it's running."""
+    with self._lock:
+      if self._process is not None:
+        self._stop()
+
+  def _start(self):
+    env = dict(os.environ, GIT_FLUSH='1')
+    # Its stderr goes to a file, so that it can never block on a full pipe that we don't read.
+    self._stderr = tempfile.TemporaryFile()
+    try:
+      self._process = subprocess.Popen(self._cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=self._stderr, bufsize=-1, env=env)
+    except OSError as e:
+      self._stderr.close()
+      raise GitShedError('Error running "{0}": {1}'.format(' '.join(self._cmd), str(e)))
+    self._reader = _Reader(self._process.stdout)
+    if not self._close_at_exit:
+      atexit.register(self.close)
+      self._close_at_exit = True
+
+  def _stop(self):
+    """Stops the process, and returns what it wrote to stderr."""
+    process, self._process = self._process, None
+    try:
+      process.stdin.close()
+    except (IOError, OSError):
+      pass  # Anything left in the buffer can't be flushed to an exited process.
+    process.wait()
+    process.stdout.close()
+    self._stderr.seek(0)
+    stderr = self._stderr.read()
+    self._stderr.close()
+    return stderr
+
+
+class _Reader(object):
+  """Reads a process's output in blocks, without waiting for more output than is available."""
+
+  _BLOCK_SIZE = 65536
+
+  def __init__(self, infile):
+    self._fd = infile.fileno()
+    self._buffer = b''
+    self._pos = 0  # The position in the buffer of the first unread byte.
+
+  def read_field(self, delimiter):
+    """Reads bytes up to a delimiter, and returns them without it.
+
+    :raises EOFError: If the output ends first.
+    """
+    while True:
+      end = self._buffer.find(delimiter, self._pos)
+      if end != -1:
+        field = self._buffer[self._pos:end]
+        self._pos = end + len(delimiter)
+        return field
+      self._fill()
+
+  def read_exactly(self, size):
+    """Reads exactly size bytes.
+
+    :raises EOFError: If the output ends first.
+    """
+    chunks = [self._buffer[self._pos:self._pos + size]]
+    self._pos += len(chunks[0])
+    remaining = size - len(chunks[0])
+    while remaining > 0:
+      data = self._read_block()
+      chunks.append(data[:remaining])
+      remaining -= len(chunks[-1])
+      if remaining <= 0:
+        self._buffer, self._pos = data, len(chunks[-1])
+    return b''.join(chunks)
+
+  def _fill(self):
+    """Appends a block to the unread part of the buffer."""
+    self._buffer = self._buffer[self._pos:] + self._read_block()
+    self._pos = 0
+
+  def _read_block(self):
+    data = os.read(self._fd, self._BLOCK_SIZE)
+    if not data:
+      raise EOFError()
+    return data
+
+
+def _encode(path):
+  return path.encode('utf-8') if isinstance(path, unicode) else path
+
+
 class GitRepo(object):
   """A git repo.
 
   The repo root must be the current working directory.
 
+  Questions that may be asked about many paths or objects are answered by long-lived git processes,
+  started on first use, so that each one costs a round trip through a pipe, not a process spawn.
+  Call close() to stop them.
+
   :param root: The root of the git repo.
   :type root: str
   :raises GitShedError: If the repo root is not the CWD.
@@ -23,6 +178,18 @@ class GitRepo(object):
     cwd = os.path.realpath(os.path.normpath(os.getcwd()))
     if self._root != cwd:
       raise GitShedError('Git root {0} is not the current working directory.'.format(root))
+    self._check_ignore = _Coprocess(['git', 'check-ignore', '--stdin', '-z', '--verbose', '--non-matching'])
+    self._cat_file = _Coprocess(['git', 'cat-file', '--batch'])
+    self._cat_file_check = _Coprocess(['git', 'cat-file', '--batch-check'])
+
+  def close(self):
+    """Stops this repo's long-lived git processes.
+
+    They're restarted if they're needed again.
+    """
+    self._check_ignore.close()
+    self._cat_file.close()
+    self._cat_file_check.close()
 
   def relpath(self, path):
     """Resolves path to a relative path under this repo's root.
@@ -57,5 +224,172 @@ class GitRepo(object):
     :returns: Whether `path` is gitignored in this repo.
     :rtype: bool
     """
-    retcode, _, _ = run_cmd_str('git check-ignore -q {0}'.format(path))
-    return retcode == 0
+    return path in self.ignored_paths([path])
+
+  def ignored_paths(self, paths):
+    """Finds the paths that are gitignored in this repo.
+
+    :param paths: The paths to check.
+    :type paths: iterable of str
+    :returns: The subset of `paths` that are gitignored.
+    :rtype: set
+    :raises GitShedError: If the paths can't be checked (e.g., because one is outside the repo).
+    """
+    paths = list(paths)
+    if not paths:
+      return set()
+
+    def read_response(reader):
+      ret = set()
+      for path in paths:
+        # Each path is output as: <source> NUL <linenum> NUL <pattern> NUL <pathname> NUL.
+        # The source, linenum and pattern are empty if no pattern matched the path.
+        reader.read_field(b'\0')
+        reader.read_field(b'\0')
+        pattern = reader.read_field(b'\0')
+        reader.read_field(b'\0')
+        # A matching negated pattern (!pattern) means that the path is not ignored.
+        if pattern and not pattern.startswith(b'!'):
+          ret.add(path)
+      return ret
+
+    return self._check_ignore.query(b''.join(_encode(path) + b'\0' for path in paths), read_response)
+
+  def symlink_targets(self, rev):
+    """Finds all the symlinks in the tree at a revision.
+
+    :param rev: The revision to inspect.
+    :type rev: str
+    :returns: A map of symlink path (relative to this repo's root) -> symlink target.
+    :rtype: dict
+    :raises GitShedError: If the tree can't be read.
+    """
+    cmd_str = 'git ls-tree -r -z --full-tree {0}'.format(rev)
+    retcode, stdout, stderr = run_cmd_str(cmd_str)
+    if retcode:
+      raise GitShedError('Command failed: {0}.\nstderr: {1}'.format(cmd_str, stderr))
+    path_to_blob = {}
+    for entry in filter(None, stdout.split(b'\0')):
+      # Each entry is of the form: <mode> SP <type> SP <object> TAB <path>.
+      info, _, path = entry.partition(b'\t')
+      mode, _, blob = info.split(b' ')
+      if mode == b'120000':
+        path_to_blob[path] = blob
+    blob_to_content = self.read_blobs(set(path_to_blob.values()))
+    return {path: blob_to_content[blob] for path, blob in path_to_blob.items()}
+
+  def has_commit(self, rev):
+    """Checks if a revision refers to a commit in this repo.
+
+    :param rev: The revision to check.
+    :type rev: str
+    :rtype: bool
+    """
+    def read_response(reader):
+      # The output is <sha> SP commit SP <size> LF, or <rev> SP missing LF if rev isn't a commit.
+      return reader.read_field(b'\n').split(b' ')[1:2] == [b'commit']
+
+    return self._cat_file_check.query(b'{0}^{{commit}}\n'.format(_encode(rev)), read_response)
+
+  def hooks_dir(self):
+    """Returns the path of the directory containing this repo's git hooks.
+
+    :rtype: str
+    :raises GitShedError: If the path can't be determined.
+    """
+    cmd_str = 'git rev-parse --git-path hooks'
+    retcode, stdout, stderr = run_cmd_str(cmd_str)
+    if retcode:
+      raise GitShedError('Command failed: {0}.\nstderr: {1}'.format(cmd_str, stderr))
+    return stdout.strip()
+
+  def staged_symlink_targets(self):
+    """Finds the symlinks that are added or modified in the index, relative to HEAD.
+
+    :returns: A map of symlink path (relative to this repo's root) -> symlink target.
+    :rtype: dict
+    :raises GitShedError: If the index can't be read.
+    """
+    cmd_str = 'git diff --cached --raw -z --no-abbrev --no-renames --diff-filter=AMT'
+    retcode, stdout, stderr = run_cmd_str(cmd_str)
+    if retcode:
+      raise GitShedError('Command failed: {0}.\nstderr: {1}'.format(cmd_str, stderr))
+    path_to_blob = dict(self._symlinks_in_raw_diff(stdout))
+    blob_to_content = self.read_blobs(set(path_to_blob.values()))
+    return {path: blob_to_content[blob] for path, blob in path_to_blob.items()}
+
+  def introduced_symlink_targets(self, rev, exclude):
+    """Finds the symlinks added or modified by the commits in a range.
+
+    :param rev: Inspect the commits reachable from this revision...
+    :type rev: str
+    :param exclude: ...but not from any of these revisions (or rev-list arguments, such as
+                    --remotes=origin).
+    :type exclude: list of str
+    :returns: A list of (symlink path, symlink target) pairs. A path may appear more than once,
+              if it was modified by multiple commits.
+    :rtype: list
+    :raises GitShedError: If the commits can't be read.
+    """
+    cmd_str = 'git rev-list {0} --not {1}'.format(rev, ' '.join(exclude))
+    retcode, stdout, stderr = run_cmd_str(cmd_str)
+    if retcode:
+      raise GitShedError('Command failed: {0}.\nstderr: {1}'.format(cmd_str, stderr))
+    commits = stdout.split()
+    if not commits:
+      return []
+    # -m shows the changes in merge commits, relative to each of their parents.
+    cmd_str = 'git diff-tree --stdin -r -m -z --root --no-abbrev --no-renames --no-commit-id --diff-filter=AMT'
+    retcode, stdout, stderr = run_cmd_str(cmd_str, stdin=b''.join(b'{0}\n'.format(c) for c in commits))
+    if retcode:
+      raise GitShedError('Command failed: {0}.\nstderr: {1}'.format(cmd_str, stderr))
+    paths_and_blobs = self._symlinks_in_raw_diff(stdout)
+    blob_to_content = self.read_blobs(set(blob for _, blob in paths_and_blobs))
+    return [(path, blob_to_content[blob]) for path, blob in paths_and_blobs]
+
+  @staticmethod
+  def _symlinks_in_raw_diff(raw_diff):
+    """Finds the symlinks in the post-image of a raw diff, as output by git diff --raw -z --no-renames.
+
+    :returns: A list of (symlink path, blob sha) pairs.
+    """
+    ret = []
+    fields = raw_diff.split(b'\0')
+    # Each entry is of the form: :<old mode> SP <new mode> SP <old sha> SP <new sha> SP <status> NUL <path> NUL.
+    for info, path in zip(fields[0::2], fields[1::2]):
+      _, new_mode, _, new_blob, _ = info.split(b' ')
+      if new_mode == b'120000':
+        ret.append((path, new_blob))
+    return ret
+
+  def read_blobs(self, blobs):
+    """Reads the content of blobs from the object database.
+
+    :param blobs: The shas of the blobs to read.
+    :type blobs: iterable of str
+    :returns: A map of blob sha -> blob content.
+    :rtype: dict
+    :raises GitShedError: If any of the blobs can't be read.
+    """
+    blobs = list(blobs)
+    if not blobs:
+      return {}
+
+    def read_response(reader):
+      ret = {}
+      errors = []
+      for blob in blobs:
+        # Each blob is output as: <sha> SP <type> SP <size> LF <contents> LF,
+        # or as <object> SP missing LF if it can't be read.
+        header = reader.read_field(b'\n').split(b' ')
+        if len(header) != 3:
+          # Keep reading, so that the next query doesn't see the rest of this one's response.
+          errors.append('Failed to read blob {0}: {1}'.format(blob, ' '.join(header)))
+          continue
+        ret[blob] = reader.read_exactly(int(header[2]))
+        reader.read_exactly(1)
+      if errors:
+        raise GitShedError('\n'.join(errors))
+      return ret
+
+    return self._cat_file.query(b''.join(b'{0}\n'.format(b) for b in blobs), read_response)
@@ -0,0 +1,153 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+from collections import defaultdict
+from fnmatch import fnmatch
+import os
+import threading
+
+from gitshed.content_store import ContentStore
+from gitshed.error import GitShedError
+from gitshed.metrics import metric_name, metrics
+
+
+class RoutedContentStore(ContentStore):
+  """Keeps content in one of several named content stores, chosen by the path of the managed file.
+
+  Routes map path globs to store names, and the first route that matches a path wins. Content for
+  paths that no route matches goes to the default store. This allows, e.g., large artifacts to live
+  on cheap bulk storage, while small, frequently-synced files live on a fast store nearby.
+
+  Since keys don't identify paths, callers tell the store which paths the content under some keys
+  belongs to, via note_paths(), before getting or checking for that content. Content is then looked
+  for in its route's store first, and in the others only if it's not there (e.g., because it was
+  managed before the routes changed). Content whose paths are unknown is looked for in the default
+  store first.
+  """
+
+  def __init__(self, stores, routes, default, chunk_size=20, get_concurrency=None, put_concurrency=None):
+    """
+    :param stores: A map of store name -> ContentStore.
+    :param routes: A list of (path globs, store name) pairs, in order of precedence. The globs are
+                   matched against paths relative to the repo root, and * matches across directories.
+    :param default: The name of the store for content whose path matches no route.
+    :param chunk_size: Get/put in chunks of this size.
+    :param get_concurrency: Size of threadpool for gets.
+    :param put_concurrency: Size of threadpool for puts.
+    """
+    super(RoutedContentStore, self).__init__(chunk_size, get_concurrency, put_concurrency)
+    for name in [default] + [name for _, name in routes]:
+      if name not in stores:
+        raise GitShedError('No content store named {0}.'.format(name))
+    # The default store comes first, so content of unknown path is looked for there first.
+    self._names = [default] + sorted(name for name in stores if name != default)
+    self._stores = [stores[name] for name in self._names]
+    self._routes = [(globs, self._names.index(name)) for globs, name in routes]
+    self._key_to_index = {}  # Key -> index of the store that its path routes to.
+    self._lock = threading.Lock()
+
+  @property
+  def stores(self):
+    """A map of store name -> ContentStore."""
+    return dict(zip(self._names, self._stores))
+
+  def store_name_for_path(self, path):
+    """Returns the name of the store that content at a path is routed to."""
+    return self._names[self._index_for_path(path)]
+
+  def note_paths(self, paths_and_keys):
+    paths_and_keys = list(paths_and_keys)
+    routed = []
+    for path, key in paths_and_keys:
+      index = self._index_for_path(path)
+      # Content is named by its key, or by its sha alone when deduping.
+      routed.extend([(key, index), (self.sha_from_key(key), index)])
+    with self._lock:
+      self._key_to_index.update(routed)
+    for store in self._stores:
+      store.note_paths(paths_and_keys)
+
+  def raw_get(self, content_store_paths, target_dir_tmp):
+    missing = self.raw_get_partial(content_store_paths, target_dir_tmp)
+    if missing:
+      raise GitShedError('Content not found in any store: {0}'.format(', '.join(missing)))
+
+  def raw_get_partial(self, content_store_paths, target_dir_tmp):
+    return self._find(content_store_paths,
+                      lambda store, cs_paths: store.raw_get_partial(cs_paths, target_dir_tmp))
+
+  def raw_put(self, src_paths, content_store_dir):
+    # The basename of each source path is the key (or sha) of its content.
+    for index, index_src_paths in self._by_index(src_paths).items():
+      self._stores[index].raw_put(index_src_paths, content_store_dir)
+
+  def raw_has(self, content_store_path):
+    return not self._find([content_store_path],
+                          lambda store, cs_paths: [p for p in cs_paths if not store.raw_has(p)])
+
+  def raw_has_many(self, content_store_paths):
+    content_store_paths = set(content_store_paths)
+    missing = self._find(content_store_paths,
+                         lambda store, cs_paths: set(cs_paths) - store.raw_has_many(cs_paths))
+    return content_store_paths - set(missing)
+
+  def raw_sizes(self, content_store_paths):
+    ret = {}
+
+    def sizes(store, cs_paths):
+      found = store.raw_sizes(cs_paths)
+      ret.update(found)
+      return [p for p in cs_paths if p not in found]
+
+    self._find(content_store_paths, sizes, count_fallbacks=False)
+    return ret
+
+  def raw_list(self, content_store_dir):
+    names = set()
+    for store in self._stores:
+      names.update(store.raw_list(content_store_dir))
+    return sorted(names)
+
+  def _index_for_path(self, path):
+    # Paths may be given as, e.g., ./models/big.bin.
+    path = os.path.normpath(path)
+    if os.path.sep != '/':
+      path = path.replace(os.path.sep, '/')
+    for globs, index in self._routes:
+      if any(fnmatch(path, glob) for glob in globs):
+        return index
+    return 0
+
+  def _by_index(self, paths):
+    """Groups content store (or source) paths by the index of the store their content routes to."""
+    ret = defaultdict(list)
+    with self._lock:
+      for path in paths:
+        ret[self._key_to_index.get(os.path.basename(path), 0)].append(path)
+    return ret
+
+  def _find(self, content_store_paths, lookup, count_fallbacks=True):
+    """Looks up content in the store it's routed to, and then in the others.
+
+    :param content_store_paths: The content to look up.
+    :param lookup: A function that looks up content store paths in a store, and returns the ones
+                   it couldn't find there.
+    :param count_fallbacks: Whether to count content found outside its route's store in the metrics.
+    :returns: The content store paths that couldn't be found in any store.
+    """
+    missing = []
+    for index, cs_paths in self._by_index(content_store_paths).items():
+      cs_paths = lookup(self._stores[index], cs_paths)
+      for other_index, other in enumerate(self._stores):
+        if not cs_paths:
+          break
+        if other_index != index:
+          still_missing = lookup(other, cs_paths)
+          if count_fallbacks:
+            metrics.increment(metric_name('route_fallbacks', store=self._names[other_index]),
+                              len(cs_paths) - len(still_missing))
+          cs_paths = still_missing
+      missing.extend(cs_paths)
+    return missing
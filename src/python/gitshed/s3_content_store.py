@@ -0,0 +1,286 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+import datetime
+import hashlib
+import hmac
+import httplib
+import os
+import socket
+import threading
+import urllib
+import urlparse
+from xml.etree import ElementTree
+
+from gitshed.content_store import ContentStore
+from gitshed.error import GitShedError
+
+
+def _quote(s, safe='-_.~'):
+  return urllib.quote(s.encode('utf-8'), safe=safe.encode('utf-8')).decode('utf-8')
+
+
+def _find_all(element, name):
+  """Finds all descendants of an XML element with the given tag name, ignoring namespaces."""
+  return [e for e in element.iter() if e.tag == name or e.tag.endswith('}' + name)]
+
+
+def _find_text(element, name):
+  found = _find_all(element, name)
+  return found[0].text if found else None
+
+
+class S3ContentStore(ContentStore):
+  """A content store in an S3-compatible object store.
+
+  Each content store path maps to an object in the bucket (under an optional prefix), so the
+  naming of content_store_path_from_key() is preserved. File permissions are kept in object metadata.
+
+  Large files are uploaded as multipart uploads and downloaded as byte ranges, with several parts
+  in flight at once. Existence checks are HEAD requests, which never transfer content.
+
+  Requests are signed with AWS Signature Version 4, if credentials are available.
+  """
+
+  # The object metadata header that holds a file's permissions.
+  _MODE_HEADER = 'x-amz-meta-mode'
+
+  def __init__(self, endpoint, bucket, prefix='', region='us-east-1', access_key=None, secret_key=None,
+               part_size=8 * 1024 * 1024, parts_in_flight=4, chunk_size=20, get_concurrency=None,
+               put_concurrency=None):
+    """
+    :param endpoint: The URL of the object store, e.g., https://s3.amazonaws.com.
+    :param bucket: The bucket to keep content in.
+    :param prefix: Keep content under this prefix in the bucket.
+    :param region: The region to sign requests for.
+    :param access_key: The access key to sign requests with. Defaults to $AWS_ACCESS_KEY_ID.
+    :param secret_key: The secret key to sign requests with. Defaults to $AWS_SECRET_ACCESS_KEY.
+    :param part_size: Upload and download large files in parts of this many bytes.
+    :param parts_in_flight: Transfer up to this many parts of a single file at once.
+    :param chunk_size: Get/put in chunks of this size.
+    :param get_concurrency: Size of threadpool for gets.
+    :param put_concurrency: Size of threadpool for puts.
+    """
+    super(S3ContentStore, self).__init__(chunk_size, get_concurrency, put_concurrency)
+    parsed = urlparse.urlparse(endpoint)
+    self._https = parsed.scheme == 'https'
+    self._host = parsed.netloc
+    self._bucket = bucket
+    self._prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+    self._region = region
+    self._access_key = access_key or os.environ.get('AWS_ACCESS_KEY_ID')
+    self._secret_key = secret_key or os.environ.get('AWS_SECRET_ACCESS_KEY')
+    self._part_size = part_size
+    self._parts_in_flight = parts_in_flight
+    # Each thread keeps its own connection alive across requests.
+    self._local = threading.local()
+
+  def raw_get(self, content_store_paths, target_dir_tmp):
+    missing = []
+    for path in content_store_paths:
+      if not self._get_object(path, os.path.join(target_dir_tmp, os.path.basename(path))):
+        missing.append(path)
+    if missing:
+      # We fetch everything we can first, so that raw_get_partial() works precisely.
+      raise GitShedError('Content not found in bucket {0}: {1}'.format(self._bucket, ', '.join(missing)))
+
+  def raw_put(self, src_paths, content_store_dir):
+    for src_path in src_paths:
+      self._put_object('{0}/{1}'.format(content_store_dir, os.path.basename(src_path)), src_path)
+
+  def raw_has(self, content_store_path):
+    return self._head(content_store_path) is not None
+
+  def raw_has_many(self, content_store_paths):
+    return set(self.raw_sizes(content_store_paths).keys())
+
+  def raw_sizes(self, content_store_paths):
+    content_store_paths = list(content_store_paths)
+    sizes = self._map_in_parallel(self._head, content_store_paths)
+    return dict((path, size) for path, size in zip(content_store_paths, sizes) if size is not None)
+
+  def raw_list(self, content_store_dir):
+    object_prefix = '{0}{1}/'.format(self._prefix, content_store_dir)
+    ret = []
+    continuation_token = None
+    while True:
+      query = {'list-type': '2', 'prefix': object_prefix, 'delimiter': '/'}
+      if continuation_token:
+        query['continuation-token'] = continuation_token
+      _, _, body = self._request('GET', '/{0}'.format(self._bucket), query)
+      root = ElementTree.fromstring(body)
+      for contents in _find_all(root, 'Contents'):
+        ret.append(_find_text(contents, 'Key')[len(object_prefix):])
+      continuation_token = _find_text(root, 'NextContinuationToken')
+      if _find_text(root, 'IsTruncated') != 'true' or not continuation_token:
+        return ret
+
+  def _object_path(self, content_store_path):
+    return '/{0}/{1}{2}'.format(self._bucket, self._prefix, content_store_path)
+
+  def _head(self, content_store_path):
+    """Returns the size of an object, or None if it doesn't exist."""
+    status, headers, _ = self._request('HEAD', self._object_path(content_store_path), expected=(200, 404))
+    return int(headers['content-length']) if status == 200 else None
+
+  def _get_object(self, content_store_path, target_path):
+    """Downloads an object, returning False if it doesn't exist."""
+    object_path = self._object_path(content_store_path)
+    # Fetch the first part, which also tells us the total size, and so whether there are more parts.
+    status, headers, body = self._request(
+      'GET', object_path, headers={'Range': 'bytes=0-{0}'.format(self._part_size - 1)}, expected=(200, 206, 404, 416))
+    if status == 404:
+      return False
+    if status == 416:  # Empty objects have no ranges.
+      status, headers, body = self._request('GET', object_path)
+    size = int(headers['content-range'].rpartition('/')[2]) if status == 206 else len(body)
+    with open(target_path, 'wb') as outfile:
+      outfile.write(body)
+      outfile.truncate(size)
+
+    def get_part(offset):
+      end = min(offset + self._part_size, size) - 1
+      _, _, data = self._request('GET', object_path, headers={'Range': 'bytes={0}-{1}'.format(offset, end)},
+                                 expected=(206,))
+      if len(data) != end - offset + 1:
+        raise GitShedError('Short read of {0} at offset {1}.'.format(content_store_path, offset))
+      # Each part gets its own fd, so that parts can be written concurrently.
+      fd = os.open(target_path, os.O_WRONLY)
+      try:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+          data = data[os.write(fd, data):]
+      finally:
+        os.close(fd)
+
+    self._map_in_parallel(get_part, range(len(body), size, self._part_size))
+    os.chmod(target_path, int(headers.get(self._MODE_HEADER, '0444'), 8))
+    return True
+
+  def _put_object(self, content_store_path, src_path):
+    object_path = self._object_path(content_store_path)
+    st = os.stat(src_path)
+    mode_headers = {self._MODE_HEADER: oct(st.st_mode & 07777)}
+    if st.st_size <= self._part_size:
+      with open(src_path, 'rb') as infile:
+        self._request('PUT', object_path, headers=mode_headers, body=infile.read())
+      return
+
+    _, _, body = self._request('POST', object_path, {'uploads': ''}, headers=mode_headers)
+    upload_id = _find_text(ElementTree.fromstring(body), 'UploadId')
+
+    def put_part(part_number):
+      with open(src_path, 'rb') as infile:
+        infile.seek((part_number - 1) * self._part_size)
+        data = infile.read(self._part_size)
+      _, headers, _ = self._request('PUT', object_path, {'partNumber': str(part_number), 'uploadId': upload_id},
+                                    body=data)
+      return headers['etag']
+
+    try:
+      part_numbers = range(1, (st.st_size + self._part_size - 1) // self._part_size + 1)
+      etags = self._map_in_parallel(put_part, part_numbers)
+      complete = ''.join('<Part><PartNumber>{0}</PartNumber><ETag>{1}</ETag></Part>'.format(n, etag)
+                         for n, etag in zip(part_numbers, etags))
+      self._request('POST', object_path, {'uploadId': upload_id},
+                    body='<CompleteMultipartUpload>{0}</CompleteMultipartUpload>'.format(complete).encode('utf-8'))
+    except Exception:
+      # Don't leave orphaned parts behind.
+      try:
+        self._request('DELETE', object_path, {'uploadId': upload_id}, expected=(204, 404))
+      except GitShedError:
+        pass
+      raise
+
+  def _map_in_parallel(self, func, items):
+    """Like map(), but with up to parts_in_flight calls at once."""
+    items = list(items)
+    if len(items) <= 1:
+      return [func(item) for item in items]
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(self._parts_in_flight, len(items)))
+    try:
+      return pool.map(func, items)
+    finally:
+      pool.close()
+      pool.join()
+
+  def _request(self, method, path, query=None, headers=None, body=b'', expected=(200,)):
+    """Sends a signed request.
+
+    :returns: A triple of (status, map of lowercase header name -> value, body).
+    """
+    query = query or {}
+    headers = dict(headers or {})
+    quoted_path = _quote(path, safe='/-_.~')
+    query_string = '&'.join('{0}={1}'.format(_quote(k), _quote(v)) for k, v in sorted(query.items()))
+    self._sign(method, quoted_path, query_string, headers)
+    url = '{0}?{1}'.format(quoted_path, query_string) if query_string else quoted_path
+    # httplib concatenates the request line and headers with the body, so they must all be bytes.
+    method, url = method.encode('utf-8'), url.encode('utf-8')
+    headers = dict((k.encode('utf-8'), '{0}'.format(v).encode('utf-8')) for k, v in headers.items())
+
+    # A kept-alive connection may have been closed by the server, so we retry once on a new one.
+    for attempt in range(2):
+      connection = self._connection()
+      try:
+        connection.request(method, url, body, headers)
+        response = connection.getresponse()
+        response_body = response.read()
+        break
+      except (httplib.HTTPException, socket.error) as e:
+        connection.close()
+        self._local.connection = None
+        if attempt:
+          raise GitShedError('{0} {1} failed: {2}'.format(method, path, e))
+    response_headers = dict((k.lower(), v) for k, v in response.getheaders())
+    if response.status not in expected:
+      raise GitShedError('{0} {1} failed with status {2}: {3}'.format(
+        method, path, response.status, response_body.decode('utf-8', 'replace')))
+    return response.status, response_headers, response_body
+
+  def _connection(self):
+    connection = getattr(self._local, 'connection', None)
+    if connection is None:
+      connection_class = httplib.HTTPSConnection if self._https else httplib.HTTPConnection
+      connection = connection_class(self._host, timeout=60)
+      self._local.connection = connection
+    return connection
+
+  def _sign(self, method, quoted_path, query_string, headers):
+    """Adds AWS Signature Version 4 headers to a request."""
+    now = datetime.datetime.utcnow()
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    date = now.strftime('%Y%m%d')
+    headers['Host'] = self._host
+    headers['x-amz-date'] = amz_date
+    # The payload isn't included in the signature, so we needn't hash it up front.
+    headers['x-amz-content-sha256'] = 'UNSIGNED-PAYLOAD'
+    if not self._access_key or not self._secret_key:
+      return
+
+    canonical_headers = sorted((k.lower(), ' '.join(v.split())) for k, v in headers.items())
+    signed_headers = ';'.join(k for k, _ in canonical_headers)
+    canonical_request = '\n'.join([
+      method,
+      quoted_path,
+      query_string,
+      ''.join('{0}:{1}\n'.format(k, v) for k, v in canonical_headers),
+      signed_headers,
+      'UNSIGNED-PAYLOAD',
+    ])
+    scope = '{0}/{1}/s3/aws4_request'.format(date, self._region)
+    string_to_sign = '\n'.join([
+      'AWS4-HMAC-SHA256',
+      amz_date,
+      scope,
+      hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+    ])
+    signing_key = ('AWS4' + self._secret_key).encode('utf-8')
+    for part in [date, self._region, 's3', 'aws4_request']:
+      signing_key = hmac.new(signing_key, part.encode('utf-8'), hashlib.sha256).digest()
+    signature = hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+    headers['Authorization'] = 'AWS4-HMAC-SHA256 Credential={0}/{1}, SignedHeaders={2}, Signature={3}'.format(
+      self._access_key, scope, signed_headers, signature)
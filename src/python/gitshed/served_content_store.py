@@ -0,0 +1,272 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+from collections import deque
+import itertools
+import os
+import subprocess
+import threading
+
+from gitshed.content_store import ContentStore
+from gitshed.error import GitShedError
+from gitshed.protocol import (ERROR, GET, LIST, PROTOCOL_VERSION, PUT, STAT, VERSION, decode_fields,
+                              encode_fields, read_frame, write_frame)
+
+
+class _PendingResponse(object):
+  """The eventual response to a request."""
+
+  def __init__(self):
+    self._event = threading.Event()
+    self._payload = None
+    self._error = None
+
+  def set(self, payload=None, error=None):
+    self._payload = payload
+    self._error = error
+    self._event.set()
+
+  def wait(self):
+    """Waits for the response, returning its payload or raising its error."""
+    # Wait with a timeout so that we remain interruptible.
+    while not self._event.wait(0.1):
+      pass
+    if self._error:
+      raise GitShedError(self._error)
+    return self._payload
+
+
+class _Session(object):
+  """A long-lived connection to a `git shed serve` process, multiplexing concurrent requests.
+
+  Safe to use from multiple threads.
+  """
+
+  def __init__(self, command):
+    """
+    :param command: The command that runs `git shed serve`, as a list of args.
+    """
+    self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    self._request_ids = itertools.count(1)
+    self._pending = {}  # Request id -> _PendingResponse.
+    self._lock = threading.Lock()
+    self._closed_error = None
+    reader = threading.Thread(target=self._read_responses)
+    reader.daemon = True
+    reader.start()
+    try:
+      server_version, = decode_fields(self.send(VERSION, encode_fields([PROTOCOL_VERSION])).wait())
+      if server_version != PROTOCOL_VERSION:
+        raise GitShedError('Server speaks protocol version {0}, but we need {1}.'.format(
+          server_version, PROTOCOL_VERSION))
+    except BaseException:
+      # Don't leave behind a server process that nobody will ever close.
+      self._kill()
+      raise
+
+  @property
+  def is_open(self):
+    return self._closed_error is None
+
+  def send(self, frame_type, payload):
+    """Sends a request, without waiting for its response.
+
+    :returns: A _PendingResponse.
+    """
+    pending = _PendingResponse()
+    with self._lock:
+      if self._closed_error:
+        raise GitShedError(self._closed_error)
+      request_id = next(self._request_ids)
+      self._pending[request_id] = pending
+      try:
+        write_frame(self._process.stdin, frame_type, request_id, payload)
+      except (IOError, OSError) as e:
+        del self._pending[request_id]
+        raise GitShedError('Lost connection to content store server: {0}'.format(e))
+    return pending
+
+  def close(self):
+    with self._lock:
+      if not self._closed_error:
+        self._closed_error = 'Session closed.'
+        self._process.stdin.close()
+    self._process.wait()
+
+  def _kill(self):
+    with self._lock:
+      self._closed_error = self._closed_error or 'Session closed.'
+    try:
+      self._process.kill()
+    except OSError:
+      pass  # It already exited.
+    self._process.wait()
+    self._process.stdin.close()
+
+  def _read_responses(self):
+    error = 'Content store server exited.'
+    try:
+      while True:
+        frame = read_frame(self._process.stdout)
+        if frame is None:
+          break
+        frame_type, request_id, payload = frame
+        with self._lock:
+          pending = self._pending.pop(request_id, None)
+        if pending:
+          if frame_type == ERROR:
+            pending.set(error=payload.decode('utf-8'))
+          else:
+            pending.set(payload=payload)
+    except Exception as e:
+      error = 'Lost connection to content store server: {0}'.format(e)
+    # Fail everything still outstanding.
+    with self._lock:
+      self._closed_error = self._closed_error or error
+      pending_responses = self._pending.values()
+      self._pending = {}
+    for pending in pending_responses:
+      pending.set(error=error)
+
+
+class ServedContentStore(ContentStore):
+  """A content store accessed through a `git shed serve` process on the content store host.
+
+  All requests are multiplexed over a few long-lived sessions (e.g., ssh connections), instead of
+  paying for a new connection per chunk. Large files are transferred as multiple byte ranges, with
+  several ranges in flight at once, so a single huge file doesn't serialize behind one request.
+  """
+
+  def __init__(self, command, num_sessions=1, range_size=4 * 1024 * 1024, ranges_in_flight=8,
+               chunk_size=20, get_concurrency=None, put_concurrency=None):
+    """
+    :param command: The command that runs `git shed serve`, as a list of args. E.g.,
+                    ['ssh', 'myhost', 'git', 'shed', 'serve', '/data/gitshed/myrepo'].
+    :param num_sessions: Spread requests over this many sessions.
+    :param range_size: Transfer file content in byte ranges of this size.
+    :param ranges_in_flight: Have at most this many ranges in flight per raw get or put.
+    :param chunk_size: Get/put in chunks of this size.
+    :param get_concurrency: Size of threadpool for gets.
+    :param put_concurrency: Size of threadpool for puts.
+    """
+    super(ServedContentStore, self).__init__(chunk_size, get_concurrency, put_concurrency)
+    self._command = command
+    self._num_sessions = num_sessions
+    self._range_size = range_size
+    self._ranges_in_flight = ranges_in_flight
+    self._sessions = []
+    self._next_session = 0
+    self._sessions_lock = threading.Lock()
+
+  def close(self):
+    """Closes all sessions. They're reopened if the content store is used again."""
+    with self._sessions_lock:
+      sessions, self._sessions = self._sessions, []
+    for session in sessions:
+      session.close()
+
+  def raw_get(self, content_store_paths, target_dir_tmp):
+    path_to_stat = self._stat(content_store_paths)
+    window = deque()
+    fds = []
+    try:
+      for path in content_store_paths:
+        if path not in path_to_stat:
+          continue
+        size, mode = path_to_stat[path]
+        target_path = os.path.join(target_dir_tmp, os.path.basename(path))
+        fd = os.open(target_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        fds.append((fd, target_path, mode))
+        for offset in range(0, size, self._range_size):
+          if len(window) == self._ranges_in_flight:
+            self._write_range(*window.popleft())
+          length = min(self._range_size, size - offset)
+          window.append((self._send(GET, encode_fields([path, offset, length])), fd, offset, length))
+      while window:
+        self._write_range(*window.popleft())
+    finally:
+      for fd, _, _ in fds:
+        os.close(fd)
+    for _, target_path, mode in fds:
+      os.chmod(target_path, mode)
+    missing = [path for path in content_store_paths if path not in path_to_stat]
+    if missing:
+      # We fetch everything we can first, so that raw_get_partial() works precisely.
+      raise GitShedError('Content not found: {0}'.format(', '.join(missing)))
+
+  @staticmethod
+  def _write_range(pending, fd, offset, length):
+    data = pending.wait()
+    if len(data) != length:
+      raise GitShedError('Expected {0} bytes at offset {1}, but got {2}.'.format(length, offset, len(data)))
+    os.lseek(fd, offset, os.SEEK_SET)
+    while data:
+      data = data[os.write(fd, data):]
+
+  def raw_put(self, src_paths, content_store_dir):
+    window = deque()
+    uploads = []  # (content store path, [confirmed]) for each file.
+    for src_path in src_paths:
+      content_store_path = '{0}/{1}'.format(content_store_dir, os.path.basename(src_path))
+      token = self._random_string()
+      confirmed = [False]
+      uploads.append((content_store_path, confirmed))
+      # Upload tokens are per session, so send all of a file's ranges on the same session.
+      session = self._session()
+      st = os.stat(src_path)
+      mode = oct(st.st_mode & 07777)
+      with open(src_path, 'rb') as infile:
+        # An empty file is still uploaded, as a single empty range.
+        for offset in range(0, st.st_size, self._range_size) or [0]:
+          if len(window) == self._ranges_in_flight:
+            self._confirm_range(*window.popleft())
+          data = infile.read(self._range_size)
+          fields = [token, content_store_path, mode, offset, st.st_size]
+          window.append((session.send(PUT, encode_fields(fields, data)), confirmed))
+    while window:
+      self._confirm_range(*window.popleft())
+    unconfirmed = [path for path, confirmed in uploads if not confirmed[0]]
+    if unconfirmed:
+      raise GitShedError('Server did not confirm uploads of: {0}'.format(', '.join(unconfirmed)))
+
+  @staticmethod
+  def _confirm_range(pending, confirmed):
+    # Only the range that completes the upload is answered with a field.
+    if decode_fields(pending.wait()):
+      confirmed[0] = True
+
+  def raw_has(self, content_store_path):
+    return content_store_path in self._stat([content_store_path])
+
+  def raw_has_many(self, content_store_paths):
+    return set(self._stat(content_store_paths).keys())
+
+  def raw_sizes(self, content_store_paths):
+    return dict((path, size) for path, (size, _) in self._stat(content_store_paths).items())
+
+  def raw_list(self, content_store_dir):
+    return decode_fields(self._send(LIST, encode_fields([content_store_dir])).wait())
+
+  def _stat(self, content_store_paths):
+    """Returns a map of content store path -> (size, mode) for whichever of the paths exist."""
+    content_store_paths = list(content_store_paths)
+    if not content_store_paths:
+      return {}
+    fields = decode_fields(self._send(STAT, encode_fields(content_store_paths)).wait())
+    return dict((fields[i], (int(fields[i + 1]), int(fields[i + 2], 8))) for i in range(0, len(fields), 3))
+
+  def _send(self, frame_type, payload):
+    return self._session().send(frame_type, payload)
+
+  def _session(self):
+    """Returns the next session to use, opening sessions as needed."""
+    with self._sessions_lock:
+      # Sessions that have failed are replaced with new ones.
+      self._sessions = [session for session in self._sessions if session.is_open]
+      if len(self._sessions) < self._num_sessions:
+        self._sessions.append(_Session(self._command))
+        return self._sessions[-1]
+      self._next_session = (self._next_session + 1) % len(self._sessions)
+      return self._sessions[self._next_session]
@@ -0,0 +1,155 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+import os
+import re
+import threading
+
+from gitshed.error import GitShedError
+from gitshed.protocol import (ERROR, GET, LIST, OK, PROTOCOL_VERSION, PUT, STAT, VERSION, decode_fields,
+                              encode_fields, read_frame, write_frame)
+from gitshed.util import safe_makedirs
+
+
+class ContentStoreServer(object):
+  """Serves a content store on the local filesystem, over the protocol in gitshed.protocol.
+
+  Runs on the content store host (e.g., as `ssh <host> git shed serve <root>`), so that clients can
+  multiplex all their requests over a single long-lived session, instead of paying for a new
+  connection per chunk.
+
+  Requests are handled concurrently, so a client can keep many requests in flight at once.
+  """
+
+  _TOKEN_RE = re.compile(r'^[0-9a-f]{1,64}$')
+
+  def __init__(self, root, infile, outfile, concurrency=8):
+    """
+    :param root: The root dir of the content store.
+    :param infile: Read requests from this binary stream.
+    :param outfile: Write responses to this binary stream.
+    :param concurrency: Handle up to this many requests at once.
+    """
+    self._root = root
+    self._infile = infile
+    self._outfile = outfile
+    self._concurrency = concurrency
+    self._write_lock = threading.Lock()
+    self._uploads = {}  # Upload token -> [tmp path, number of bytes written so far].
+    self._uploads_lock = threading.Lock()
+    self._handlers = {
+      VERSION: self._version,
+      STAT: self._stat,
+      GET: self._get,
+      PUT: self._put,
+      LIST: self._list,
+    }
+
+  def serve(self):
+    """Handles requests until the input stream ends."""
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(self._concurrency)
+    # Don't read arbitrarily far ahead of the workers, as requests may carry lots of data.
+    slots = threading.BoundedSemaphore(2 * self._concurrency)
+    try:
+      while True:
+        frame = read_frame(self._infile)
+        if frame is None:
+          break
+        slots.acquire()
+        pool.apply_async(self._handle, (frame, slots))
+    finally:
+      pool.close()
+      pool.join()
+      # Uploads the client didn't complete never will be, as tokens are per session.
+      for tmp_path, _ in self._uploads.values():
+        if os.path.exists(tmp_path):
+          os.unlink(tmp_path)
+      self._uploads.clear()
+
+  def _handle(self, frame, slots):
+    frame_type, request_id, payload = frame
+    try:
+      handler = self._handlers.get(frame_type)
+      if handler is None:
+        raise GitShedError('Unknown request type: {0!r}'.format(frame_type))
+      response_type, response = OK, handler(payload)
+    except Exception as e:
+      response_type, response = ERROR, '{0}'.format(e).encode('utf-8')
+    finally:
+      slots.release()
+    with self._write_lock:
+      write_frame(self._outfile, response_type, request_id, response)
+
+  def _version(self, payload):
+    client_version, = decode_fields(payload)
+    if client_version != PROTOCOL_VERSION:
+      raise GitShedError('Unsupported protocol version {0}. This server speaks version {1}.'.format(
+        client_version, PROTOCOL_VERSION))
+    return encode_fields([PROTOCOL_VERSION])
+
+  def _stat(self, payload):
+    fields = []
+    for path in decode_fields(payload):
+      full_path = self._full_path(path)
+      if os.path.isfile(full_path):
+        st = os.stat(full_path)
+        fields.extend([path, st.st_size, oct(st.st_mode & 07777)])
+    return encode_fields(fields)
+
+  def _get(self, payload):
+    path, offset, length = decode_fields(payload)
+    with open(self._full_path(path), 'rb') as infile:
+      infile.seek(int(offset))
+      return infile.read(int(length))
+
+  def _put(self, payload):
+    (token, path, mode, offset, total_size), data = decode_fields(payload, 5)
+    length = len(data)
+    if not self._TOKEN_RE.match(token):
+      raise GitShedError('Invalid upload token: {0}'.format(token))
+    full_path = self._full_path(path)
+    tmp_path = '{0}.{1}.tmp'.format(full_path, token)
+    safe_makedirs(os.path.dirname(full_path))
+    with self._uploads_lock:
+      # Track the upload before creating its tmp file, so that the file is cleaned up if the
+      # upload is never completed.
+      upload = self._uploads.setdefault(token, [tmp_path, 0])
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT, 0600)
+    try:
+      os.lseek(fd, int(offset), os.SEEK_SET)
+      while data:
+        data = data[os.write(fd, data):]
+    finally:
+      os.close(fd)
+    with self._uploads_lock:
+      upload[1] += length
+      if upload[1] < int(total_size):
+        return b''
+      self._uploads.pop(token, None)
+    # All the upload's data is written, so make it visible, atomically.
+    try:
+      os.chmod(tmp_path, int(mode, 8))
+      os.rename(tmp_path, full_path)
+    except OSError:
+      os.unlink(tmp_path)
+      raise
+    # Confirm that the upload is complete.
+    return encode_fields([path])
+
+  def _list(self, payload):
+    content_store_dir, = decode_fields(payload)
+    full_dir = self._full_path(content_store_dir)
+    if not os.path.isdir(full_dir):
+      return encode_fields([])
+    return encode_fields([name for name in os.listdir(full_dir) if not name.endswith('.tmp')])
+
+  def _full_path(self, path):
+    """Converts a logical content store path to a filesystem path, refusing to escape the root."""
+    parts = path.split('/')
+    if any(part in ('', '.', '..') for part in parts):
+      raise GitShedError('Invalid content store path: {0}'.format(path))
+    return os.path.join(self._root, *parts)
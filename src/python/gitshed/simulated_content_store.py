@@ -0,0 +1,122 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+import os
+import random
+import threading
+import time
+
+from gitshed.content_store import ContentStore
+from gitshed.error import GitShedError
+
+
+class SimulatedContentStore(ContentStore):
+  """Wraps another content store, making it behave like a remote one.
+
+  Every call pays a latency (plus random jitter) and may fail at random, and content is transferred
+  over a simulated link of limited bandwidth, shared by all concurrent calls. Wrapping a
+  LocalContentStore lets tests and benchmarks reproduce the effects of chunk_size, concurrency and
+  retries against a remote content store, on a single machine.
+
+  Safe to use from multiple threads.
+  """
+
+  def __init__(self, backend, latency=0.0, jitter=0.0, bandwidth=None, failure_rate=0.0, seed=None,
+               chunk_size=20, get_concurrency=None, put_concurrency=None, clock=time.time, sleep=time.sleep):
+    """
+    :param backend: The ContentStore to wrap.
+    :param latency: Each call takes at least this many seconds.
+    :param jitter: Each call takes up to this many more seconds, at random.
+    :param bandwidth: Transfer content at this many bytes per second, shared by all calls.
+                      If None, content is transferred instantly.
+    :param failure_rate: Each call fails with this probability, after its latency.
+    :param seed: Seed the random jitter and failures with this, for reproducible runs.
+    :param chunk_size: Get/put in chunks of this size.
+    :param get_concurrency: Size of threadpool for gets.
+    :param put_concurrency: Size of threadpool for puts.
+    :param clock: A no-arg function returning the current time in seconds.
+    :param sleep: A function that sleeps for the specified number of seconds.
+    """
+    super(SimulatedContentStore, self).__init__(chunk_size, get_concurrency, put_concurrency)
+    self._backend = backend
+    self._latency = latency
+    self._jitter = jitter
+    self._bandwidth = bandwidth
+    self._failure_rate = failure_rate
+    self._random = random.Random(seed)
+    self._clock = clock
+    self._sleep = sleep
+    self._lock = threading.Lock()
+    self._link_free_at = 0.0  # The time at which the simulated link finishes its queued transfers.
+
+  @property
+  def backend(self):
+    return self._backend
+
+  def note_paths(self, paths_and_keys):
+    self._backend.note_paths(paths_and_keys)
+
+  def raw_get(self, content_store_paths, target_dir_tmp):
+    self._call()
+    try:
+      self._backend.raw_get(content_store_paths, target_dir_tmp)
+    finally:
+      self._transfer(self._fetched_size(content_store_paths, target_dir_tmp))
+
+  def raw_get_partial(self, content_store_paths, target_dir_tmp):
+    self._call()
+    missing = self._backend.raw_get_partial(content_store_paths, target_dir_tmp)
+    self._transfer(self._fetched_size(content_store_paths, target_dir_tmp))
+    return missing
+
+  def raw_put(self, src_paths, content_store_dir):
+    self._call()
+    self._transfer(sum(os.path.getsize(src_path) for src_path in src_paths))
+    self._backend.raw_put(src_paths, content_store_dir)
+
+  def raw_has(self, content_store_path):
+    self._call()
+    return self._backend.raw_has(content_store_path)
+
+  def raw_has_many(self, content_store_paths):
+    self._call()
+    return self._backend.raw_has_many(content_store_paths)
+
+  def raw_sizes(self, content_store_paths):
+    self._call()
+    return self._backend.raw_sizes(content_store_paths)
+
+  def raw_list(self, content_store_dir):
+    self._call()
+    return self._backend.raw_list(content_store_dir)
+
+  def _call(self):
+    """Simulates the latency, and possible failure, of a call."""
+    with self._lock:
+      delay = self._latency + self._jitter * self._random.random()
+      fail = self._random.random() < self._failure_rate
+    self._sleep(delay)
+    if fail:
+      raise GitShedError('Simulated failure.')
+
+  def _transfer(self, num_bytes):
+    """Simulates transferring content over the shared link."""
+    if not self._bandwidth or not num_bytes:
+      return
+    with self._lock:
+      # Transfers queue up behind each other, so concurrent calls share the bandwidth.
+      now = self._clock()
+      self._link_free_at = max(now, self._link_free_at) + num_bytes / self._bandwidth
+      delay = self._link_free_at - now
+    self._sleep(delay)
+
+  @staticmethod
+  def _fetched_size(content_store_paths, target_dir_tmp):
+    total = 0
+    for path in content_store_paths:
+      target_path = os.path.join(target_dir_tmp, os.path.basename(path))
+      if os.path.isfile(target_path):
+        total += os.path.getsize(target_path)
+    return total
@@ -0,0 +1,101 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+from contextlib import contextmanager
+import errno
+import os
+import shutil
+import threading
+
+from gitshed.util import safe_makedirs
+
+
+class StagingArea(object):
+  """Scratch directories for content on its way into, or out of, the shed.
+
+  Unlike temporary dirs under the system temp dir, the staging area can live on the same filesystem
+  as the shed, so content moves between them with atomic renames and hard links, rather than copies.
+  Its directories (slots) are reused, so that transferring many chunks doesn't create and remove a
+  directory per chunk.
+
+  Each process has its own slots. Slots left behind by processes that no longer exist are removed
+  when the staging area is first used.
+
+  Safe to use from multiple threads.
+  """
+
+  def __init__(self, root):
+    """
+    :param root: The directory to create slots in, or a no-arg function that returns it. The
+                 function is called when the staging area is first used.
+    """
+    self._root = root
+    self._free = []  # Empty slots, ready for reuse.
+    self._num_slots = 0
+    self._lock = threading.Lock()
+
+  @contextmanager
+  def slot(self):
+    """A context yielding an empty directory, which is emptied for reuse on context exit."""
+    with self._lock:
+      if self._free:
+        path = self._free.pop()
+      else:
+        path = self._create_slot()
+    try:
+      yield path
+    finally:
+      try:
+        self._empty(path)
+        reusable = True
+      except (IOError, OSError):
+        shutil.rmtree(path, ignore_errors=True)
+        reusable = False
+      if reusable:
+        with self._lock:
+          self._free.append(path)
+
+  def close(self):
+    """Removes the slots that aren't in use."""
+    with self._lock:
+      for path in self._free:
+        shutil.rmtree(path, ignore_errors=True)
+      self._free = []
+
+  def _create_slot(self):
+    if not self._num_slots:
+      if callable(self._root):
+        self._root = self._root()
+      safe_makedirs(self._root)
+      self._remove_stale_slots()
+      import atexit
+      atexit.register(self.close)
+    self._num_slots += 1
+    path = os.path.join(self._root, '{0}.{1}'.format(os.getpid(), self._num_slots))
+    safe_makedirs(path)
+    return path
+
+  def _remove_stale_slots(self):
+    for name in os.listdir(self._root):
+      pid, _, _ = name.partition('.')
+      if pid.isdigit() and int(pid) != os.getpid() and not self._is_running(int(pid)):
+        shutil.rmtree(os.path.join(self._root, name), ignore_errors=True)
+
+  @staticmethod
+  def _is_running(pid):
+    try:
+      os.kill(pid, 0)
+      return True
+    except OSError as e:
+      return e.errno == errno.EPERM  # It exists, but belongs to someone else.
+
+  @staticmethod
+  def _empty(path):
+    for name in os.listdir(path):
+      child = os.path.join(path, name)
+      if os.path.isdir(child) and not os.path.islink(child):
+        shutil.rmtree(child)
+      else:
+        os.unlink(child)
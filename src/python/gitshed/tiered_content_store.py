@@ -0,0 +1,118 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+from collections import defaultdict
+import os
+
+from gitshed.content_store import ContentStore
+from gitshed.error import GitShedError
+from gitshed.metrics import metric_name, metrics
+
+
+class TieredContentStore(ContentStore):
+  """A read-through chain of content stores, ordered from fastest to slowest.
+
+  The last tier is the origin, which is expected to have all content. Faster tiers (e.g., a
+  mirror on the local network, or a shared filesystem) may have any subset of it.
+
+  Gets try each tier in order, passing just the misses down to the next tier, so that latency
+  tracks the closest tier that has the content. Optionally, content fetched from a slower tier is
+  back-filled into the faster tiers, so subsequent gets find it there.
+
+  Puts write through to the origin only.
+  """
+  def __init__(self, tiers, backfill=False, chunk_size=20, get_concurrency=None, put_concurrency=None):
+    """
+    :param tiers: The ContentStore instances to chain, from fastest to slowest.
+    :param backfill: Whether to write content fetched from a tier into all the faster tiers.
+    :param chunk_size: Get/put in chunks of this size.
+    :param get_concurrency: Size of threadpool for gets.
+    :param put_concurrency: Size of threadpool for puts.
+    """
+    super(TieredContentStore, self).__init__(chunk_size, get_concurrency, put_concurrency)
+    self._tiers = tiers
+    self._backfill = backfill
+
+  @property
+  def origin(self):
+    return self._tiers[-1]
+
+  def note_paths(self, paths_and_keys):
+    paths_and_keys = list(paths_and_keys)
+    for tier in self._tiers:
+      tier.note_paths(paths_and_keys)
+
+  def raw_get(self, content_store_paths, target_dir_tmp):
+    missing = self.raw_get_partial(content_store_paths, target_dir_tmp)
+    if missing:
+      raise GitShedError('Content not found in any tier: {0}'.format(', '.join(missing)))
+
+  def raw_get_partial(self, content_store_paths, target_dir_tmp):
+    missing = list(content_store_paths)
+    for i, tier in enumerate(self._tiers):
+      if not missing:
+        break
+      with metrics.timer(metric_name('tier_seconds', tier=i, backend=type(tier).__name__)):
+        still_missing = tier.raw_get_partial(missing, target_dir_tmp)
+      metrics.increment(metric_name('tier_hits', tier=i), len(missing) - len(still_missing))
+      if self._backfill and i > 0:
+        still_missing_set = set(still_missing)
+        self._backfill_tiers(self._tiers[:i], [p for p in missing if p not in still_missing_set],
+                             target_dir_tmp)
+      missing = still_missing
+    return missing
+
+  def raw_put(self, src_paths, content_store_dir):
+    self.origin.raw_put(src_paths, content_store_dir)
+
+  def raw_has(self, content_store_path):
+    return any(tier.raw_has(content_store_path) for tier in self._tiers)
+
+  def raw_has_many(self, content_store_paths):
+    present = set()
+    missing = set(content_store_paths)
+    for tier in self._tiers:
+      if not missing:
+        break
+      tier_present = tier.raw_has_many(missing)
+      present.update(tier_present)
+      missing.difference_update(tier_present)
+    return present
+
+  def raw_sizes(self, content_store_paths):
+    return self.origin.raw_sizes(content_store_paths)
+
+  def raw_list(self, content_store_dir):
+    return self.origin.raw_list(content_store_dir)
+
+  def _backfill_tiers(self, tiers, content_store_paths, target_dir_tmp):
+    """Writes fetched content into the specified tiers.
+
+    Content is verified before it's back-filled, so that a corrupt tier can't spread its
+    corruption to other tiers. A failure to back-fill is not an error: it just means that the
+    content will be fetched from a slower tier next time.
+    """
+    cs_dir_to_src_paths = defaultdict(list)
+    for content_store_path in content_store_paths:
+      cs_dir, _, key = content_store_path.rpartition('/')
+      src_path = os.path.join(target_dir_tmp, key)
+      if self._is_verified(src_path, key):
+        cs_dir_to_src_paths[cs_dir].append(src_path)
+    for tier in tiers:
+      for cs_dir, src_paths in cs_dir_to_src_paths.items():
+        try:
+          tier.raw_put(src_paths, cs_dir)
+        except (GitShedError, IOError, OSError):
+          pass
+
+  def _is_verified(self, src_path, name):
+    """Checks whether fetched content matches the name it's stored under in the content store."""
+    if self.is_valid_key(name):
+      return (self.fingerprint_for_key(src_path, name) == self.sha_from_key(name) and
+              self.mode(src_path) == self.mode_from_key(name))
+    if self.is_valid_sha(name):
+      # Content stored under its sha alone (see ContentStore.use_dedupe()) has no mode to check.
+      return self.fingerprint(src_path, self.algorithm_from_sha(name)) == name
+    return False
@@ -0,0 +1,105 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+
+from gitshed.util import safe_makedirs
+
+
+class UploadJournal(object):
+  """A durable record of content that's in the shed, but not yet uploaded to the content store.
+
+  The journal is a file of JSON lines, each either adding a key (with the shed path of its content,
+  and the path of the file it was managed from)
+  or marking a key's upload as done. Every write is synced to disk before it returns, so entries
+  survive crashes. Once every added key is done, the file is emptied.
+
+  Safe to use from multiple threads and processes.
+  """
+
+  def __init__(self, path):
+    """
+    :param path: The journal file.
+    """
+    self._path = path
+
+  def add(self, entries):
+    """Records content waiting to be uploaded.
+
+    :param entries: An iterable of (key, shed path of that key's content, path relative to the repo
+                    root of the file it was managed from) triples.
+    """
+    self._append([{'key': key, 'path': shed_path, 'relpath': relpath} for key, shed_path, relpath in entries])
+
+  def mark_done(self, keys):
+    """Records that the content under some keys has been uploaded.
+
+    :param keys: The uploaded keys.
+    """
+    with self._locked() as journal:
+      self._write(journal, [{'done': key} for key in keys])
+      if not self._read_pending(journal):
+        journal.truncate(0)
+        os.fsync(journal.fileno())
+
+  def pending(self):
+    """Returns the content waiting to be uploaded, as a map of key -> shed path, in the order added."""
+    return OrderedDict((key, shed_path) for key, (shed_path, _) in self.pending_entries().items())
+
+  def pending_entries(self):
+    """Returns the content waiting to be uploaded, in the order added.
+
+    :returns: A map of key -> (shed path, path of the file it was managed from). The latter is None
+              for content journaled before those paths were recorded.
+    """
+    if not os.path.exists(self._path):
+      return OrderedDict()
+    with self._locked() as journal:
+      return self._read_pending(journal)
+
+  def _append(self, records):
+    if records:
+      with self._locked() as journal:
+        self._write(journal, records)
+
+  @contextmanager
+  def _locked(self):
+    safe_makedirs(os.path.dirname(self._path))
+    with open(self._path, 'a+') as journal:
+      fcntl.flock(journal.fileno(), fcntl.LOCK_EX)
+      yield journal
+
+  @staticmethod
+  def _write(journal, records):
+    data = ''.join(json.dumps(record, sort_keys=True) + '\n' for record in records)
+    # Don't append to the partial last line of a write that was interrupted by a crash.
+    journal.seek(0, os.SEEK_END)
+    if journal.tell():
+      journal.seek(-1, os.SEEK_END)
+      if journal.read(1) != '\n':
+        data = '\n' + data
+      journal.seek(0, os.SEEK_END)  # Required between a read and a write.
+    journal.write(data)
+    journal.flush()
+    os.fsync(journal.fileno())
+
+  @staticmethod
+  def _read_pending(journal):
+    journal.seek(0)
+    pending = OrderedDict()
+    for line in journal:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        continue  # A write that was interrupted by a crash.
+      if 'done' in record:
+        pending.pop(record['done'], None)
+      else:
+        pending[record['key']] = (record['path'], record.get('relpath'))
+    return pending
@@ -9,6 +9,7 @@ import os
 import shlex
 import shutil
 import subprocess
+import sys
 import tempfile
 
 from gitshed.error import GitShedError
@@ -39,6 +40,27 @@ def safe_rmtree(path):
   shutil.rmtree(path, True)
 
 
+_SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(size):
+  """Parses a size in bytes, optionally with a K, M, G or T suffix (e.g., 500M or 20G).
+
+  :param size: An int, or a string representing a size.
+  :returns: The size in bytes.
+  """
+  if isinstance(size, (int, long)):
+    return size
+  s = size.strip().upper()
+  if s.endswith('B'):
+    s = s[:-1]
+  unit = s[-1:] if s[-1:] in _SIZE_UNITS else ''
+  try:
+    return int(float(s[:len(s) - len(unit)]) * _SIZE_UNITS[unit])
+  except ValueError:
+    raise GitShedError('Invalid size: {0}'.format(size))
+
+
 def make_mode_read_only(mode):
   return mode & ~0222
 
@@ -51,6 +73,101 @@ def make_user_writeable(path):
   os.chmod(path, mode | 0200)
 
 
+# Copy and hash files in buffers of this size, so that per-call overhead is negligible.
+IO_BUFFER_SIZE = 1024 * 1024
+
+
+def copy_file(src, dst):
+  """Copies a file's content and permission bits, like shutil.copy().
+
+  Where possible, the content never passes through this process: we try a copy-on-write clone
+  (on filesystems that support it), then copying in the kernel with copy_file_range() or
+  sendfile(), and only then copying through a large userspace buffer.
+
+  :param src: The file to copy.
+  :param dst: The path to copy it to. Overwritten if it exists.
+  """
+  src_fd = os.open(src, os.O_RDONLY)
+  try:
+    dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    try:
+      if not _kernel_copy(src_fd, dst_fd):
+        # Continue from wherever the kernel left off.
+        data = os.read(src_fd, IO_BUFFER_SIZE)
+        while data:
+          while data:
+            data = data[os.write(dst_fd, data):]
+          data = os.read(src_fd, IO_BUFFER_SIZE)
+    finally:
+      os.close(dst_fd)
+  finally:
+    os.close(src_fd)
+  shutil.copymode(src, dst)
+
+
+# The Linux ioctl that clones one file's extents into another (formerly BTRFS_IOC_CLONE).
+_FICLONE = 0x40049409
+
+# The largest count that sendfile() will copy in one call.
+_MAX_KERNEL_COPY = 0x7ffff000
+
+_libc_copy_funcs = None
+
+
+def _get_libc_copy_funcs():
+  """Returns a pair of (functions func(src_fd, dst_fd, count) that copy in the kernel, errno getter)."""
+  global _libc_copy_funcs
+  if _libc_copy_funcs is None:
+    import ctypes
+    funcs = []
+    try:
+      libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+      libc = None
+    if libc is not None and hasattr(libc, 'copy_file_range'):
+      copy_file_range = libc.copy_file_range
+      copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                                  ctypes.c_size_t, ctypes.c_uint]
+      copy_file_range.restype = ctypes.c_ssize_t
+      funcs.append(lambda src_fd, dst_fd, count: copy_file_range(src_fd, None, dst_fd, None, count, 0))
+    if libc is not None and hasattr(libc, 'sendfile'):
+      sendfile = libc.sendfile
+      sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+      sendfile.restype = ctypes.c_ssize_t
+      funcs.append(lambda src_fd, dst_fd, count: sendfile(dst_fd, src_fd, None, count))
+    _libc_copy_funcs = (funcs, ctypes.get_errno)
+  return _libc_copy_funcs
+
+
+def _kernel_copy(src_fd, dst_fd):
+  """Copies the rest of a file without passing its content through this process, if possible.
+
+  Copies from the current offset of each fd, advancing the offsets as it goes.
+
+  :returns: True if the copy completed, False if the rest of the content must be copied some other way.
+  """
+  if not sys.platform.startswith('linux'):
+    return False
+  import fcntl
+  if os.lseek(src_fd, 0, os.SEEK_CUR) == 0:
+    try:
+      fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+      return True
+    except (IOError, OSError):
+      pass  # E.g., the filesystem doesn't support clones, or the files are on different filesystems.
+  funcs, get_errno = _get_libc_copy_funcs()
+  for func in funcs:
+    while True:
+      n = func(src_fd, dst_fd, _MAX_KERNEL_COPY)
+      if n == 0:
+        return True
+      if n < 0:
+        if get_errno() == errno.EINTR:
+          continue
+        break  # This function can't copy these files, so try the next one.
+  return False
+
+
 @contextmanager
 def temporary_dir(suffix='', prefix='gitshed.', ignore_errors=False, cleanup=True):
   """A context yielding an empty temporary directory.
@@ -63,20 +180,79 @@ def temporary_dir(suffix='', prefix='gitshed.', ignore_errors=False, cleanup=Tru
     shutil.rmtree(ret, ignore_errors=ignore_errors)
 
 
-def run_cmd_str(cmd_str):
+def run_cmd_str(cmd_str, stdin=None):
   """Spawns a command specified as a single string.
 
   Tokenizes the string appropriately, so the caller need not worry about spaces, escaping etc.
+
+  :param cmd_str: The command to run.
+  :param stdin: Optional data to write to the command's stdin.
   """
   cmd = shlex.split(cmd_str.encode('utf8'))
   try:
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate()
+    p = subprocess.Popen(cmd, stdin=None if stdin is None else subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate(stdin)
     return p.returncode, stdout, stderr
   except OSError as e:
     raise GitShedError('Error running "{0}": {1}'.format(' '.join(cmd), str(e)))
 
 
+def iter_cmd_output(cmd_str, delimiter):
+  """Spawns a command specified as a single string, and lazily splits its stdout into records.
+
+  Unlike run_cmd_str(), doesn't buffer the command's entire output in memory.
+
+  :param cmd_str: The command to run.
+  :param delimiter: The record delimiter (e.g., '\\n' or '\\0').
+  :raises GitShedError: If the command fails.
+  """
+  cmd = shlex.split(cmd_str.encode('utf8'))
+  # We don't read stderr until stdout is exhausted, so it goes to a file rather than a pipe: a
+  # command blocked on writing to a full stderr pipe would never finish writing to stdout.
+  with tempfile.TemporaryFile() as stderr:
+    try:
+      p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+    except OSError as e:
+      raise GitShedError('Error running "{0}": {1}'.format(' '.join(cmd), str(e)))
+    finished = False
+    try:
+      for record in iter_delimited(p.stdout, delimiter):
+        yield record
+      finished = True
+    finally:
+      p.stdout.close()
+      if not finished:
+        # The caller stopped early, so the rest of the output isn't wanted.
+        p.kill()
+        p.wait()
+    if p.wait():
+      stderr.seek(0)
+      raise GitShedError('Command failed: {0}.\nstderr: {1}'.format(cmd_str, stderr.read()))
+
+
+def iter_delimited(infile, delimiter, block_size=65536):
+  """Lazily splits the content of a file into records.
+
+  :param infile: The file to read.
+  :param delimiter: The record delimiter (e.g., '\\n' or '\\0').
+  :param block_size: Read the file in blocks of this many bytes.
+  :returns: An iterator over the non-empty records.
+  """
+  remainder = b''
+  while True:
+    block = infile.read(block_size)
+    if not block:
+      break
+    records = (remainder + block).split(delimiter)
+    remainder = records.pop()
+    for record in records:
+      if record:
+        yield record
+  if remainder:
+    yield remainder
+
+
 def can_ssh(host):
   """Checks if we can ssh to a given host.
 
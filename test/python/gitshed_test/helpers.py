@@ -59,4 +59,18 @@ def temporary_git_repo(seed_files=None):
         safe_makedirs(os.path.dirname(path))
         with open(path, 'w') as outfile:
           outfile.write(contents)
-      yield GitRepo(root)
+      repo = GitRepo(root)
+      try:
+        yield repo
+      finally:
+        repo.close()
+
+
+def commit_all(message='Test commit.'):
+  """Commits all changes in the git repo at the cwd."""
+  retcode, _, stderr = run_cmd_str('git add -A .')
+  if not retcode:
+    retcode, _, stderr = run_cmd_str(
+      'git -c user.name=gitshed_test -c user.email=gitshed_test@example.com commit -q -m "{0}"'.format(message))
+  if retcode:
+    raise GitShedError('Failed to commit to temporary git repo: {0}'.format(stderr))
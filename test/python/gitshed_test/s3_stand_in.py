@@ -0,0 +1,165 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from contextlib import contextmanager
+import hashlib
+import itertools
+import re
+from SocketServer import ThreadingMixIn
+import threading
+import urllib
+import urlparse
+from xml.etree import ElementTree
+
+
+class S3StandIn(object):
+  """An in-memory stand-in for the subset of the S3 API that S3ContentStore uses.
+
+  Requires requests to carry a SigV4 Authorization header for the expected access key, but doesn't
+  verify signatures.
+  """
+
+  def __init__(self, bucket, access_key, max_keys=1000):
+    """
+    :param bucket: The only bucket.
+    :param access_key: Reject requests that aren't signed with this access key.
+    :param max_keys: Return at most this many keys per list request.
+    """
+    self.bucket = bucket
+    self.access_key = access_key
+    self.max_keys = max_keys
+    self.objects = {}  # Object key -> (data, mode).
+    self.requests = []  # (method, sorted query param names) of each request received.
+    self._uploads = {}  # Upload id -> (object key, mode, map of part number -> data).
+    self._upload_ids = itertools.count(1)
+    self._lock = threading.Lock()
+
+  def handle(self, method, path, query, headers, body):
+    """Handles a request.
+
+    :returns: A triple of (status, map of header name -> value, body).
+    """
+    with self._lock:
+      self.requests.append((method, sorted(query.keys())))
+    if not headers.get('Authorization', '').startswith(
+        'AWS4-HMAC-SHA256 Credential={0}/'.format(self.access_key)):
+      return 403, {}, b'<Error><Code>AccessDenied</Code></Error>'
+    bucket, _, key = urllib.unquote(path).lstrip('/').partition('/')
+    if bucket != self.bucket:
+      return 404, {}, b'<Error><Code>NoSuchBucket</Code></Error>'
+    if not key:
+      return self._list(query)
+    with self._lock:
+      if method == 'POST' and 'uploads' in query:
+        upload_id = '{0}'.format(next(self._upload_ids))
+        self._uploads[upload_id] = (key, headers.get('x-amz-meta-mode'), {})
+        return 200, {}, '<InitiateMultipartUploadResult><UploadId>{0}</UploadId>' \
+                        '</InitiateMultipartUploadResult>'.format(upload_id).encode('utf-8')
+      if 'uploadId' in query:
+        return self._multipart(method, key, query, body)
+      if method == 'PUT':
+        self.objects[key] = (body, headers.get('x-amz-meta-mode'))
+        return 200, {'ETag': self._etag(body)}, b''
+      if key not in self.objects:
+        return 404, {}, b'<Error><Code>NoSuchKey</Code></Error>'
+      data, mode = self.objects[key]
+    response_headers = {'x-amz-meta-mode': mode} if mode else {}
+    if method == 'HEAD':
+      return 200, dict(response_headers, **{'Content-Length': len(data)}), b''
+    match = re.match(r'^bytes=(\d+)-(\d+)$', headers.get('Range', ''))
+    if not match:
+      return 200, response_headers, data
+    start, end = int(match.group(1)), min(int(match.group(2)), len(data) - 1)
+    if start >= len(data):
+      return 416, {}, b'<Error><Code>InvalidRange</Code></Error>'
+    response_headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end, len(data))
+    return 206, response_headers, data[start:end + 1]
+
+  def _multipart(self, method, key, query, body):
+    upload_id = query['uploadId']
+    if upload_id not in self._uploads or self._uploads[upload_id][0] != key:
+      return 404, {}, b'<Error><Code>NoSuchUpload</Code></Error>'
+    _, mode, parts = self._uploads[upload_id]
+    if method == 'PUT':
+      parts[int(query['partNumber'])] = body
+      return 200, {'ETag': self._etag(body)}, b''
+    if method == 'DELETE':
+      del self._uploads[upload_id]
+      return 204, {}, b''
+    data = []
+    for part in ElementTree.fromstring(body).iter('Part'):
+      part_data = parts.get(int(part.find('PartNumber').text))
+      if part_data is None or self._etag(part_data) != part.find('ETag').text:
+        return 400, {}, b'<Error><Code>InvalidPart</Code></Error>'
+      data.append(part_data)
+    del self._uploads[upload_id]
+    self.objects[key] = (b''.join(data), mode)
+    return 200, {}, b'<CompleteMultipartUploadResult/>'
+
+  def _list(self, query):
+    prefix = query.get('prefix', '')
+    with self._lock:
+      # With the '/' delimiter, only list objects directly under the prefix.
+      keys = sorted(key for key in self.objects if key.startswith(prefix) and '/' not in key[len(prefix):])
+    keys = [key for key in keys if key > query.get('continuation-token', '')]
+    truncated = len(keys) > self.max_keys
+    keys = keys[:self.max_keys]
+    xml = ['<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">']
+    xml.extend('<Contents><Key>{0}</Key></Contents>'.format(key) for key in keys)
+    xml.append('<IsTruncated>{0}</IsTruncated>'.format('true' if truncated else 'false'))
+    if truncated:
+      xml.append('<NextContinuationToken>{0}</NextContinuationToken>'.format(keys[-1]))
+    xml.append('</ListBucketResult>')
+    return 200, {}, ''.join(xml).encode('utf-8')
+
+  @staticmethod
+  def _etag(data):
+    return '"{0}"'.format(hashlib.md5(data).hexdigest())
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def _handle(self):
+    length = int(self.headers.get('Content-Length', 0))
+    body = self.rfile.read(length) if length else b''
+    parsed = urlparse.urlparse(self.path)
+    query = dict((k, v[0]) for k, v in urlparse.parse_qs(parsed.query, keep_blank_values=True).items())
+    status, headers, response_body = self.server.stand_in.handle(
+      self.command, parsed.path, query, self.headers, body)
+    self.send_response(status)
+    if 'Content-Length' not in headers:
+      headers['Content-Length'] = len(response_body)
+    for name, value in headers.items():
+      self.send_header(name, '{0}'.format(value))
+    self.end_headers()
+    if self.command != 'HEAD':
+      self.wfile.write(response_body)
+
+  do_DELETE = do_GET = do_HEAD = do_POST = do_PUT = _handle
+
+  def log_message(self, format, *args):
+    pass
+
+
+@contextmanager
+def s3_stand_in(bucket='bucket', access_key='ACCESSKEY', max_keys=1000):
+  """A context yielding a (S3StandIn, endpoint URL) pair, for an S3 stand-in served on localhost."""
+  stand_in = S3StandIn(bucket, access_key, max_keys)
+  server = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+  server.stand_in = stand_in
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  try:
+    yield stand_in, 'http://127.0.0.1:{0}'.format(server.server_address[1])
+  finally:
+    server.shutdown()
+    server.server_close()
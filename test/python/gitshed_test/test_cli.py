@@ -0,0 +1,34 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from gitshed_test.helpers import temporary_git_repo, temporary_test_dir
+
+
+class CliTest(unittest.TestCase):
+  @staticmethod
+  def _run(*args):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    subprocess.check_output([sys.executable, '-m', 'gitshed.main'] + list(args), env=env)
+
+  def test_argfile(self):
+    with temporary_test_dir() as tmpdir:
+      config = json.dumps({'content_store': {'local': {'root': os.path.join(tmpdir, 'content_store')}}})
+      seed_files = {os.path.join('.gitshed', 'config.json'): config, 'a': 'A', 'b': 'B', 'c': 'C', 'd': 'D'}
+      with temporary_git_repo(seed_files):
+        crlf_argfile = os.path.join(tmpdir, 'crlf_argfile')
+        with open(crlf_argfile, 'wb') as outfile:
+          outfile.write(b'a\r\nb\r\n')
+        self._run('manage', '-f', crlf_argfile)
+        null_argfile = os.path.join(tmpdir, 'null_argfile')
+        with open(null_argfile, 'wb') as outfile:
+          outfile.write(b'c\0d\0')
+        self._run('manage', '-z', '-f', null_argfile)
+        self.assertEqual([True, True, True, True], [os.path.islink(path) for path in ['a', 'b', 'c', 'd']])
@@ -0,0 +1,161 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+import os
+import threading
+import time
+import unittest
+
+import pytest
+
+from gitshed.concurrency import AdaptiveConcurrency, ConcurrencyMemory
+from gitshed.error import GitShedError
+from gitshed.local_content_store import LocalContentStore
+from gitshed_test.helpers import temporary_test_dir
+
+
+class ConcurrencyTest(unittest.TestCase):
+  def test_aimd(self):
+    now = [0.0]
+    concurrency = AdaptiveConcurrency(2, maximum=4, clock=lambda: now[0])
+
+    def run_round(seconds_per_op):
+      for _ in range(concurrency.limit):
+        with concurrency.slot():
+          now[0] += seconds_per_op
+
+    # Increase while throughput improves, up to the maximum.
+    run_round(1.0)
+    self.assertEqual(3, concurrency.limit)
+    run_round(0.5)
+    self.assertEqual(4, concurrency.limit)
+    run_round(0.25)
+    self.assertEqual(4, concurrency.limit)
+    self.assertEqual(4, concurrency.best_limit)
+
+    # Decrease when throughput gets worse.
+    run_round(1.0)
+    self.assertEqual(3, concurrency.limit)
+    # Hold steady when it's unchanged.
+    run_round(1.0)
+    self.assertEqual(3, concurrency.limit)
+
+    # Halve on errors.
+    with pytest.raises(GitShedError):
+      with concurrency.slot():
+        raise GitShedError('Failed.')
+    self.assertEqual(1, concurrency.limit)
+    concurrency.record_error()
+    self.assertEqual(1, concurrency.limit)
+    self.assertEqual(4, concurrency.best_limit)
+
+  def test_limit(self):
+    concurrency = AdaptiveConcurrency(3, minimum=3)
+    lock = threading.Lock()
+    in_flight = [0]
+    max_in_flight = [0]
+    go = threading.Event()
+
+    def work():
+      go.wait()  # Start all at once, however slowly the threads start.
+      with concurrency.slot():
+        with lock:
+          in_flight[0] += 1
+          max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        time.sleep(0.05)
+        with lock:
+          in_flight[0] -= 1
+
+    threads = [threading.Thread(target=work) for _ in range(10)]
+    for thread in threads:
+      thread.start()
+    go.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(3, max_in_flight[0])
+    # A fixed limit stays fixed.
+    self.assertEqual(3, concurrency.limit)
+
+  def test_rounds_end_with_slots_in_flight(self):
+    concurrency = AdaptiveConcurrency(4)
+    started = threading.Semaphore(0)
+    finish = threading.Event()
+    errors = []
+
+    def work():
+      try:
+        with concurrency.slot():
+          started.release()
+          finish.wait()
+      except Exception as e:
+        errors.append(e)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    for _ in range(4):
+      started.acquire()
+    # Halving the limit starts a new round while four slots are in flight, and the others wait.
+    # Those four then end the new round, and the waiting slots must get to run.
+    concurrency.record_error()
+    self.assertEqual(2, concurrency.limit)
+    finish.set()
+    for thread in threads:
+      thread.join(10)
+      self.assertFalse(thread.is_alive())
+    self.assertEqual([], errors)
+
+  def test_memory(self):
+    with temporary_test_dir() as tmpdir:
+      path = os.path.join(tmpdir, 'state', 'concurrency.json')
+      memory = ConcurrencyMemory(path)
+      self.assertIsNone(memory.recall('store', 'get'))
+      memory.remember('store', {'get': 20, 'put': 6})
+      memory.remember('other_store', {'get': 3})
+      self.assertEqual(20, ConcurrencyMemory(path).recall('store', 'get'))
+      self.assertEqual(6, ConcurrencyMemory(path).recall('store', 'put'))
+      self.assertIsNone(ConcurrencyMemory(path).recall('other_store', 'put'))
+
+  def test_transfer_retries(self):
+    class FlakyLocalContentStore(LocalContentStore):
+      def __init__(self, root):
+        super(FlakyLocalContentStore, self).__init__(root)
+        self.num_failures = 0
+
+      def raw_get(self, content_store_paths, target_dir_tmp):
+        if self.num_failures < 2:
+          self.num_failures += 1
+          raise GitShedError('Connection dropped.')
+        super(FlakyLocalContentStore, self).raw_get(content_store_paths, target_dir_tmp)
+
+    with temporary_test_dir() as file_root:
+      with temporary_test_dir() as content_store_root:
+        path = os.path.join(file_root, 'file')
+        with open(path, 'w') as outfile:
+          outfile.write(b'CONTENT')
+        content_store = FlakyLocalContentStore(content_store_root)
+        key = content_store.put([path])[0]
+        os.remove(path)
+
+        # Retries are off by default.
+        with pytest.raises(GitShedError):
+          content_store.get({key: [path]})
+        self.assertEqual(1, content_store.num_failures)
+        content_store.num_failures = 0
+
+        content_store.use_transfer_retries(2)
+        content_store.use_adaptive_concurrency(AdaptiveConcurrency(8, maximum=8), AdaptiveConcurrency(4))
+        content_store.get({key: [path]})
+        with open(path, 'r') as infile:
+          self.assertEqual(b'CONTENT', infile.read())
+        self.assertEqual(2, content_store.num_failures)
+        # Each failure halved the get concurrency.
+        self.assertEqual(2, content_store.get_concurrency.limit)
+
+        # Persistent failures are still errors.
+        content_store.num_failures = -10
+        with pytest.raises(GitShedError):
+          content_store.get({key: [path + '2']})
@@ -4,7 +4,12 @@ from __future__ import (nested_scopes, generators, division, absolute_import, wi
                         print_function, unicode_literals)
 
 from collections import defaultdict
+import errno
+import io
 import os
+import shutil
+import sys
+import threading
 import unittest
 
 import pytest
@@ -12,9 +17,20 @@ import pytest
 from gitshed.content_store import ContentStore
 from gitshed.error import GitShedError
 from gitshed.local_content_store import LocalContentStore
+from gitshed.manifest import KeyManifest
+from gitshed.protocol import PUT, encode_fields, write_frame
 from gitshed.remote_content_store import RSyncedRemoteContentStore
+from gitshed.replicated_content_store import ReplicaStats, ReplicatedContentStore
+from gitshed.routed_content_store import RoutedContentStore
+from gitshed.s3_content_store import S3ContentStore
+from gitshed.served_content_store import ServedContentStore
+from gitshed.server import ContentStoreServer
+from gitshed.simulated_content_store import SimulatedContentStore
+from gitshed.staging import StagingArea
+from gitshed.tiered_content_store import TieredContentStore
 from gitshed.util import can_ssh, run_cmd_str, safe_makedirs
 from gitshed_test.helpers import cd, temporary_git_repo, temporary_test_dir
+from gitshed_test.s3_stand_in import s3_stand_in
 
 
 class ContentStoreTest(unittest.TestCase):
@@ -44,6 +60,20 @@ class ContentStoreTest(unittest.TestCase):
     self.assertTrue( ContentStore.is_valid_key('8c61f083227d5957c825defd97363c77d2122746_00644'))
 
 
+  def test_versioned_keys(self):
+    sha1_key = '8c61f083227d5957c825defd97363c77d2122746_00644'
+    blake2b_key = 'blake2b-{0}_00755'.format('0123456789abcdef' * 4)
+    self.assertTrue(ContentStore.is_valid_key(blake2b_key))
+    self.assertFalse(ContentStore.is_valid_key('blake2b-{0}_00755'.format('0123456789abcdef' * 3)))
+    self.assertFalse(ContentStore.is_valid_key('md5-{0}_00755'.format('0123456789abcdef' * 4)))
+    self.assertEqual('8c61f083227d5957c825defd97363c77d2122746', ContentStore.sha_from_key(sha1_key))
+    self.assertEqual('00644', ContentStore.mode_from_key(sha1_key))
+    self.assertEqual('sha1', ContentStore.algorithm_from_key(sha1_key))
+    self.assertEqual('blake2b-{0}'.format('0123456789abcdef' * 4), ContentStore.sha_from_key(blake2b_key))
+    self.assertEqual('00755', ContentStore.mode_from_key(blake2b_key))
+    self.assertEqual('blake2b', ContentStore.algorithm_from_key(blake2b_key))
+    self.assertFalse(ContentStore.is_supported_hash_algorithm('md5'))
+
   def test_content_store_path_from_key(self):
     path = ContentStore().content_store_path_from_key('da39a3ee5e6b4b0d3255bfef95601890afd80709')
     self.assertEquals('content_store/da39a3ee5e6b4b0d3255bfef95601890afd80709', path)
@@ -65,6 +95,156 @@ class ContentStoreTest(unittest.TestCase):
     for chunk_size in self.chunk_sizes:
       self._test_local_content_store(chunk_size)
 
+  def test_staged_content_store(self):
+    real_link = os.link
+
+    def cross_device_link(src, dst):
+      raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+    for link in [real_link, cross_device_link]:
+      with temporary_test_dir() as content_store_root:
+        with temporary_test_dir() as staging_root:
+          content_store = LocalContentStore(content_store_root)
+          staging_area = StagingArea(staging_root)
+          content_store.use_staging_area(staging_area)
+          # Content that can't be hard-linked into the staging area is copied into it instead.
+          os.link = link
+          try:
+            self._test_contentstore(content_store)
+          finally:
+            os.link = real_link
+          staging_area.close()
+          self.assertEqual([], os.listdir(staging_root))
+
+  def test_direct_local_content_store(self):
+    real_link = os.link
+
+    def cross_device_link(src, dst):
+      raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+    for link in [real_link, cross_device_link]:
+      with temporary_test_dir() as content_store_root:
+        content_store = LocalContentStore(content_store_root, direct=True)
+        # Content that can't be hard-linked into place is symlinked instead.
+        os.link = link
+        try:
+          self._test_contentstore(content_store)
+        finally:
+          os.link = real_link
+
+    with temporary_test_dir() as content_store_root:
+      with temporary_test_dir() as file_root:
+        src_path = os.path.join(file_root, 'src')
+        with open(src_path, 'w') as outfile:
+          outfile.write('CONTENT')
+        key = ContentStore.key(src_path)
+        content_store = LocalContentStore(content_store_root)
+        content_store.put([src_path])
+        store_path = os.path.join(content_store_root, content_store.content_store_path_from_key(key))
+
+        target_path = os.path.join(file_root, 'dir', 'target')
+        LocalContentStore(content_store_root, direct=True).get({key: [target_path]})
+        self.assertTrue(os.path.samefile(store_path, target_path))
+        self.assertFalse(os.path.islink(target_path))
+        os.link = cross_device_link
+        try:
+          # Replaces what's already there.
+          LocalContentStore(content_store_root, direct=True).get({key: [target_path]})
+        finally:
+          os.link = real_link
+        self.assertEqual(store_path, os.readlink(target_path))
+        self.assertEqual(['target'], os.listdir(os.path.dirname(target_path)))
+
+        # Tampered-with content is caught, unless verification is off.
+        os.chmod(store_path, 0644)
+        with open(store_path, 'w') as outfile:
+          outfile.write('TAMPERED')
+        os.chmod(store_path, 0444)
+        other_target_path = os.path.join(file_root, 'other_target')
+        with pytest.raises(GitShedError):
+          LocalContentStore(content_store_root, direct=True).get({key: [other_target_path]})
+        self.assertFalse(os.path.exists(other_target_path))
+        LocalContentStore(content_store_root, direct=True, verify=False).get({key: [other_target_path]})
+        self.assertTrue(os.path.samefile(store_path, other_target_path))
+
+  def test_dedupe_content_store(self):
+    class CountingLocalContentStore(LocalContentStore):
+      def __init__(self, root):
+        super(CountingLocalContentStore, self).__init__(root, chunk_size=1)
+        self.fetched = []
+
+      def raw_get(self, content_store_paths, target_dir_tmp):
+        self.fetched.extend(content_store_paths)
+        super(CountingLocalContentStore, self).raw_get(content_store_paths, target_dir_tmp)
+
+    for chunk_size in self.chunk_sizes:
+      with temporary_test_dir() as content_store_root:
+        content_store = LocalContentStore(content_store_root, chunk_size=chunk_size)
+        content_store.use_dedupe()
+        self._test_contentstore(content_store)
+
+    with temporary_test_dir() as content_store_root:
+      with temporary_test_dir() as file_root:
+        # The same content, with different modes.
+        paths = [os.path.join(file_root, name) for name in ['a', 'b', 'c']]
+        for path, mode in zip(paths, [0755, 0644, 0644]):
+          with open(path, 'w') as outfile:
+            outfile.write('CONTENT')
+          os.chmod(path, mode)
+        content_store = CountingLocalContentStore(content_store_root)
+        content_store.use_dedupe()
+        keys = content_store.put(paths)
+        self.assertEqual(2, len(set(keys)))
+        sha = ContentStore.sha_from_key(keys[0])
+        self.assertEqual([sha], os.listdir(os.path.join(content_store_root, 'content_store')))
+        self.assertEqual(set(), content_store.missing(keys))
+        self.assertEqual({keys[0]: 7, keys[1]: 7}, content_store.sizes(keys))
+
+        # Fetched once, even with a chunk per key, with each key's mode applied.
+        targets = [os.path.join(file_root, 'targets', name) for name in ['a', 'b', 'c']]
+        content_store.get({keys[0]: [targets[0]], keys[1]: targets[1:]})
+        self.assertEqual(['content_store/{0}'.format(sha)], content_store.fetched)
+        for target, key in zip(targets, keys):
+          self.assertEqual(ContentStore.key(target), key)
+
+        # Content stored under its key, before dedupe, is still found.
+        legacy_path = os.path.join(file_root, 'legacy')
+        with open(legacy_path, 'w') as outfile:
+          outfile.write('LEGACY CONTENT')
+        legacy_key = LocalContentStore(content_store_root).put([legacy_path])[0]
+        self.assertTrue(content_store.has(legacy_key))
+        self.assertEqual(set(), content_store.missing([legacy_key]))
+        self.assertEqual({legacy_key: 14}, content_store.sizes([legacy_key]))
+        legacy_target = os.path.join(file_root, 'targets', 'legacy')
+        content_store.get({legacy_key: [legacy_target]})
+        self.assertEqual(legacy_key, ContentStore.key(legacy_target))
+
+        # Direct mode links to content with the right mode, and copies content with any other.
+        direct_content_store = LocalContentStore(content_store_root, direct=True)
+        direct_content_store.use_dedupe()
+        direct_targets = [os.path.join(file_root, 'direct', name) for name in ['a', 'b', 'legacy']]
+        direct_content_store.get(dict(zip(keys[:2] + [legacy_key], [[t] for t in direct_targets])))
+        store_paths = [os.path.join(content_store_root, 'content_store', name) for name in [sha, legacy_key]]
+        self.assertEqual([True, False, True],
+                         [any(os.path.samefile(t, p) for p in store_paths) for t in direct_targets])
+        for target, key in zip(direct_targets, keys[:2] + [legacy_key]):
+          self.assertEqual(key, ContentStore.key(target))
+
+        # Concurrent puts of the same deduped content, under different keys, don't collide.
+        errors = []
+        def put(src_path, key):
+          try:
+            for _ in range(20):
+              content_store.put_keyed([(src_path, key)])
+          except Exception as e:
+            errors.append(e)
+        threads = [threading.Thread(target=put, args=(paths[i % 2], keys[i % 2])) for i in range(4)]
+        for thread in threads:
+          thread.start()
+        for thread in threads:
+          thread.join()
+        self.assertEqual([], errors)
+
   def test_remote_content_store(self):
     if not can_ssh('localhost'):
       pytest.skip(
@@ -75,6 +255,565 @@ class ContentStoreTest(unittest.TestCase):
     for chunk_size in self.chunk_sizes:
       self._test_remote_content_store(chunk_size)
 
+  def test_tiered_content_store(self):
+    for chunk_size in self.chunk_sizes:
+      with temporary_test_dir() as fast_root:
+        with temporary_test_dir() as origin_root:
+          content_store = TieredContentStore([LocalContentStore(fast_root), LocalContentStore(origin_root)],
+                                             backfill=True, chunk_size=chunk_size)
+          self._test_contentstore(content_store)
+
+  def test_tiered_content_store_read_through(self):
+    with temporary_test_dir() as file_root:
+      with temporary_test_dir() as fast_root:
+        with temporary_test_dir() as origin_root:
+          fast_store = LocalContentStore(fast_root)
+          origin_store = LocalContentStore(origin_root)
+          path1 = os.path.join(file_root, 'file1')
+          path2 = os.path.join(file_root, 'file2')
+          for path, content in [(path1, b'CONTENT1'), (path2, b'CONTENT2')]:
+            with open(path, 'w') as outfile:
+              outfile.write(content)
+          key1, key2 = ContentStore.key(path1), ContentStore.key(path2)
+
+          # Puts write through to the origin only.
+          TieredContentStore([fast_store, origin_store]).put([path1, path2])
+          self.assertFalse(fast_store.has(key1))
+          self.assertTrue(origin_store.has(key1))
+          os.remove(path1)
+          os.remove(path2)
+
+          # Without backfill, content stays where it is.
+          TieredContentStore([fast_store, origin_store]).get({key1: [path1]})
+          self.assertFalse(fast_store.has(key1))
+          with open(path1, 'r') as infile:
+            self.assertEqual(b'CONTENT1', infile.read())
+
+          # With backfill, misses are written to the faster tiers.
+          TieredContentStore([fast_store, origin_store], backfill=True).get({key2: [path2]})
+          self.assertTrue(fast_store.has(key2))
+
+          # Content in a faster tier is read from it.
+          os.remove(path2)
+          TieredContentStore([fast_store, LocalContentStore(os.path.join(origin_root, 'nonexistent'))]).get(
+            {key2: [path2]})
+          with open(path2, 'r') as infile:
+            self.assertEqual(b'CONTENT2', infile.read())
+
+          # Missing everywhere is an error.
+          with pytest.raises(GitShedError):
+            TieredContentStore([fast_store, fast_store]).get({key1: [path1 + '.missing']})
+
+  def test_tiered_content_store_backfill_with_dedupe(self):
+    with temporary_test_dir() as file_root:
+      with temporary_test_dir() as fast_root:
+        with temporary_test_dir() as origin_root:
+          fast_store = LocalContentStore(fast_root)
+          content_store = TieredContentStore([fast_store, LocalContentStore(origin_root)], backfill=True)
+          content_store.use_dedupe()
+          path = os.path.join(file_root, 'file')
+          with open(path, 'w') as outfile:
+            outfile.write(b'CONTENT')
+          key, = content_store.put([path])
+          self.assertEqual([], fast_store.raw_list('content_store'))
+          os.remove(path)
+
+          # Deduped content is stored under its sha, and is back-filled too.
+          content_store.get({key: [path]})
+          self.assertEqual([ContentStore.sha_from_key(key)], fast_store.raw_list('content_store'))
+
+          # Corrupt deduped content isn't back-filled.
+          shutil.rmtree(os.path.join(fast_root, 'content_store'))
+          with open(os.path.join(file_root, '0' * 40), 'w') as outfile:
+            outfile.write(b'CONTENT')
+          content_store._backfill_tiers([fast_store], ['content_store/{0}'.format('0' * 40)], file_root)
+          self.assertEqual([], fast_store.raw_list('content_store'))
+
+  def test_replicated_content_store(self):
+    for chunk_size in self.chunk_sizes:
+      with temporary_test_dir() as root1:
+        with temporary_test_dir() as root2:
+          content_store = ReplicatedContentStore([LocalContentStore(root1), LocalContentStore(root2)],
+                                                 chunk_size=chunk_size)
+          self._test_contentstore(content_store)
+
+  def test_replicated_content_store_quorum_and_failover(self):
+    class BrokenLocalContentStore(LocalContentStore):
+      def raw_put(self, src_paths, content_store_dir):
+        raise GitShedError('Broken.')
+
+    with temporary_test_dir() as file_root:
+      with temporary_test_dir() as root1:
+        with temporary_test_dir() as root2:
+          store1 = LocalContentStore(root1)
+          broken_store = BrokenLocalContentStore(root2)
+          path = os.path.join(file_root, 'file')
+          with open(path, 'w') as outfile:
+            outfile.write(b'CONTENT')
+          key = ContentStore.key(path)
+
+          with pytest.raises(GitShedError):
+            ReplicatedContentStore([store1, broken_store]).put([path])
+          ReplicatedContentStore([broken_store, store1], write_quorum=1).put([path])
+          self.assertTrue(store1.has(key))
+          self.assertFalse(broken_store.has(key))
+
+          # The preferred replica doesn't have the content, so we fail over to the other one.
+          os.remove(path)
+          replicated_store = ReplicatedContentStore([broken_store, store1], write_quorum=1)
+          replicated_store.get({key: [path]})
+          with open(path, 'r') as infile:
+            self.assertEqual(b'CONTENT', infile.read())
+          # Not having content isn't a failure, so the replica keeps its place.
+          self.assertEqual([broken_store, store1], [r for r, _ in replicated_store._replicas_by_preference()])
+
+          # But a replica that fails to provide content it has is now tried last.
+          class FailingLocalContentStore(LocalContentStore):
+            def raw_get(self, content_store_paths, target_dir_tmp):
+              raise IOError('Broken.')
+
+          failing_store = FailingLocalContentStore(root1)
+          os.remove(path)
+          replicated_store = ReplicatedContentStore([failing_store, store1], write_quorum=1)
+          replicated_store.get({key: [path]})
+          with open(path, 'r') as infile:
+            self.assertEqual(b'CONTENT', infile.read())
+          self.assertEqual([store1, failing_store], [r for r, _ in replicated_store._replicas_by_preference()])
+
+  def test_routed_content_store(self):
+    for chunk_size in self.chunk_sizes:
+      with temporary_test_dir() as root1:
+        with temporary_test_dir() as root2:
+          content_store = RoutedContentStore({'bulk': LocalContentStore(root1), 'fast': LocalContentStore(root2)},
+                                             [(['*1'], 'bulk')], 'fast', chunk_size=chunk_size)
+          self._test_contentstore(content_store)
+
+  def test_routed_content_store_routing(self):
+    with temporary_test_dir() as file_root:
+      with temporary_test_dir() as bulk_root:
+        with temporary_test_dir() as fast_root:
+          bulk_store = LocalContentStore(bulk_root)
+          fast_store = LocalContentStore(fast_root)
+          stores = {'bulk': bulk_store, 'fast': fast_store}
+          routes = [(['models/*', '*.ckpt'], 'bulk')]
+          self.assertEqual('bulk', RoutedContentStore(stores, routes, 'fast').store_name_for_path('models/a/b.bin'))
+          self.assertEqual('bulk', RoutedContentStore(stores, routes, 'fast').store_name_for_path('x/y.ckpt'))
+          self.assertEqual('bulk', RoutedContentStore(stores, routes, 'fast').store_name_for_path('./models/c.bin'))
+          self.assertEqual('fast', RoutedContentStore(stores, routes, 'fast').store_name_for_path('fixtures/z.json'))
+          with pytest.raises(GitShedError):
+            RoutedContentStore(stores, [(['*'], 'nonexistent')], 'fast')
+
+          with cd(file_root):
+            model_path = os.path.join('models', 'model.bin')
+            fixture_path = os.path.join('fixtures', 'fixture.json')
+            for path, content in [(model_path, b'MODEL'), (fixture_path, b'FIXTURE')]:
+              safe_makedirs(os.path.dirname(path))
+              with open(path, 'w') as outfile:
+                outfile.write(content)
+            model_key, fixture_key = ContentStore.key(model_path), ContentStore.key(fixture_path)
+
+            # Puts route content by the path it's put from.
+            RoutedContentStore(stores, routes, 'fast').put_keyed([(model_path, model_key),
+                                                                  (fixture_path, fixture_key)])
+            self.assertEqual({model_key}, fast_store.missing([model_key, fixture_key]))
+            self.assertEqual({fixture_key}, bulk_store.missing([model_key, fixture_key]))
+            os.remove(model_path)
+            os.remove(fixture_path)
+
+            # Gets look only in the store that a noted path routes to, if the content is there.
+            class CountingLocalContentStore(LocalContentStore):
+              def __init__(self, root):
+                super(CountingLocalContentStore, self).__init__(root)
+                self.gets = 0
+
+              def raw_get_partial(self, content_store_paths, target_dir_tmp):
+                self.gets += 1
+                return super(CountingLocalContentStore, self).raw_get_partial(content_store_paths, target_dir_tmp)
+
+            counting_bulk_store = CountingLocalContentStore(bulk_root)
+            counting_fast_store = CountingLocalContentStore(fast_root)
+            routed_store = RoutedContentStore({'bulk': counting_bulk_store, 'fast': counting_fast_store},
+                                              routes, 'fast')
+            routed_store.note_paths([(model_path, model_key)])
+            routed_store.get({model_key: [model_path]})
+            self.assertEqual((1, 0), (counting_bulk_store.gets, counting_fast_store.gets))
+            with open(model_path, 'r') as infile:
+              self.assertEqual(b'MODEL', infile.read())
+
+            # If the routes have changed since the content was put, it's still found in the other stores.
+            moved_store = RoutedContentStore(stores, [(['fixtures/*'], 'bulk')], 'fast')
+            moved_store.note_paths([(fixture_path, fixture_key), (model_path, model_key)])
+            self.assertEqual(set(), moved_store.missing([model_key, fixture_key]))
+            moved_store.get({fixture_key: [fixture_path]})
+            with open(fixture_path, 'r') as infile:
+              self.assertEqual(b'FIXTURE', infile.read())
+
+            # Missing everywhere is an error.
+            with pytest.raises(GitShedError):
+              moved_store.get({model_key.replace('0', '1'): [model_path + '.missing']})
+
+  def test_replica_stats(self):
+    now = [1000.0]
+    clock = lambda: now[0]
+    fast, slow, failed, unmeasured = [ReplicaStats(clock) for _ in range(4)]
+    fast.record_success(1.0, 10)
+    slow.record_success(10.0, 10)
+    failed.record_success(0.1, 10)
+    failed.record_failure()
+    ordered = sorted([failed, slow, fast, unmeasured], key=lambda stats: stats.sort_key())
+    self.assertEqual([unmeasured, fast, slow, failed], ordered)
+
+    # Failures and measurements expire.
+    now[0] += 100
+    self.assertEqual((False, 0), failed.sort_key())
+    self.assertEqual((False, 0), slow.sort_key())
+
+  @staticmethod
+  def _serve_command(root):
+    # Runs `git shed serve` locally, as it would be run on the content store host.
+    script = 'import sys; sys.path[:0] = {0!r}; from gitshed.main import main; sys.exit(main(sys.argv[1:]))'.format(sys.path)
+    return [sys.executable, '-c', script, 'serve', root]
+
+  def test_served_content_store(self):
+    for chunk_size in self.chunk_sizes:
+      with temporary_test_dir() as root:
+        content_store = ServedContentStore(self._serve_command(root), num_sessions=2, chunk_size=chunk_size)
+        try:
+          self._test_contentstore(content_store)
+        finally:
+          content_store.close()
+
+  def test_served_content_store_ranges(self):
+    with temporary_test_dir() as file_root:
+      with temporary_test_dir() as root:
+        # Small ranges, so that files are transferred as many ranges, several at a time.
+        content_store = ServedContentStore(self._serve_command(root), range_size=1000, ranges_in_flight=3)
+        try:
+          paths = []
+          for name, size in [('empty', 0), ('small', 10), ('exact', 3000), ('large', 123456)]:
+            path = os.path.join(file_root, name)
+            with open(path, 'wb') as outfile:
+              outfile.write(os.urandom(size))
+            paths.append(path)
+          contents = []
+          for path in paths:
+            with open(path, 'rb') as infile:
+              contents.append(infile.read())
+          keys = content_store.put(paths)
+          self.assertEqual(sorted(keys), sorted(content_store.raw_list('content_store')))
+          self.assertEqual(123456, content_store.sizes(keys)[keys[3]])
+          for path in paths:
+            os.remove(path)
+          content_store.get(dict((key, [path]) for key, path in zip(keys, paths)))
+          for path, content in zip(paths, contents):
+            with open(path, 'rb') as infile:
+              self.assertEqual(content, infile.read())
+
+          # Errors are reported without breaking the session.
+          with pytest.raises(GitShedError):
+            content_store.raw_get(['../escape'], file_root)
+          self.assertTrue(content_store.has(keys[0]))
+        finally:
+          content_store.close()
+
+  def test_served_content_store_ranges_across_sessions(self):
+    with temporary_test_dir() as file_root:
+      with temporary_test_dir() as root:
+        # Each of a file's ranges must reach the same server process, whichever session is next.
+        content_store = ServedContentStore(self._serve_command(root), num_sessions=2, range_size=1000)
+        try:
+          paths = []
+          for name, size in [('a', 5000), ('b', 4321), ('c', 10)]:
+            path = os.path.join(file_root, name)
+            with open(path, 'wb') as outfile:
+              outfile.write(os.urandom(size))
+            paths.append(path)
+          keys = content_store.put(paths)
+          self.assertEqual(set(), content_store.missing(keys))
+          self.assertEqual([5000, 4321, 10], [content_store.sizes(keys)[key] for key in keys])
+        finally:
+          content_store.close()
+
+  def test_served_content_store_unconfirmed_put(self):
+    with temporary_test_dir() as file_root:
+      # A server that acknowledges every request, but never stores anything.
+      script = '; '.join([
+        'import sys',
+        'sys.path[:0] = {0!r}'.format(sys.path),
+        'from gitshed.protocol import *',
+        'frame = read_frame(sys.stdin)',
+        'write_frame(sys.stdout, OK, frame[1], encode_fields([PROTOCOL_VERSION]))',
+        'frames = iter(lambda: read_frame(sys.stdin), None)',
+        '[write_frame(sys.stdout, OK, frame[1]) for frame in frames]',
+      ])
+      content_store = ServedContentStore([sys.executable, '-c', script])
+      try:
+        path = os.path.join(file_root, 'a')
+        with open(path, 'wb') as outfile:
+          outfile.write(b'CONTENT')
+        with pytest.raises(GitShedError):
+          content_store.raw_put([path], 'content_store')
+      finally:
+        content_store.close()
+
+  def test_server_removes_partial_uploads(self):
+    with temporary_test_dir() as root:
+      requests = io.BytesIO()
+      # One complete upload, and one whose connection closes midway.
+      write_frame(requests, PUT, 1, encode_fields(['aaaa', 'content_store/done', '0444', 0, 4], b'DONE'))
+      write_frame(requests, PUT, 2, encode_fields(['bbbb', 'content_store/partial', '0444', 0, 8], b'PART'))
+      requests.seek(0)
+      responses = io.BytesIO()
+      server = ContentStoreServer(root, requests, responses)
+      server.serve()
+      self.assertEqual(['done'], os.listdir(os.path.join(root, 'content_store')))
+      self.assertEqual({}, server._uploads)
+
+  def test_session_handshake_failure(self):
+    with temporary_test_dir() as tmpdir:
+      pid_file = os.path.join(tmpdir, 'pid')
+      # A server that speaks the wrong protocol version, and then lingers.
+      script = '; '.join([
+        'import os, sys, time',
+        'sys.path[:0] = {0!r}'.format(sys.path),
+        'from gitshed.protocol import *',
+        'open({0!r}, "w").write(str(os.getpid()))'.format(pid_file),
+        '_, request_id, _ = read_frame(sys.stdin)',
+        'write_frame(sys.stdout, OK, request_id, encode_fields(["999"]))',
+        'time.sleep(60)',
+      ])
+      content_store = ServedContentStore([sys.executable, '-c', script])
+      with pytest.raises(GitShedError):
+        content_store.raw_has('content_store/foo')
+      with open(pid_file, 'r') as infile:
+        pid = int(infile.read())
+      # The server process was killed and reaped.
+      with pytest.raises(OSError):
+        os.kill(pid, 0)
+
+  def test_s3_content_store(self):
+    for chunk_size in self.chunk_sizes:
+      with s3_stand_in() as (_, endpoint):
+        content_store = S3ContentStore(endpoint, 'bucket', prefix='gitshed/myrepo', access_key='ACCESSKEY',
+                                       secret_key='SECRET', chunk_size=chunk_size)
+        self._test_contentstore(content_store)
+
+  def test_s3_content_store_parts(self):
+    with temporary_test_dir() as file_root:
+      with s3_stand_in(max_keys=2) as (stand_in, endpoint):
+        # Small parts, so that files are transferred as many parts, several at a time.
+        content_store = S3ContentStore(endpoint, 'bucket', access_key='ACCESSKEY', secret_key='SECRET',
+                                       part_size=1000, parts_in_flight=3)
+        paths = []
+        for name, size in [('empty', 0), ('small', 10), ('exact', 3000), ('large', 123456)]:
+          path = os.path.join(file_root, name)
+          with open(path, 'wb') as outfile:
+            outfile.write(os.urandom(size))
+          paths.append(path)
+        contents = []
+        for path in paths:
+          with open(path, 'rb') as infile:
+            contents.append(infile.read())
+        keys = content_store.put(paths)
+        # Large files were uploaded in parts.
+        self.assertEqual(2, stand_in.requests.count(('POST', ['uploads'])))
+        self.assertEqual(3 + 124, stand_in.requests.count(('PUT', ['partNumber', 'uploadId'])))
+        # Listing follows continuation tokens.
+        self.assertEqual(sorted(keys), sorted(content_store.raw_list('content_store')))
+        self.assertEqual(123456, content_store.sizes(keys)[keys[3]])
+
+        # Existence checks don't download content.
+        del stand_in.requests[:]
+        self.assertEqual(set(), content_store.missing(keys))
+        self.assertEqual({'HEAD'}, {method for method, _ in stand_in.requests})
+
+        for path in paths:
+          os.remove(path)
+        content_store.get(dict((key, [path]) for key, path in zip(keys, paths)))
+        for path, content in zip(paths, contents):
+          with open(path, 'rb') as infile:
+            self.assertEqual(content, infile.read())
+
+        with pytest.raises(GitShedError):
+          content_store.raw_get(['content_store/missing'], file_root)
+        # Requests signed with the wrong credentials are errors, not missing content.
+        with pytest.raises(GitShedError):
+          S3ContentStore(endpoint, 'bucket', access_key='WRONG', secret_key='SECRET').has(keys[0])
+
+  def test_simulated_content_store(self):
+    for chunk_size in self.chunk_sizes:
+      with temporary_test_dir() as root:
+        content_store = SimulatedContentStore(LocalContentStore(root), latency=0.001, jitter=0.001,
+                                              bandwidth=10 * 1024 * 1024, chunk_size=chunk_size)
+        self._test_contentstore(content_store)
+
+  def test_simulated_content_store_timing(self):
+    with temporary_test_dir() as file_root:
+      with temporary_test_dir() as root:
+        now = [0.0]
+        def sleep(seconds):
+          now[0] += seconds
+
+        def simulated(**kwargs):
+          return SimulatedContentStore(LocalContentStore(root), clock=lambda: now[0], sleep=sleep, **kwargs)
+
+        path = os.path.join(file_root, 'file')
+        with open(path, 'wb') as outfile:
+          outfile.write(b'x' * 1000)
+        key = ContentStore.key(path)
+        cs_path = ContentStore().content_store_path_from_key(key)
+
+        # Each call pays the latency, and transfers pay for their bytes.
+        content_store = simulated(latency=0.5, bandwidth=100)
+        content_store.put([path])
+        self.assertAlmostEqual(10.5, now[0])
+        content_store.raw_has(cs_path)
+        self.assertAlmostEqual(11.0, now[0])
+        with temporary_test_dir() as target_dir:
+          content_store.raw_get([cs_path], target_dir)
+        self.assertAlmostEqual(21.5, now[0])
+
+        # Concurrent transfers queue up behind each other on the shared link: the second of two
+        # 10 second transfers that start together finishes after 20 seconds.
+        content_store._transfer(1000)
+        now[0] -= 10  # Rewind, as if the second transfer started at the same time as the first.
+        content_store._transfer(1000)
+        self.assertAlmostEqual(41.5, now[0])
+
+        # Jitter and failures are reproducible from the seed.
+        def run(seed):
+          content_store = simulated(jitter=1.0, failure_rate=0.5, seed=seed)
+          results = []
+          for _ in range(20):
+            start = now[0]
+            try:
+              content_store.raw_has(cs_path)
+              results.append((True, now[0] - start))
+            except GitShedError:
+              results.append((False, now[0] - start))
+          return results
+        self.assertEqual(run(42), run(42))
+        self.assertNotEqual(run(42), run(43))
+        self.assertEqual({True, False}, set(ok for ok, _ in run(42)))
+        self.assertTrue(all(0 <= delay < 1.0 for _, delay in run(42)))
+
+  def test_failed_transfers_leave_no_threads(self):
+    class FailingLocalContentStore(LocalContentStore):
+      def raw_put(self, src_paths, content_store_dir):
+        raise GitShedError('Put failed.')
+
+    def on_complete(target_path):
+      raise GitShedError('Callback failed.')
+
+    with temporary_test_dir() as file_root:
+      with temporary_test_dir() as root:
+        paths = []
+        for i in range(5):
+          path = os.path.join(file_root, 'file{0}'.format(i))
+          with open(path, 'w') as outfile:
+            outfile.write(b'CONTENT{0}'.format(i))
+          paths.append(path)
+        content_store = LocalContentStore(root, chunk_size=1)
+        keys = content_store.put(paths)
+        num_threads = threading.active_count()
+        with pytest.raises(GitShedError):
+          content_store.get(dict((key, [path + '.copy']) for key, path in zip(keys, paths)), on_complete)
+        self.assertEqual(num_threads, threading.active_count())
+        with pytest.raises(GitShedError):
+          FailingLocalContentStore(os.path.join(root, 'failing'), chunk_size=1).put(paths)
+        self.assertEqual(num_threads, threading.active_count())
+
+  def test_content_store_with_manifest(self):
+    for chunk_size in self.chunk_sizes:
+      with temporary_test_dir() as root:
+        with temporary_test_dir() as cache_dir:
+          content_store = LocalContentStore(root, chunk_size=chunk_size)
+          content_store.use_manifest(KeyManifest(content_store, cache_dir))
+          self._test_contentstore(content_store)
+
+  def test_manifest(self):
+    class CountingLocalContentStore(LocalContentStore):
+      def __init__(self, root):
+        super(CountingLocalContentStore, self).__init__(root)
+        self.num_remote_checks = 0
+        self.num_puts = 0
+
+      def raw_has(self, content_store_path):
+        self.num_remote_checks += 1
+        return super(CountingLocalContentStore, self).raw_has(content_store_path)
+
+      def raw_put(self, src_paths, content_store_dir):
+        if content_store_dir != KeyManifest.MANIFEST_DIR:
+          self.num_puts += 1
+        super(CountingLocalContentStore, self).raw_put(src_paths, content_store_dir)
+
+    def new_client(root, cache_dir, complete=False):
+      content_store = CountingLocalContentStore(root)
+      content_store.use_manifest(KeyManifest(content_store, cache_dir, complete))
+      return content_store
+
+    with temporary_test_dir() as file_root:
+      with temporary_test_dir() as root:
+        with temporary_test_dir() as cache_root:
+          paths = []
+          for name in ['file1', 'file2', 'file3']:
+            path = os.path.join(file_root, name)
+            with open(path, 'w') as outfile:
+              outfile.write(name.upper())
+            paths.append(path)
+          key1, key2, key3 = [ContentStore.key(p) for p in paths]
+
+          # Content put without a manifest isn't in it, so we must check the store for it.
+          LocalContentStore(root).put([paths[0]])
+          client1 = new_client(root, os.path.join(cache_root, '1'))
+          self.assertTrue(client1.has(key1))
+          self.assertEqual(1, client1.num_remote_checks)
+
+          # A put records its keys in the manifest, and skips content that's known to be present.
+          client1.put([paths[1]])
+          self.assertEqual(1, client1.num_puts)
+          client1.put([paths[1]])
+          self.assertEqual(1, client1.num_puts)
+          self.assertEqual(1, len(os.listdir(os.path.join(root, KeyManifest.MANIFEST_DIR))))
+
+          # Another client fetches the manifest, and then needs no remote check for the recorded key.
+          client2 = new_client(root, os.path.join(cache_root, '2'))
+          self.assertTrue(client2.has(key2))
+          self.assertEqual({key3}, client2.missing([key2, key3]))
+          self.assertEqual(1, client2.num_remote_checks)
+
+          # The fetched manifest is cached locally.
+          client2_again = new_client(root, os.path.join(cache_root, '2'))
+          shutil.rmtree(os.path.join(root, KeyManifest.MANIFEST_DIR))
+          self.assertTrue(client2_again.has(key2))
+          self.assertEqual(0, client2_again.num_remote_checks)
+
+          # After a rebuild, a complete manifest answers all questions locally.
+          self.assertEqual(2, KeyManifest(LocalContentStore(root), os.path.join(cache_root, '3')).rebuild())
+          client3 = new_client(root, os.path.join(cache_root, '4'), complete=True)
+          self.assertEqual({key3}, client3.missing([key1, key2, key3]))
+          self.assertFalse(client3.has(key3))
+          self.assertEqual(0, client3.num_remote_checks)
+
+          # Clients sharing a cache dir (e.g., concurrent gitshed processes) can record at the same time.
+          shared_cache_dir = os.path.join(cache_root, '5')
+          errors = []
+
+          def record(i):
+            try:
+              for j in range(10):
+                KeyManifest(LocalContentStore(root), shared_cache_dir).record(['{0:040x}'.format(10 * i + j)])
+            except Exception as e:
+              errors.append(e)
+
+          threads = [threading.Thread(target=record, args=(i,)) for i in range(8)]
+          for thread in threads:
+            thread.start()
+          for thread in threads:
+            thread.join()
+          self.assertEqual([], errors)
+          self.assertEqual([], [name for name in os.listdir(shared_cache_dir) if name.endswith('.tmp')])
+
   def _test_local_content_store(self, chunk_size):
     with temporary_test_dir(cleanup=False) as content_store_root:
       content_store = LocalContentStore(content_store_root, chunk_size=chunk_size)
@@ -111,8 +850,10 @@ class ContentStoreTest(unittest.TestCase):
       key = ContentStore.key(fullpath)
 
       self.assertFalse(content_store.has(key))
+      self.assertEqual({key}, content_store.missing([key]))
       content_store.put([fullpath])
       self.assertTrue(content_store.has(key))
+      self.assertEqual(set(), content_store.missing([key]))
 
       self.assertTrue(os.path.exists(fullpath))
       os.remove(fullpath)
@@ -162,7 +903,9 @@ class ContentStoreTest(unittest.TestCase):
         fullpath2mode[fullpath] = current_mode
         key2fullpaths[key].append(fullpath)
 
+      self.assertEqual(set(fullpath2key.values()), content_store.missing(fullpath2key.values()))
       content_store.put(fullpath2key.keys())
+      self.assertEqual(set(), content_store.missing(fullpath2key.values()))
 
       for fullpath, key in fullpath2key.items():
         self.assertTrue(content_store.has(key))
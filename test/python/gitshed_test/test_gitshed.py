@@ -4,15 +4,28 @@ from __future__ import (nested_scopes, generators, division, absolute_import, wi
                         print_function, unicode_literals)
 
 from contextlib import contextmanager
+from io import BytesIO, StringIO
+import hashlib
+import json
 import os
+import resource
 import stat
+import tarfile
+import threading
+import time
 import unittest
 
+import pytest
+
 from gitshed.content_store import ContentStore
+from gitshed.error import GitShedError
 from gitshed.local_content_store import LocalContentStore
+from gitshed.locks import KeyLocks
+from gitshed.metrics import metrics
 from gitshed.gitshed import GitShed
-from gitshed.util import make_read_only
-from gitshed_test.helpers import temporary_test_dir, temporary_git_repo
+from gitshed import util
+from gitshed.util import copy_file, make_read_only, run_cmd_str
+from gitshed_test.helpers import commit_all, temporary_test_dir, temporary_git_repo
 
 
 @contextmanager
@@ -49,6 +62,38 @@ class gitshedTest(unittest.TestCase):
         make_read_only(path)
         self._assert_is_read_only(path)
 
+  def test_copy_file(self):
+    with temporary_test_dir() as test_dir:
+      src = os.path.join(test_dir, 'src')
+      content = os.urandom(3 * util.IO_BUFFER_SIZE + 17)
+      with open(src, 'wb') as outfile:
+        outfile.write(content)
+      os.chmod(src, 0751)
+
+      def assert_copies(name):
+        dst = os.path.join(test_dir, name)
+        copy_file(src, dst)
+        with open(dst, 'rb') as infile:
+          self.assertEquals(content, infile.read())
+        self.assertEquals(0751, stat.S_IMODE(os.stat(dst).st_mode))
+
+      assert_copies('default')
+
+      # A kernel copy that fails partway through is completed in userspace.
+      def copy_some_then_fail(src_fd, dst_fd, count):
+        if os.lseek(src_fd, 0, os.SEEK_CUR) > 0:
+          return -1
+        return os.write(dst_fd, os.read(src_fd, 1000))
+      old_libc_copy_funcs = util._libc_copy_funcs
+      util._libc_copy_funcs = ([copy_some_then_fail], lambda: 0)
+      try:
+        assert_copies('partial_kernel_copy')
+      finally:
+        util._libc_copy_funcs = old_libc_copy_funcs
+
+      # Overwrites existing files.
+      assert_copies('default')
+
   def test_generate_find_command(self):
     with temporary_git_repo({}) as repo:
       with temporary_test_dir() as content_store_root:
@@ -57,7 +102,7 @@ class gitshedTest(unittest.TestCase):
         # Note that ./.git and ./.gitshed get automatically added to the excluded paths.
         self.assertEquals(
           'find . \( -path "./exclude_me" -o -path "./exclude_me_too" -o -path "./.git" -o -path "./.gitshed" \) '
-          '-prune -o -lname "*/.gitshed/files/*" -print',
+          '-prune -o \( -lname ".gitshed/files/*" -o -lname "*/.gitshed/files/*" \) -print0',
           gitshed._generate_find_command()
         )
 
@@ -155,3 +200,691 @@ class gitshedTest(unittest.TestCase):
         assert_status(1, 0)
         self._assert_is_read_only(new_link_abspath)
 
+  def test_manage_failures(self):
+    class FailingLocalContentStore(LocalContentStore):
+      def raw_put(self, src_paths, content_store_dir):
+        time.sleep(0.2)
+        raise GitShedError('Broken.')
+
+    seed_files = {'a': 'SAME CONTENT', 'b': 'SAME CONTENT', 'c': 'C CONTENT'}
+    with temporary_git_repo(seed_files) as repo:
+      with temporary_test_dir() as content_store_root:
+        # Nothing is managed if any path is bad.
+        gitshed = GitShed(repo, LocalContentStore(content_store_root))
+        with pytest.raises(GitShedError):
+          gitshed.manage(['a', 'nonexistent', 'c'])
+        self.assertFalse(any(os.path.islink(path) for path in seed_files))
+
+        # A file isn't managed while the upload of its content by another batch is in flight, or
+        # if that upload fails.
+        gitshed = GitShed(repo, FailingLocalContentStore(content_store_root, chunk_size=1, put_concurrency=2))
+        with pytest.raises(GitShedError):
+          gitshed.manage(['a', 'b'])
+        self.assertFalse(any(os.path.islink(path) for path in seed_files))
+
+  def test_hash_algorithm(self):
+    if not ContentStore.is_supported_hash_algorithm('blake2b'):
+      # Exercise the key format with a stand-in hash function of the same digest size.
+      old_blake2b_constructor = ContentStore.__dict__['_blake2b_constructor']
+      ContentStore._blake2b_constructor = staticmethod(lambda: lambda digest_size: hashlib.sha256())
+    else:
+      old_blake2b_constructor = None
+    try:
+      with temporary_git_repo({'old': 'OLD CONTENT', 'new': 'NEW CONTENT'}) as repo:
+        with temporary_test_dir() as content_store_root:
+          content_store = LocalContentStore(content_store_root)
+          GitShed(repo, content_store).manage(['old'])
+          gitshed = GitShed(repo, content_store, hash_algorithm='blake2b')
+          gitshed.manage(['new'])
+          keys = dict((m.path, m.key) for m in gitshed.iter_managed(['old', 'new']))
+          self.assertEquals('sha1', ContentStore.algorithm_from_key(keys['old']))
+          self.assertEquals('blake2b', ContentStore.algorithm_from_key(keys['new']))
+
+          # Files managed with either algorithm can be synced and verified.
+          for path in ['old', 'new']:
+            os.unlink(gitshed._get_gitshed_path(path))
+          gitshed.sync(['old', 'new'])
+          with open('new', 'r') as infile:
+            self.assertEquals('NEW CONTENT', infile.read())
+          self.assertEquals([], gitshed.fsck(out=StringIO()))
+
+      with pytest.raises(GitShedError):
+        GitShed(repo, content_store, hash_algorithm='md5')
+    finally:
+      if old_blake2b_constructor:
+        ContentStore._blake2b_constructor = old_blake2b_constructor
+
+  def test_fsck(self):
+    file_relpath = os.path.join('foo', 'bar', 'baz')
+    with temporary_git_repo({file_relpath: 'SOME FILE CONTENT'}) as repo:
+      with temporary_test_dir() as content_store_root:
+        content_store = LocalContentStore(content_store_root)
+        gitshed = GitShed(repo, content_store)
+        gitshed.manage([file_relpath])
+        bucket_relpath = gitshed._get_gitshed_path(file_relpath)
+
+        out = StringIO()
+        self.assertEquals([], gitshed.fsck(out=out))
+        self.assertIn('1 files checked. 0 failed verification.', out.getvalue())
+
+        # Verification results are cached, and the cache is only trusted for unchanged files.
+        self.assertEquals([], gitshed.fsck(out=StringIO()))
+        os.chmod(bucket_relpath, 0644)
+        with open(bucket_relpath, 'w') as fp:
+          fp.write(b'BAD CONTENT')
+        make_read_only(bucket_relpath)
+        self.assertEquals([bucket_relpath], gitshed.fsck(out=StringIO()))
+
+        # Wrong permissions are detected too.
+        os.chmod(bucket_relpath, 0755)
+        self.assertEquals([bucket_relpath], gitshed.fsck(out=StringIO()))
+
+        # Repair refetches just the bad file.
+        self.assertEquals([bucket_relpath], gitshed.fsck(repair=True, out=StringIO()))
+        self.assertEquals([], gitshed.fsck(out=StringIO()))
+        with open(file_relpath, 'r') as fp:
+          self.assertEquals('SOME FILE CONTENT', fp.read())
+
+        # Good content with the wrong permissions is repaired in place.
+        inode = os.stat(bucket_relpath).st_ino
+        os.chmod(bucket_relpath, 0755)
+        self.assertEquals([bucket_relpath], gitshed.fsck(repair=True, out=StringIO()))
+        self.assertEquals([], gitshed.fsck(out=StringIO()))
+        self.assertEquals(inode, os.stat(bucket_relpath).st_ino)
+        self._assert_is_read_only(bucket_relpath)
+
+        # Files that leave the shed are forgotten by the fingerprint cache.
+        fingerprints_path = os.path.join('.gitshed', 'state', 'fingerprints.json')
+        with open(fingerprints_path, 'r') as infile:
+          self.assertEquals([bucket_relpath], list(json.load(infile).keys()))
+        os.unlink(bucket_relpath)
+        self.assertEquals([], gitshed.fsck(out=StringIO()))
+        with open(fingerprints_path, 'r') as infile:
+          self.assertEquals({}, json.load(infile))
+        gitshed.sync([file_relpath])
+
+        # The state dir ignores itself.
+        self.assertTrue(repo.is_ignored(os.path.join('.gitshed', 'state', 'fingerprints.json')))
+
+  def test_gc(self):
+    seed_files = {'a': 'A CONTENT', 'b': 'B CONTENT', 'c': 'C CONTENT', 'd': 'D CONTENT'}
+    with temporary_git_repo(seed_files) as repo:
+      with temporary_test_dir() as content_store_root:
+        content_store = LocalContentStore(content_store_root)
+        gitshed = GitShed(repo, content_store)
+        gitshed.manage(sorted(seed_files))
+        shed_paths = dict((p, gitshed._get_gitshed_path(p)) for p in seed_files)
+        commit_all()
+        for i, path in enumerate(sorted(seed_files)):
+          # Give the files distinct last use times, in order.
+          os.utime(shed_paths[path], (1000000000 + i, 1000000000 + i))
+
+        # Everything is referenced by the worktree.
+        self.assertEquals((0, 0), gitshed.gc())
+
+        # Unreferenced by the worktree, but still referenced by HEAD.
+        for path in seed_files:
+          os.unlink(path)
+        self.assertEquals((0, 0), gitshed.gc(refs=['HEAD']))
+
+        # Evict least recently used first, until within budget.
+        self.assertEquals((2, 18), gitshed.gc(max_size=18))
+        self.assertFalse(os.path.exists(shed_paths['a']))
+        self.assertFalse(os.path.exists(shed_paths['b']))
+        self.assertTrue(os.path.exists(shed_paths['c']))
+
+        # Within budget is a no-op.
+        self.assertEquals((0, 0), gitshed.gc(max_size=18))
+
+        # Evict everything unreferenced.
+        self.assertEquals((2, 18), gitshed.gc())
+        self.assertEquals([], list(gitshed._iter_shed_files()))
+
+        # Evicted content can be synced back.
+        run_cmd_str('git checkout -- .')
+        gitshed.sync_all()
+        with open('a', 'r') as fp:
+          self.assertEquals('A CONTENT', fp.read())
+
+  def test_iter_managed(self):
+    seed_files = {'foo/a': 'A CONTENT', 'foo/new\nline': 'NEWLINE CONTENT', 'unmanaged': 'UNMANAGED'}
+    with temporary_git_repo(seed_files) as repo:
+      with temporary_test_dir() as content_store_root:
+        content_store = LocalContentStore(content_store_root)
+        gitshed = GitShed(repo, content_store)
+        gitshed.manage(iter(['foo/a', 'foo/new\nline']))
+        os.unlink(gitshed._get_gitshed_path('foo/a'))
+
+        managed = sorted(gitshed.iter_managed())
+        self.assertEquals(['./foo/a', './foo/new\nline'], [m.path for m in managed])
+        self.assertEquals([False, True], [m.synced for m in managed])
+        self.assertEquals(ContentStore.key('foo/new\nline'), managed[1].key)
+        self.assertEquals(['foo/a'], [m.path for m in gitshed.iter_managed(['foo/a', 'unmanaged'])])
+
+        out = BytesIO()
+        gitshed.synced(out=out, delimiter=b'\0')
+        self.assertEquals(b'./foo/new\nline\0', out.getvalue())
+        out = BytesIO()
+        gitshed.unsynced(out=out, delimiter=b'\0')
+        self.assertEquals(b'./foo/a\0', out.getvalue())
+
+        gitshed.sync(iter(['foo/a']))
+        self.assertEquals((2, 0), gitshed.get_status())
+        # Paths are listed in sorted order.
+        out = BytesIO()
+        gitshed.synced(out=out, delimiter=b'\0')
+        self.assertEquals(b'./foo/a\0./foo/new\nline\0', out.getvalue())
+
+  def test_iter_cmd_output(self):
+    # More stderr than a pipe holds doesn't block the command.
+    cmd = "sh -c 'head -c 200000 /dev/zero >&2; printf \"a\\0b\\0\"'"
+    self.assertEquals([b'a', b'b'], list(util.iter_cmd_output(cmd, b'\0')))
+    with pytest.raises(GitShedError):
+      list(util.iter_cmd_output("sh -c 'echo oops >&2; exit 1'", b'\0'))
+    # Stopping early ends the command.
+    records = util.iter_cmd_output('yes', b'\n')
+    self.assertEquals(b'y', next(records))
+    records.close()
+
+  def test_sync_batches(self):
+    class CountingLocalContentStore(LocalContentStore):
+      def __init__(self, root):
+        super(CountingLocalContentStore, self).__init__(root)
+        self.fetched = []
+
+      def raw_get(self, content_store_paths, target_dir_tmp):
+        self.fetched.extend(content_store_paths)
+        super(CountingLocalContentStore, self).raw_get(content_store_paths, target_dir_tmp)
+
+    # The same content, in different shed paths.
+    seed_files = {'a/x': 'SAME CONTENT', 'b/y': 'SAME CONTENT', 'c/z': 'SAME CONTENT'}
+    with temporary_git_repo(seed_files) as repo:
+      with temporary_test_dir() as content_store_root:
+        content_store = CountingLocalContentStore(content_store_root)
+        gitshed = GitShed(repo, content_store)
+        gitshed.manage(sorted(seed_files))
+        for path in seed_files:
+          os.unlink(gitshed._get_gitshed_path(path))
+        gitshed._SYNC_BATCH_SIZE = 1
+        gitshed.sync(sorted(seed_files))
+        # Fetched once, although each file is in a different batch.
+        self.assertEquals(1, len(content_store.fetched))
+        for path, content in seed_files.items():
+          with open(path, 'r') as infile:
+            self.assertEquals(content, infile.read())
+          self._assert_is_read_only(path)
+
+  def test_sync_more_keys_than_open_files(self):
+    # Each held key lock is an open file, so a sync mustn't hold a lock per key.
+    max_open_files = 512
+    seed_files = dict(('f{0}'.format(i), 'CONTENT {0}'.format(i)) for i in range(2 * max_open_files))
+    with temporary_git_repo(seed_files) as repo:
+      with temporary_test_dir() as content_store_root:
+        gitshed = GitShed(repo, LocalContentStore(content_store_root))
+        gitshed.manage(sorted(seed_files))
+        for path in seed_files:
+          os.unlink(gitshed._get_gitshed_path(path))
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max_open_files, hard))
+        try:
+          gitshed.sync_all()
+        finally:
+          resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        for path, content in seed_files.items():
+          with open(path, 'r') as infile:
+            self.assertEquals(content, infile.read())
+
+  def test_sync_priority(self):
+    seed_files = {'a/big': 'BIG CONTENT', 'a/small': 'S', 'b/medium': 'MEDIUM', 'b/small': 'SM'}
+    with temporary_git_repo(seed_files) as repo:
+      with temporary_test_dir() as content_store_root:
+        content_store = LocalContentStore(content_store_root, chunk_size=1, get_concurrency=1)
+        gitshed = GitShed(repo, content_store)
+        gitshed.manage(sorted(seed_files))
+
+        def unsync_all():
+          for path in seed_files:
+            os.unlink(gitshed._get_gitshed_path(path))
+
+        def synced_order(**kwargs):
+          order = []
+          def on_synced(path):
+            # Each file is usable as soon as it's reported.
+            self.assertTrue(os.path.exists(path))
+            order.append(path)
+          gitshed.sync(paths, on_synced=on_synced, **kwargs)
+          return order
+
+        # By default, files are synced in the order specified.
+        paths = ['b/small', 'a/big', 'b/medium', 'a/small']
+        unsync_all()
+        self.assertEquals(paths, synced_order())
+
+        unsync_all()
+        self.assertEquals(['a/small', 'b/small', 'b/medium', 'a/big'], synced_order(smallest_first=True))
+
+        unsync_all()
+        self.assertEquals(['b/small', 'b/medium', 'a/big', 'a/small'], synced_order(prefixes=['b/']))
+
+        unsync_all()
+        self.assertEquals(['b/small', 'b/medium', 'a/small', 'a/big'],
+                          synced_order(prefixes=['b'], smallest_first=True))
+
+        # Synced files aren't reported again.
+        self.assertEquals([], synced_order())
+
+  def test_routed_content_store(self):
+    seed_files = {'models/big.bin': 'BIG CONTENT', 'fixtures/small.json': 'SMALL CONTENT'}
+    with temporary_git_repo(seed_files) as repo:
+      with temporary_test_dir() as tmpdir:
+        bulk_root = os.path.join(tmpdir, 'bulk')
+        fast_root = os.path.join(tmpdir, 'fast')
+        config_path = os.path.join(tmpdir, 'config.json')
+        with open(config_path, 'w') as outfile:
+          json.dump({'content_store': {'routed': {
+            'stores': {'bulk': {'local': {'root': bulk_root}}, 'fast': {'local': {'root': fast_root}}},
+            'routes': [{'paths': ['models/*'], 'store': 'bulk'}],
+            'default': 'fast'}}}, outfile)
+        gitshed = GitShed.from_config(config_path)
+        gitshed.manage(sorted(seed_files))
+        self.assertEqual(['content_store'], os.listdir(bulk_root))
+        self.assertEqual(1, len(os.listdir(os.path.join(bulk_root, 'content_store'))))
+        self.assertEqual(1, len(os.listdir(os.path.join(fast_root, 'content_store'))))
+
+        for path in seed_files:
+          os.unlink(gitshed._get_gitshed_path(path))
+        metrics.reset()
+        gitshed.sync_all()
+        for path, content in seed_files.items():
+          with open(path, 'r') as infile:
+            self.assertEqual(content, infile.read())
+        # Each key was found in the store its path routes to.
+        self.assertEqual([], [name for name in metrics.record()['counters'] if name.startswith('route_fallbacks')])
+        # Content was staged on the shed's filesystem.
+        self.assertTrue(os.path.isdir(os.path.join('.gitshed', 'state', 'staging')))
+
+  def test_direct_content_store(self):
+    seed_files = {'a': 'A CONTENT', 'b': 'B CONTENT'}
+    with temporary_git_repo(seed_files) as repo:
+      with temporary_test_dir() as tmpdir:
+        content_store_root = os.path.join(tmpdir, 'content_store_root')
+        config_path = os.path.join(tmpdir, 'config.json')
+        with open(config_path, 'w') as outfile:
+          json.dump({'content_store': {'local': {'root': content_store_root, 'direct': True}}}, outfile)
+        gitshed = GitShed.from_config(config_path)
+        gitshed.manage(sorted(seed_files))
+        for path in seed_files:
+          os.unlink(gitshed._get_gitshed_path(path))
+        gitshed.sync_all()
+
+        def store_path(path):
+          key = gitshed._get_key_from_versioned_path(gitshed._get_gitshed_path(path))
+          return os.path.join(content_store_root, gitshed.content_store.content_store_path_from_key(key))
+
+        for path, content in seed_files.items():
+          # The shed entry is the content store object.
+          self.assertTrue(os.path.samefile(store_path(path), path))
+          with open(path, 'r') as infile:
+            self.assertEqual(content, infile.read())
+
+        # Unmanaging copies the content, leaving the content store object read-only and in place.
+        a_store_path = store_path('a')
+        gitshed.unmanage(['a'])
+        self._assert_is_user_writeable('a')
+        self.assertFalse(os.path.samefile(a_store_path, 'a'))
+        self._assert_is_read_only(a_store_path)
+        with open(a_store_path, 'r') as infile:
+          self.assertEqual('A CONTENT', infile.read())
+
+  def test_direct_content_store_must_be_top_level(self):
+    local_cfg = {'local': {'root': 'content_store_root', 'direct': True}}
+    nested_cfgs = [
+      {'tiers': [local_cfg]},
+      {'replicated': {'replicas': [local_cfg]}},
+      {'routed': {'stores': {'nfs': local_cfg}, 'default': 'nfs'}},
+      {'simulated': {'backend': local_cfg}},
+    ]
+    with temporary_test_dir() as tmpdir:
+      config_path = os.path.join(tmpdir, 'config.json')
+      for content_store_cfg in nested_cfgs:
+        with self.assertRaisesRegexp(GitShedError, 'Direct mode'):
+          GitShed._content_store_from_config(config_path, content_store_cfg, {})
+      # Without direct mode, a nested local content store is fine.
+      GitShed._content_store_from_config(config_path, {'tiers': [{'local': {'root': 'content_store_root'}}]}, {})
+
+  def test_manifest_cache_per_content_store(self):
+    seed_files = {'a': 'A CONTENT'}
+    with temporary_git_repo(seed_files) as repo:
+      with temporary_test_dir() as tmpdir:
+        config_path = os.path.join(tmpdir, 'config.json')
+
+        def gitshed_for(content_store_root):
+          with open(config_path, 'w') as outfile:
+            json.dump({'content_store': {'local': {'root': content_store_root}}, 'manifest': True}, outfile)
+          return GitShed.from_config(config_path)
+
+        gitshed = gitshed_for(os.path.join(tmpdir, 'store_a'))
+        gitshed.manage(['a'])
+        key = gitshed._get_key_from_versioned_path(gitshed._get_gitshed_path('a'))
+        self.assertEqual(set(), gitshed.content_store.missing([key]))
+
+        # Keys cached for the old content store don't count as present in the new one.
+        gitshed = gitshed_for(os.path.join(tmpdir, 'store_b'))
+        self.assertEqual({key}, gitshed.content_store.missing([key]))
+        gitshed.content_store.put([gitshed._get_gitshed_path('a')])
+        self.assertTrue(os.path.isfile(os.path.join(tmpdir, 'store_b',
+                                                    gitshed.content_store.content_store_path_from_key(key))))
+
+  def test_dedupe(self):
+    seed_files = {'a': 'SAME CONTENT', 'b': 'SAME CONTENT'}
+    with temporary_git_repo(seed_files) as repo:
+      os.chmod('a', 0755)
+      with temporary_test_dir() as tmpdir:
+        content_store_root = os.path.join(tmpdir, 'content_store_root')
+        config_path = os.path.join(tmpdir, 'config.json')
+        with open(config_path, 'w') as outfile:
+          json.dump({'content_store': {'local': {'root': content_store_root}}, 'dedupe': True}, outfile)
+        gitshed = GitShed.from_config(config_path)
+        gitshed.manage(sorted(seed_files))
+        # Different keys, but the content is stored once.
+        self.assertNotEqual(gitshed._get_gitshed_path('a'), gitshed._get_gitshed_path('b'))
+        self.assertEqual(1, len(os.listdir(os.path.join(content_store_root, 'content_store'))))
+
+        for path in seed_files:
+          os.unlink(gitshed._get_gitshed_path(path))
+        gitshed.sync_all()
+        self.assertTrue(os.access('a', os.X_OK))
+        self.assertFalse(os.access('b', os.X_OK))
+        for path, content in seed_files.items():
+          with open(path, 'r') as infile:
+            self.assertEqual(content, infile.read())
+
+  def test_sync_coalescing(self):
+    class CountingLocalContentStore(LocalContentStore):
+      def __init__(self, root):
+        super(CountingLocalContentStore, self).__init__(root)
+        self.fetched = []
+
+      def raw_get(self, content_store_paths, target_dir_tmp):
+        self.fetched.extend(content_store_paths)
+        super(CountingLocalContentStore, self).raw_get(content_store_paths, target_dir_tmp)
+
+    seed_files = {'a': 'A CONTENT', 'b': 'B CONTENT'}
+    with temporary_git_repo(seed_files) as repo:
+      with temporary_test_dir() as content_store_root:
+        content_store = CountingLocalContentStore(content_store_root)
+        gitshed = GitShed(repo, content_store)
+        gitshed.manage(sorted(seed_files))
+        for path in seed_files:
+          os.unlink(gitshed._get_gitshed_path(path))
+        key_a = gitshed._get_key_from_versioned_path(gitshed._get_gitshed_path('a'))
+
+        # Another process is fetching a's content, so we fetch just b's, and wait for a's.
+        other_process_locks = KeyLocks(os.path.join('.gitshed', 'state', 'locks'))
+        self.assertTrue(other_process_locks.try_acquire(key_a))
+        synced = []
+        b_synced = threading.Event()
+        errors = []
+
+        def on_synced(path):
+          synced.append(path)
+          if path == 'b':
+            b_synced.set()
+
+        def sync():
+          try:
+            gitshed.sync(sorted(seed_files), on_synced=on_synced)
+          except Exception as e:
+            errors.append(e)
+            b_synced.set()
+
+        syncer = threading.Thread(target=sync)
+        syncer.start()
+        b_synced.wait()
+        copy_file(os.path.join(content_store_root, content_store.content_store_path_from_key(key_a)),
+                  gitshed._get_gitshed_path('a'))
+        other_process_locks.release(key_a)
+        syncer.join()
+
+        self.assertEqual([], errors)
+        self.assertEqual(['b', 'a'], synced)
+        self.assertEqual(1, len(content_store.fetched))
+        self.assertNotIn(key_a, content_store.fetched[0])
+        for path, content in seed_files.items():
+          with open(path, 'r') as infile:
+            self.assertEqual(content, infile.read())
+
+  def test_hooks(self):
+    seed_files = {'foo/a': 'A CONTENT'}
+    with temporary_git_repo(seed_files) as repo:
+      with temporary_test_dir() as content_store_root:
+        content_store = LocalContentStore(content_store_root)
+        gitshed = GitShed(repo, content_store)
+        gitshed.manage(['foo/a'])
+        # A symlink into the shed whose content was never put into the content store.
+        bogus_key = '0123456789abcdef0123456789abcdef01234567_00444'
+        os.symlink('../.gitshed/files/foo/{0}.b'.format(bogus_key), 'foo/b')
+        os.symlink('a', 'foo/unmanaged_link')
+
+        run_cmd_str('git add -A .')
+        self.assertEquals(['foo/b'], gitshed.check_staged(out=StringIO()))
+        os.unlink('foo/b')
+        run_cmd_str('git add -A .')
+        self.assertEquals([], gitshed.check_staged(out=StringIO()))
+        commit_all()
+        _, head, _ = run_cmd_str('git rev-parse HEAD')
+        head = head.strip()
+
+        os.symlink('../.gitshed/files/foo/{0}.b'.format(bogus_key), 'foo/b')
+        commit_all()
+        _, new_head, _ = run_cmd_str('git rev-parse HEAD')
+        new_head = new_head.strip()
+
+        null_sha = '0' * 40
+        # Pushing only the first commit is fine.
+        self.assertEquals([], gitshed.check_pushed([('refs/heads/master', head, 'refs/heads/master', null_sha)],
+                                                   'origin', out=StringIO()))
+        # Pushing both commits to a new remote ref is not.
+        self.assertEquals(['foo/b'], gitshed.check_pushed(
+          [('refs/heads/master', new_head, 'refs/heads/master', null_sha)], 'origin', out=StringIO()))
+        # Nor is pushing just the second commit, if the remote already has the first.
+        self.assertEquals(['foo/b'], gitshed.check_pushed(
+          [('refs/heads/master', new_head, 'refs/heads/master', head)], 'origin', out=StringIO()))
+        # Deleting a remote ref pushes nothing.
+        self.assertEquals([], gitshed.check_pushed([('(delete)', null_sha, 'refs/heads/master', new_head)],
+                                                   'origin', out=StringIO()))
+
+  def test_async_upload_routing(self):
+    from gitshed.routed_content_store import RoutedContentStore
+
+    seed_files = {'models/big.bin': 'BIG CONTENT', 'small.json': 'SMALL CONTENT'}
+    with temporary_git_repo(seed_files) as repo:
+      with temporary_test_dir() as tmpdir:
+        roots = dict((name, os.path.join(tmpdir, name)) for name in ['bulk', 'fast'])
+        stores = dict((name, LocalContentStore(root)) for name, root in roots.items())
+        content_store = RoutedContentStore(stores, [(['models/*'], 'bulk')], 'fast')
+        gitshed = GitShed(repo, content_store, async_upload=True)
+        gitshed.manage(sorted(seed_files))
+        self.assertEqual(set(), gitshed.upload(out=StringIO()))
+        # Content is routed by the path it was managed from, not by its path in the shed.
+        for path, name in [('models/big.bin', 'bulk'), ('small.json', 'fast')]:
+          key = gitshed._get_key_from_versioned_path(gitshed._get_gitshed_path(path))
+          self.assertEqual([key], os.listdir(os.path.join(roots[name], 'content_store')))
+
+  def test_async_upload(self):
+    seed_files = {'a': 'A CONTENT', 'b': 'B CONTENT'}
+    with temporary_git_repo(seed_files) as repo:
+      with temporary_test_dir() as content_store_root:
+        content_store = LocalContentStore(content_store_root)
+        gitshed = GitShed(repo, content_store, async_upload=True)
+        gitshed.manage(['a'])
+        key_a = gitshed._get_key_from_versioned_path(gitshed._get_gitshed_path('a'))
+        self.assertFalse(content_store.has(key_a))
+        self.assertEqual([key_a], list(gitshed._upload_journal().pending()))
+        out = StringIO()
+        gitshed.status(out=out)
+        self.assertIn('1 files are waiting to be uploaded.', out.getvalue())
+
+        # Content waiting to be uploaded can be committed, and isn't garbage-collected.
+        run_cmd_str('git add -A .')
+        self.assertEquals([], gitshed.check_staged(out=StringIO()))
+        commit_all()
+        _, head, _ = run_cmd_str('git rev-parse HEAD')
+        head = head.strip()
+        gitshed.manage(['b'])
+        key_b = gitshed._get_key_from_versioned_path(gitshed._get_gitshed_path('b'))
+        os.unlink('a')
+        self.assertEqual((0, 0), gitshed.gc())
+        os.symlink(os.path.relpath(gitshed._upload_journal().pending()[key_a]), 'a')
+
+        # Pushing uploads the pushed content, but not the rest.
+        null_sha = '0' * 40
+        self.assertEquals([], gitshed.check_pushed([('refs/heads/master', head, 'refs/heads/master', null_sha)],
+                                                   'origin', out=StringIO()))
+        self.assertTrue(content_store.has(key_a))
+        self.assertFalse(content_store.has(key_b))
+        self.assertEqual([key_b], list(gitshed._upload_journal().pending()))
+
+        # Content removed from the shed before it was uploaded is reported, and dropped.
+        shed_path_b = gitshed._get_gitshed_path('b')
+        os.chmod(shed_path_b, 0644)
+        os.unlink(shed_path_b)
+        out = StringIO()
+        self.assertEqual(set(), gitshed.upload(out=out))
+        self.assertIn('content was removed from the shed before it was uploaded', out.getvalue())
+        self.assertFalse(content_store.has(key_b))
+        self.assertEqual({}, gitshed._upload_journal().pending())
+
+        # Failed uploads stay in the journal, to be retried.
+        class BrokenLocalContentStore(LocalContentStore):
+          def raw_put(self, src_paths, content_store_dir):
+            raise GitShedError('Broken.')
+
+        with open('c', 'w') as outfile:
+          outfile.write('C CONTENT')
+        broken_gitshed = GitShed(repo, BrokenLocalContentStore(content_store_root), async_upload=True)
+        broken_gitshed._UPLOAD_RETRY_DELAY_SECONDS = 0
+        broken_gitshed.manage(['c'])
+        key_c = gitshed._get_key_from_versioned_path(gitshed._get_gitshed_path('c'))
+        self.assertEqual({key_c}, broken_gitshed.upload(retries=1, out=StringIO()))
+        self.assertEqual({key_c}, set(gitshed._upload_journal().pending()))
+        self.assertEqual(set(), gitshed.upload(out=StringIO()))
+        self.assertTrue(content_store.has(key_c))
+        self.assertFalse(os.path.getsize(os.path.join('.gitshed', 'state', 'upload_journal')))
+
+  def test_install_hooks(self):
+    with temporary_git_repo({}) as repo:
+      gitshed = GitShed(repo, None)
+      gitshed.install_hooks()
+      gitshed.install_hooks()  # Idempotent.
+      for hook in GitShed.HOOKS:
+        hook_path = os.path.join('.git', 'hooks', hook)
+        self.assertTrue(os.access(hook_path, os.X_OK))
+        with open(hook_path, 'r') as infile:
+          self.assertIn('git shed hook {0}'.format(hook), infile.read())
+
+      # Don't clobber other hooks.
+      with open(os.path.join('.git', 'hooks', 'pre-commit'), 'w') as outfile:
+        outfile.write('#!/bin/sh\nexit 0\n')
+      with pytest.raises(GitShedError):
+        gitshed.install_hooks()
+
+  def test_bundle(self):
+    seed_files = {'a/x': 'X CONTENT', 'a/y': 'Y CONTENT', 'b/x': 'X CONTENT', 'b/z': 'Z CONTENT'}
+    with temporary_git_repo(seed_files) as repo:
+      with temporary_test_dir() as content_store_root:
+        with temporary_test_dir() as bundle_dir:
+          content_store = LocalContentStore(content_store_root)
+          gitshed = GitShed(repo, content_store)
+          gitshed.manage(sorted(seed_files))
+          commit_all()
+          shed_paths = dict((p, gitshed._get_gitshed_path(p)) for p in seed_files)
+          # Unsynced content is fetched from the content store.
+          os.unlink(shed_paths['b/z'])
+
+          bundle_path = os.path.join(bundle_dir, 'head.bundle')
+          self.assertEquals(3, gitshed.create_bundle('HEAD', bundle_path, out=StringIO()))
+          self.assertEquals(2, gitshed.create_bundle('HEAD', os.path.join(bundle_dir, 'a.bundle'),
+                                                     prefixes=['a'], out=StringIO()))
+
+          # Applying the bundle syncs everything, without the content store.
+          for shed_path in shed_paths.values():
+            if os.path.exists(shed_path):
+              os.unlink(shed_path)
+          gitshed = GitShed(repo, None)
+          self.assertEquals(4, gitshed.apply_bundle(bundle_path, out=StringIO()))
+          for path, content in seed_files.items():
+            with open(path, 'r') as infile:
+              self.assertEquals(content, infile.read())
+            self.assertEquals(ContentStore.mode_from_key(gitshed._get_key_from_versioned_path(shed_paths[path])),
+                              ContentStore.mode(shed_paths[path]))
+          # Content already in the shed is skipped.
+          self.assertEquals(0, gitshed.apply_bundle(bundle_path, out=StringIO()))
+
+          # A range bundles just the content added or modified in it.
+          gitshed = GitShed(repo, content_store)
+          os.unlink('a/y')
+          with open('a/y', 'w') as outfile:
+            outfile.write('NEW Y CONTENT')
+          gitshed.manage(['a/y'])
+          commit_all()
+          self.assertEquals(1, gitshed.create_bundle('HEAD~1..HEAD', os.path.join(bundle_dir, 'range.bundle'),
+                                                     out=StringIO()))
+
+  def test_bundle_verification(self):
+    from gitshed.bundle import write_bundle
+
+    with temporary_git_repo({'a': 'A CONTENT'}) as repo:
+      with temporary_test_dir() as tmpdir:
+        gitshed = GitShed(repo, LocalContentStore(os.path.join(tmpdir, 'content_store')))
+        gitshed.manage(['a'])
+        shed_path = gitshed._get_gitshed_path('a')
+        key = gitshed._get_key_from_versioned_path(shed_path)
+        os.unlink(shed_path)
+        bad_content_path = os.path.join(tmpdir, 'bad')
+        with open(bad_content_path, 'w') as outfile:
+          outfile.write('BAD CONTENT')
+        bundle_path = os.path.join(tmpdir, 'bundle')
+
+        # Content that doesn't match its key never reaches the shed.
+        write_bundle(bundle_path, [(key, bad_content_path, [shed_path])])
+        with pytest.raises(GitShedError):
+          gitshed.apply_bundle(bundle_path, out=StringIO())
+        self.assertEquals([], list(gitshed._iter_shed_files()))
+
+        # Nor can a bundle write outside the shed.
+        for bad_path in ['a', os.path.join(shed_path, '..', '..', key), os.path.abspath(shed_path)]:
+          write_bundle(bundle_path, [(key, bad_content_path, [bad_path])])
+          with pytest.raises(GitShedError):
+            gitshed.apply_bundle(bundle_path, out=StringIO())
+
+        # Nor is anything but a bundle accepted.
+        with pytest.raises(GitShedError):
+          gitshed.apply_bundle(bad_content_path, out=StringIO())
+
+        # A truncated bundle is an error, wherever it was truncated.
+        entries = []
+        for name in ['x', 'y']:
+          content_path = os.path.join(tmpdir, name)
+          with open(content_path, 'w') as outfile:
+            outfile.write(name * 9000)
+          content_key = ContentStore.key(content_path)
+          entry_shed_path = os.path.join(os.path.dirname(shed_path), '{0}.{1}'.format(content_key, name))
+          entries.append((content_key, content_path, [entry_shed_path]))
+        write_bundle(bundle_path, entries)
+        with open(bundle_path, 'rb') as infile:
+          bundle_data = infile.read()
+        with tarfile.open(bundle_path) as bundle:
+          _, first, second = bundle.getmembers()
+        # Truncate within content, between members, and within a member's header.
+        for size in [first.offset_data + 100, second.offset, second.offset + 256, second.offset_data + 100]:
+          with open(bundle_path, 'wb') as outfile:
+            outfile.write(bundle_data[:size])
+          with pytest.raises(GitShedError):
+            gitshed.apply_bundle(bundle_path, out=StringIO())
+        # The whole bundle applies.
+        with open(bundle_path, 'wb') as outfile:
+          outfile.write(bundle_data)
+        gitshed.apply_bundle(bundle_path, out=StringIO())
+        for _, _, (entry_shed_path,) in entries:
+          self.assertTrue(os.path.exists(entry_shed_path))
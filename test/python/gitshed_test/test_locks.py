@@ -0,0 +1,48 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+import os
+import threading
+import unittest
+
+from gitshed.locks import KeyLocks
+from gitshed_test.helpers import temporary_test_dir
+
+
+class KeyLocksTest(unittest.TestCase):
+  def test_key_locks(self):
+    with temporary_test_dir() as tmpdir:
+      lock_dir = os.path.join(tmpdir, 'locks')
+      # Locks are on open files, so two instances contend just like two processes would.
+      locks1 = KeyLocks(lock_dir)
+      locks2 = KeyLocks(lock_dir)
+      self.assertTrue(locks1.try_acquire('a'))
+      self.assertTrue(locks1.try_acquire('b'))
+      self.assertEqual({'a', 'b'}, locks1.held)
+      self.assertEqual(['a', 'b'], sorted(os.listdir(lock_dir)))
+      self.assertFalse(locks2.try_acquire('a'))
+      self.assertTrue(locks2.try_acquire('c'))
+
+      # A waiter gets the lock once its holder releases it.
+      acquired = threading.Event()
+
+      def wait_for_a():
+        locks2.acquire('a')
+        acquired.set()
+
+      waiter = threading.Thread(target=wait_for_a)
+      waiter.start()
+      self.assertFalse(acquired.wait(0.2))
+      locks1.release('a')
+      waiter.join()
+      self.assertTrue(acquired.is_set())
+      self.assertEqual({'a', 'c'}, locks2.held)
+      self.assertFalse(locks1.try_acquire('a'))
+
+      # Released locks leave nothing behind.
+      locks1.release_all()
+      locks2.release_all()
+      self.assertEqual(set(), locks1.held)
+      self.assertEqual([], os.listdir(lock_dir))
@@ -0,0 +1,166 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+from io import StringIO
+import json
+import os
+import threading
+import unittest
+
+import pytest
+
+from gitshed.gitshed import GitShed
+from gitshed.local_content_store import LocalContentStore
+from gitshed.metrics import (Metrics, merge, metric_name, metrics, percentile, read_records, read_totals,
+                             record_invocation, write_prometheus_textfile)
+from gitshed_test.helpers import temporary_git_repo, temporary_test_dir
+
+
+class MetricsTest(unittest.TestCase):
+  def test_metrics(self):
+    now = [100.0]
+    m = Metrics(clock=lambda: now[0])
+    m.command = 'sync'
+    self.assertEqual('bytes{op="get"}', metric_name('bytes', op='get'))
+    m.increment(metric_name('bytes', op='get'), 10)
+    m.increment(metric_name('bytes', op='get'), 5)
+    for seconds in [0.001, 0.02, 0.02, 0.3, 1000]:
+      m.observe('latency', seconds)
+    with pytest.raises(ValueError):
+      with m.timer('latency'):
+        now[0] += 0.5
+        raise ValueError()
+    now[0] += 1
+    record = m.record()
+    self.assertEqual('sync', record['command'])
+    self.assertEqual(100.0, record['time'])
+    self.assertEqual(1.5, record['duration_seconds'])
+    self.assertEqual({'bytes{op="get"}': 15}, record['counters'])
+    histogram = record['histograms']['latency']
+    self.assertEqual(6, histogram['count'])
+    self.assertEqual(0.001, percentile(histogram, 0.1))
+    self.assertEqual(0.025, percentile(histogram, 0.5))
+    self.assertEqual(0.5, percentile(histogram, 0.8))
+    self.assertIsNone(percentile(histogram, 0.99))
+
+    # Records sum across invocations, and so do totals.
+    other = dict(record, command='manage', counters={'bytes{op="get"}': 1, 'keys{op="get"}': 2})
+    totals = merge([merge([record, record]), other])
+    self.assertEqual({'sync': 2, 'manage': 1}, totals['invocations'])
+    self.assertEqual(4.5, totals['duration_seconds'])
+    self.assertEqual({'bytes{op="get"}': 31, 'keys{op="get"}': 2}, totals['counters'])
+    self.assertEqual(18, totals['histograms']['latency']['count'])
+    self.assertEqual(0.025, percentile(totals['histograms']['latency'], 0.5))
+
+    m.reset()
+    self.assertEqual({}, m.record()['counters'])
+
+  def test_prometheus_textfile(self):
+    m = Metrics()
+    m.command = 'sync'
+    m.increment(metric_name('bytes', op='get'), 15)
+    m.observe(metric_name('chunk_seconds', backend='LocalContentStore', op='get'), 0.02)
+    with temporary_test_dir() as tmpdir:
+      path = os.path.join(tmpdir, 'gitshed.prom')
+      write_prometheus_textfile(path, merge([m.record()]))
+      with open(path, 'r') as infile:
+        lines = infile.read().splitlines()
+      self.assertEqual(['gitshed.prom'], os.listdir(tmpdir))  # No temporary files are left behind.
+    self.assertIn('gitshed_invocations_total{command="sync"} 1', lines)
+    self.assertIn('# TYPE gitshed_bytes_total counter', lines)
+    self.assertIn('gitshed_bytes_total{op="get"} 15', lines)
+    self.assertIn('# TYPE gitshed_chunk_seconds histogram', lines)
+    self.assertIn('gitshed_chunk_seconds_bucket{backend="LocalContentStore",op="get",le="0.01"} 0', lines)
+    self.assertIn('gitshed_chunk_seconds_bucket{backend="LocalContentStore",op="get",le="0.025"} 1', lines)
+    self.assertIn('gitshed_chunk_seconds_bucket{backend="LocalContentStore",op="get",le="+Inf"} 1', lines)
+    self.assertIn('gitshed_chunk_seconds_count{backend="LocalContentStore",op="get"} 1', lines)
+
+  def test_record_invocation(self):
+    def record(command):
+      m = Metrics()
+      m.command = command
+      m.increment('files')
+      return m.record()
+
+    with temporary_test_dir() as tmpdir:
+      log_path = os.path.join(tmpdir, 'metrics.jsonl')
+      totals_path = os.path.join(tmpdir, 'metrics_totals.json')
+
+      # Totals that predate per-command totals are rebuilt from the log.
+      for command in ['sync', 'sync', 'manage']:
+        with open(log_path, 'a') as outfile:
+          outfile.write(json.dumps(record(command)) + '\n')
+      with open(totals_path, 'w') as outfile:
+        json.dump(merge([record('sync')]), outfile)
+      self.assertIsNone(read_totals(totals_path))
+      totals = record_invocation(log_path, totals_path, record('sync'))
+      self.assertEqual({'sync': 3, 'manage': 1},
+                       dict((command, t['counters']['files']) for command, t in totals.items()))
+      self.assertEqual(totals, read_totals(totals_path))
+
+      # Concurrent invocations all count, and the log is rotated as it grows.
+      max_log_size = 2000
+      def work():
+        for _ in range(25):
+          record_invocation(log_path, totals_path, record('status'), max_log_size=max_log_size)
+      threads = [threading.Thread(target=work) for _ in range(4)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      self.assertEqual(100, read_totals(totals_path)['status']['invocations']['status'])
+      self.assertEqual(3, read_totals(totals_path)['sync']['invocations']['sync'])
+      self.assertLess(os.path.getsize(log_path), max_log_size + 1000)
+      self.assertLess(os.path.getsize(log_path + '.1'), max_log_size + 1000)
+      self.assertEqual(sorted(['metrics.jsonl', 'metrics.jsonl.1', 'metrics_totals.json', 'metrics_totals.json.lock']),
+                       sorted(os.listdir(tmpdir)))
+
+  def test_record_and_stats(self):
+    seed_files = {'a': 'A CONTENT', 'b': 'B CONTENT'}
+    with temporary_git_repo(seed_files) as repo:
+      with temporary_test_dir() as tmpdir:
+        gitshed = GitShed(repo, LocalContentStore(os.path.join(tmpdir, 'content_store')))
+        textfile = os.path.join(tmpdir, 'gitshed.prom')
+
+        metrics.reset()
+        metrics.command = 'manage'
+        gitshed.manage(sorted(seed_files))
+        gitshed.record_metrics(textfile)
+
+        metrics.reset()
+        metrics.command = 'sync'
+        os.unlink(gitshed._get_gitshed_path('a'))
+        gitshed.sync_all()
+        gitshed.record_metrics(textfile)
+        metrics.reset()
+
+        records = read_records(os.path.join('.gitshed', 'state', 'metrics.jsonl'))
+        self.assertEqual(['manage', 'sync'], [record['command'] for record in records])
+        sync_counters = records[1]['counters']
+        self.assertEqual(1, sync_counters['sync_files{result="hit"}'])
+        self.assertEqual(1, sync_counters['sync_files{result="miss"}'])
+        self.assertEqual(len('A CONTENT'), sync_counters['bytes{op="get"}'])
+        self.assertEqual(1, records[1]['histograms']['symlink_scan_seconds']['count'])
+        self.assertEqual(1, records[1]['histograms']['chunk_seconds{backend="LocalContentStore",op="get"}']['count'])
+
+        with open(textfile, 'r') as infile:
+          prometheus = infile.read()
+        self.assertIn('gitshed_invocations_total{command="manage"} 1\n', prometheus)
+        self.assertIn('gitshed_invocations_total{command="sync"} 1\n', prometheus)
+        self.assertIn('gitshed_keys_total{op="put"} 2\n', prometheus)
+
+        out = StringIO()
+        gitshed.stats(out=out)
+        summary = out.getvalue()
+        self.assertIn('2 invocations (1 manage, 1 sync)', summary)
+        self.assertIn('50.0% of 2 files to sync were already synced.', summary)
+        self.assertIn('Fetched 1 keys (9 bytes).', summary)
+        self.assertIn('Stored 2 keys (18 bytes).', summary)
+        self.assertIn('chunk_seconds{backend="LocalContentStore",op="get"}', summary)
+
+        out = StringIO()
+        gitshed.stats(command='manage', out=out)
+        self.assertIn('1 invocations (1 manage)', out.getvalue())
+        self.assertNotIn('Fetched', out.getvalue())
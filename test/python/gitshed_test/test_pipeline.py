@@ -0,0 +1,66 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+import threading
+import time
+import unittest
+
+import pytest
+
+from gitshed.error import GitShedError
+from gitshed.pipeline import Pipeline
+
+
+class PipelineTest(unittest.TestCase):
+  def test_pipeline(self):
+    results = []
+    batch_sizes = []
+    lock = threading.Lock()
+
+    def double(x):
+      return 2 * x
+
+    def drop_multiples_of_three(x):
+      return None if x % 3 == 0 else x
+
+    def batch_add_one(batch):
+      batch_sizes.append(len(batch))
+      return [x + 1 for x in batch]
+
+    def collect(x):
+      with lock:
+        results.append(x)
+
+    (Pipeline()
+     .add_stage(double, concurrency=3)
+     .add_stage(drop_multiples_of_three)
+     .add_stage(batch_add_one, concurrency=2, batch_size=7)
+     .add_stage(collect, concurrency=2)
+     .run(iter(xrange(100))))
+
+    self.assertEqual(sorted(2 * x + 1 for x in xrange(100) if (2 * x) % 3), sorted(results))
+    self.assertTrue(all(0 < n <= 7 for n in batch_sizes))
+
+  def test_stages_overlap(self):
+    def sleep(x):
+      time.sleep(0.05)
+      return x
+
+    start = time.time()
+    Pipeline().add_stage(sleep).add_stage(sleep).add_stage(sleep).run(xrange(10))
+    # Running the stages one after another would take 1.5 seconds.
+    self.assertLess(time.time() - start, 1.0)
+
+  def test_error(self):
+    processed = []
+
+    def fail_on_five(x):
+      if x == 5:
+        raise GitShedError('Five!')
+      return x
+
+    with pytest.raises(GitShedError):
+      Pipeline().add_stage(fail_on_five).add_stage(processed.append).run(xrange(10000))
+    self.assertLess(len(processed), 10000)
@@ -22,3 +22,10 @@ class ProgressTest(unittest.TestCase):
     progress.increment()
     self.assertTrue(progress.is_complete())
     self.assertEquals(100, progress.pct_complete())
+
+  def test_progress_unknown_total(self):
+    progress = Progress(total=None)
+    for i in xrange(200):
+      self.assertFalse(progress.is_complete())
+      progress.increment()
+    self.assertFalse(progress.is_complete())
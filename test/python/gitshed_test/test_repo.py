@@ -3,9 +3,14 @@
 from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
                         print_function, unicode_literals)
 
+import os
 import unittest
 
-from gitshed_test.helpers import temporary_git_repo
+import pytest
+
+from gitshed.error import GitShedError
+from gitshed.util import run_cmd_str
+from gitshed_test.helpers import commit_all, temporary_git_repo
 
 
 class GitRepoTest(unittest.TestCase):
@@ -13,3 +18,51 @@ class GitRepoTest(unittest.TestCase):
     with temporary_git_repo({'.gitignore': '*.ignored'}) as repo:
       self.assertTrue(repo.is_ignored('foo.ignored'))
       self.assertFalse(repo.is_ignored('foo.notignored'))
+
+  def test_ignored_paths(self):
+    with temporary_git_repo({'.gitignore': '*.ignored\n!keep.ignored\n'}) as repo:
+      paths = ['foo.ignored', 'foo.notignored', 'keep.ignored', 'dir/bar.ignored', 'with space.ignored']
+      self.assertEquals({'foo.ignored', 'dir/bar.ignored', 'with space.ignored'}, repo.ignored_paths(paths))
+      self.assertEquals(set(), repo.ignored_paths([]))
+      # Paths outside the repo are an error, after which the long-lived process is restarted.
+      with pytest.raises(GitShedError):
+        repo.ignored_paths(['../outside.ignored'])
+      self.assertEquals({'foo.ignored'}, repo.ignored_paths(['foo.ignored', 'foo.notignored']))
+
+  def test_has_commit(self):
+    with temporary_git_repo({'foo.txt': 'FOO'}) as repo:
+      commit_all()
+      _, head, _ = run_cmd_str('git rev-parse HEAD')
+      _, tree, _ = run_cmd_str('git rev-parse HEAD^{tree}')
+      self.assertTrue(repo.has_commit(head.strip()))
+      self.assertTrue(repo.has_commit('HEAD'))
+      self.assertFalse(repo.has_commit(tree.strip()))
+      self.assertFalse(repo.has_commit('0' * 40))
+      self.assertTrue(repo.has_commit(head.strip()))
+
+  def test_read_blobs(self):
+    with temporary_git_repo({'foo.txt': 'FOO', 'bar.txt': 'BAR\n'}) as repo:
+      _, foo_blob, _ = run_cmd_str('git hash-object -w foo.txt')
+      _, bar_blob, _ = run_cmd_str('git hash-object -w bar.txt')
+      foo_blob, bar_blob = foo_blob.strip(), bar_blob.strip()
+      self.assertEquals({foo_blob: b'FOO', bar_blob: b'BAR\n'}, repo.read_blobs([foo_blob, bar_blob]))
+      # A missing blob is an error, but doesn't garble the responses to later queries.
+      with pytest.raises(GitShedError):
+        repo.read_blobs([foo_blob, '0' * 40, bar_blob])
+      self.assertEquals({bar_blob: b'BAR\n'}, repo.read_blobs([bar_blob]))
+      # Blobs larger than the read buffer.
+      big = os.urandom(300000)
+      with open('big.bin', 'wb') as outfile:
+        outfile.write(big)
+      _, big_blob, _ = run_cmd_str('git hash-object -w big.bin')
+      big_blob = big_blob.strip()
+      self.assertEquals({foo_blob: b'FOO', big_blob: big, bar_blob: b'BAR\n'},
+                        repo.read_blobs([foo_blob, big_blob, bar_blob]))
+
+  def test_symlink_targets(self):
+    with temporary_git_repo({'foo/bar.txt': 'BAR'}) as repo:
+      os.symlink('bar.txt', 'foo/link')
+      os.symlink('../foo/bar.txt', 'baz')
+      commit_all()
+      os.unlink('baz')
+      self.assertEquals({'foo/link': 'bar.txt', 'baz': '../foo/bar.txt'}, repo.symlink_targets('HEAD'))
@@ -0,0 +1,43 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+import os
+import unittest
+
+from gitshed.staging import StagingArea
+from gitshed.util import safe_makedirs
+from gitshed_test.helpers import temporary_test_dir
+
+
+class StagingAreaTest(unittest.TestCase):
+  def test_staging_area(self):
+    with temporary_test_dir() as tmpdir:
+      root = os.path.join(tmpdir, 'staging')
+      # A slot left behind by a process that no longer exists.
+      stale_slot = os.path.join(root, '999999999.1')
+      safe_makedirs(os.path.join(stale_slot, 'subdir'))
+      staging_area = StagingArea(lambda: root)
+      self.assertFalse(os.path.exists(os.path.join(root, '{0}.1'.format(os.getpid()))))
+
+      with staging_area.slot() as slot1:
+        self.assertFalse(os.path.exists(stale_slot))
+        self.assertEqual(root, os.path.dirname(slot1))
+        self.assertEqual([], os.listdir(slot1))
+        with staging_area.slot() as slot2:
+          self.assertNotEqual(slot1, slot2)
+        with open(os.path.join(slot1, 'file'), 'w') as outfile:
+          outfile.write('CONTENT')
+        safe_makedirs(os.path.join(slot1, 'dir', 'subdir'))
+
+      # Slots are emptied, and reused.
+      with staging_area.slot() as slot:
+        self.assertIn(slot, [slot1, slot2])
+        self.assertEqual([], os.listdir(slot))
+        with staging_area.slot() as other_slot:
+          self.assertEqual({slot1, slot2}, {slot, other_slot})
+          self.assertEqual([], os.listdir(other_slot))
+
+      staging_area.close()
+      self.assertEqual([], os.listdir(root))
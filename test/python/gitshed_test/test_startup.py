@@ -0,0 +1,90 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+import json
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+from gitshed.error import GitShedError
+from gitshed.gitshed import GitShed
+from gitshed.main import main
+from gitshed_test.helpers import temporary_git_repo
+
+
+class StartupTest(unittest.TestCase):
+  # Modules that are slow to import, and that read-only commands don't need.
+  # Importing the CLI must not import any of these.
+  slow_modules = [
+    'click',
+    'ctypes',
+    'multiprocessing.pool',
+    'uuid',
+    'gitshed.bundle',
+    'gitshed.local_content_store',
+    'gitshed.manifest',
+    'gitshed.remote_content_store',
+    'gitshed.replicated_content_store',
+    'gitshed.routed_content_store',
+    'gitshed.s3_content_store',
+    'gitshed.served_content_store',
+    'gitshed.server',
+    'gitshed.simulated_content_store',
+    'gitshed.tiered_content_store',
+  ]
+
+  # The wall time budget for `git shed status` in a small repo.
+  # Typically well under 0.1 seconds; the budget leaves room for slow test machines.
+  status_budget_seconds = 0.25
+
+  @staticmethod
+  def _env():
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+
+  def test_cli_import_budget(self):
+    script = 'import json, sys; import gitshed.main; print(json.dumps(sorted(sys.modules)))'
+    stdout = subprocess.check_output([sys.executable, '-c', script], env=self._env())
+    imported = set(json.loads(stdout))
+    self.assertEqual([], [m for m in self.slow_modules if m in imported])
+
+  def test_status_time_budget(self):
+    config = json.dumps({'content_store': {'local': {'root': 'unused'}}})
+    with temporary_git_repo({os.path.join('.gitshed', 'config.json'): config}):
+      cmd = [sys.executable, '-m', 'gitshed.main', 'status']
+      durations = []
+      for _ in range(5):  # Take the fastest of a few runs, to ignore noise from other processes.
+        start = time.time()
+        subprocess.check_output(cmd, env=self._env())
+        durations.append(time.time() - start)
+      self.assertLess(min(durations), self.status_budget_seconds)
+
+  def test_fast_commands_fail_like_cli(self):
+    def run(*args):
+      p = subprocess.Popen([sys.executable, '-m', 'gitshed.main'] + list(args),
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self._env())
+      _, stderr = p.communicate()
+      return p.returncode, stderr.decode('utf-8')
+
+    with temporary_git_repo({}):
+      expected = (1, 'Error: No config file found at .gitshed/config.json\n')
+      self.assertEqual(expected, run('stats'))  # Run by the full CLI.
+      self.assertEqual(expected, run('status'))
+      self.assertEqual(expected, run('synced', '-z'))
+      self.assertEqual(1, main(['unsynced']))
+
+  def test_read_only_commands_do_not_create_content_store(self):
+    def create_content_store():
+      raise GitShedError('Content store unexpectedly created.')
+
+    with temporary_git_repo({}) as repo:
+      gitshed = GitShed(repo, create_content_store)
+      gitshed.get_status()
+      gitshed.synced()
+      gitshed.unsynced()
+      gitshed.sync([])
+      # Nor do they create the shed.
+      self.assertFalse(os.path.exists(os.path.join('.gitshed', 'files')))
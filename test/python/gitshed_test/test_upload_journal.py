@@ -0,0 +1,43 @@
+# coding=utf-8
+
+from __future__ import (nested_scopes, generators, division, absolute_import, with_statement,
+                        print_function, unicode_literals)
+
+import os
+import unittest
+
+from gitshed.upload_journal import UploadJournal
+from gitshed_test.helpers import temporary_test_dir
+
+
+class UploadJournalTest(unittest.TestCase):
+  def test_upload_journal(self):
+    with temporary_test_dir() as tmpdir:
+      path = os.path.join(tmpdir, 'state', 'upload_journal')
+      journal = UploadJournal(path)
+      self.assertEqual({}, journal.pending())
+      journal.add([('k1', 'shed/p1', 'p1'), ('k2', 'shed/p2', 'p2')])
+      journal.add([('k3', 'shed/p3', 'p3')])
+      self.assertEqual([('k1', 'shed/p1'), ('k2', 'shed/p2'), ('k3', 'shed/p3')],
+                       list(journal.pending().items()))
+      self.assertEqual(('shed/p2', 'p2'), journal.pending_entries()['k2'])
+      # Entries journaled before paths were recorded.
+      with open(path, 'a') as outfile:
+        outfile.write('{"key": "k0", "path": "shed/p0"}\n')
+      self.assertEqual(('shed/p0', None), journal.pending_entries()['k0'])
+      journal.mark_done(['k0'])
+
+      # The journal is durable, and shared by all its users.
+      journal.mark_done(['k2'])
+      self.assertEqual(['k1', 'k3'], list(UploadJournal(path).pending().keys()))
+
+      # A write interrupted by a crash loses only itself.
+      with open(path, 'a') as outfile:
+        outfile.write('{"key": "k4", "pa')
+      journal.add([('k5', 'shed/p5', 'p5')])
+      self.assertEqual(['k1', 'k3', 'k5'], list(journal.pending().keys()))
+
+      # Once everything is done, the journal is emptied.
+      journal.mark_done(['k1', 'k3', 'k5'])
+      self.assertEqual({}, journal.pending())
+      self.assertEqual(0, os.path.getsize(path))